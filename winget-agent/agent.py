@@ -6,12 +6,21 @@ load_dotenv()
 
 import subprocess
 import json
+import gzip
+import hashlib
 import socket
-import requests
+# requests jest importowany dopiero przy pierwszym połączeniu (get_http_session) - sam import trwa dłużej
+# niż cały start agenta z wykrywaniem z pamięci podręcznej.
 import time
 import logging
 import sys
 import threading
+import base64
+import queue
+import atexit
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 # ======= KONFIGURACJA Z .env =======
 API_ENDPOINTS = [os.environ.get("AGENT_API_ENDPOINT", "").strip()]  # lista, możesz łatwo dodać wsparcie wielu serwerów
@@ -19,6 +28,28 @@ API_KEY = os.environ.get("API_KEY", "")
 LOOP_INTERVAL_SECONDS = int(os.environ.get("AGENT_LOOP_INTERVAL", "60"))
 FULL_REPORT_INTERVAL_LOOPS = int(os.environ.get("AGENT_FULL_REPORT_INTERVAL", "60"))
 WINGET_PATH_CONF = os.environ.get("WINGET_PATH_CONF", "")
+POWERSHELL_TIMEOUT_SECONDS = int(os.environ.get("AGENT_POWERSHELL_TIMEOUT", "1800"))
+COLLECTOR_WORKERS = int(os.environ.get("AGENT_COLLECTOR_WORKERS", "4"))
+# Najwięcej tylu procesów powershell.exe naraz; polecenia z innych wątków czekają na wolny proces.
+SHELL_WORKERS = max(1, int(os.environ.get("AGENT_SHELL_WORKERS", "2")))
+# Long-poll zadań: ile sekund serwer może trzymać zapytanie o zadania (0 = zwykłe odpytywanie co LOOP_INTERVAL).
+LONG_POLL_SECONDS = int(os.environ.get("AGENT_LONG_POLL_SECONDS", "55"))
+# Treści wysyłane do serwera większe niż ten próg (w bajtach) są kompresowane gzip (0 = bez kompresji).
+COMPRESS_MIN_BYTES = int(os.environ.get("AGENT_COMPRESS_MIN_BYTES", "1024"))
+# Ponowienia wysyłki, gdy serwer odpowiada 429 (kolejka raportów pełna); czekanie według Retry-After.
+REQUEST_RETRIES = int(os.environ.get("AGENT_REQUEST_RETRIES", "3"))
+MAX_RETRY_AFTER_SECONDS = 300
+# Kolejka offline: pierwsza ponowna wysyłka po tylu sekundach, potem odstęp podwajany do maksimum.
+SPOOL_RETRY_BASE_SECONDS = int(os.environ.get("AGENT_SPOOL_RETRY_BASE", "30"))
+SPOOL_RETRY_MAX_SECONDS = int(os.environ.get("AGENT_SPOOL_RETRY_MAX", "1800"))
+SPOOL_MAX_RESULTS = 1000  # na serwer; przy przepełnieniu usuwany jest najstarszy wynik
+# Gdy serwer nie podaje harmonogramu, pierwszy raport po starcie jest opóźniany o stałe dla hosta 0..N sekund.
+STARTUP_REPORT_SPREAD_SECONDS = int(os.environ.get("AGENT_STARTUP_REPORT_SPREAD", "300"))
+# Dostępne aktualizacje aplikacji: 'auto' - jak podaje serwer (X-Update-Source), 'agent' - zawsze winget upgrade.
+UPDATE_SOURCE = os.environ.get("AGENT_UPDATE_SOURCE", "auto").strip().lower()
+# Po tylu sekundach wynik wykrywania (ścieżka winget, adres IP) jest ustalany od nowa, nawet jeśli wciąż wygląda na ważny.
+DISCOVERY_MAX_AGE_SECONDS = int(os.environ.get("AGENT_DISCOVERY_MAX_AGE", "86400"))
+WINGET_MISSING_RECHECK_SECONDS = 300  # gdy winget nie znaleziono, ponowne szukanie najwcześniej po tylu sekundach
 
 # ======= RESZTA KODU AGENTA =======
 def find_winget_path():
@@ -47,8 +78,6 @@ def find_winget_path():
         pass
     return None
 
-WINGET_PATH = find_winget_path()
-
 # --- Logowanie ---
 if getattr(sys, 'frozen', False):
     application_path = os.path.dirname(sys.executable)
@@ -56,7 +85,298 @@ else:
     application_path = os.path.dirname(os.path.abspath(__file__))
 
 log_file = os.path.join(application_path, 'agent.log')
-logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Przy AGENT_LOG_LEVEL=DEBUG agent zapisuje też próbki treści każdego raportu.
+LOG_LEVEL = os.environ.get("AGENT_LOG_LEVEL", "INFO").strip().upper()
+logging.basicConfig(filename=log_file, level=getattr(logging, LOG_LEVEL, logging.INFO),
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+# --- Wykrywanie środowiska ---
+# Szukanie winget (PATH, profile użytkowników, `where winget`) i ustalanie adresu IP są kosztowne, a tryb
+# run_once płaci za nie przy każdym uruchomieniu z harmonogramu. Wynik jest zapisywany w discovery_cache.json
+# i używany, dopóki jest ważny: plik winget istnieje, nazwa hosta się nie zmieniła, adres IP nadal należy
+# do komputera, a wpis nie jest starszy niż DISCOVERY_MAX_AGE_SECONDS. Nieważne pole jest wykrywane od nowa.
+DISCOVERY_CACHE_FILE = os.path.join(application_path, 'discovery_cache.json')
+discovery = None
+discovery_lock = threading.Lock()
+
+def save_discovery_cache():
+    try:
+        tmp_path = DISCOVERY_CACHE_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(discovery, f, ensure_ascii=False)
+        os.replace(tmp_path, DISCOVERY_CACHE_FILE)
+    except OSError as e:
+        logging.error("Nie udało się zapisać pamięci podręcznej wykrywania: %s", e)
+
+def discovery_entry():
+    """Zwraca wpis wykrywania dla bieżącego hosta; po zmianie nazwy hosta albo po DISCOVERY_MAX_AGE_SECONDS pusty."""
+    global discovery
+    if discovery is None:
+        try:
+            with open(DISCOVERY_CACHE_FILE, "r", encoding="utf-8") as f:
+                discovery = json.load(f)
+        except (OSError, ValueError):
+            discovery = {}
+    hostname = socket.gethostname()
+    if discovery.get("hostname") != hostname or not 0 <= time.time() - discovery.get("checked_at", 0) < DISCOVERY_MAX_AGE_SECONDS:
+        discovery = {"hostname": hostname, "checked_at": time.time()}
+    return discovery
+
+def address_is_local(ip_address):
+    """Czy adres nadal jest przypisany do komputera - bind() bez wysyłania czegokolwiek."""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.bind((ip_address, 0))
+        return True
+    except OSError:
+        return False
+
+def get_winget_path():
+    with discovery_lock:
+        entry = discovery_entry()
+        winget_path = entry.get("winget_path")
+        # Brak winget też jest zapamiętywany, ale krótko - żeby nie szukać przy każdym kolektorze i zadaniu.
+        valid = os.path.isfile(winget_path) if winget_path else time.time() - entry.get("searched_at", 0) < WINGET_MISSING_RECHECK_SECONDS
+        if entry.get("winget_path_conf") != WINGET_PATH_CONF or not valid:
+            started = time.monotonic()
+            winget_path = find_winget_path()
+            entry.update(winget_path=winget_path, winget_path_conf=WINGET_PATH_CONF, searched_at=time.time())
+            save_discovery_cache()
+            logging.info("Wykrywanie ścieżki winget: %s (%.2fs)", winget_path or "nie znaleziono", time.monotonic() - started)
+        return winget_path
+
+# --- Raporty różnicowe (delta) ---
+# Ostatni stan potwierdzony przez każdy serwer; pozwala wysyłać tylko zmiany zamiast pełnych list.
+REPORT_STATE_FILE = os.path.join(application_path, 'report_state.json')
+REPORT_PROTOCOL_VERSION = 2
+# Pola stanu porównywane przy liczeniu skrótu i różnic - muszą być zgodne z serwerem.
+STATE_FIELDS = {
+    "installed_apps": ("id", "name", "version"),
+    "available_app_updates": ("id", "name", "current_version", "available_version"),
+    "pending_os_updates": ("Title", "KB"),
+}
+
+def normalize_report_state(payload):
+    pending_os_updates = payload.get("pending_os_updates") or []
+    if isinstance(pending_os_updates, dict): pending_os_updates = [pending_os_updates]
+    os_updates = []
+    for os_update in pending_os_updates:
+        if not isinstance(os_update, dict): continue
+        kb = ", ".join(os_update.get("KB", [])) if isinstance(os_update.get("KB"), list) else os_update.get("KB", "N/A")
+        os_updates.append({"Title": os_update.get("Title", "Brak tytułu"), "KB": kb})
+    return {
+        "installed_apps": [a for a in payload.get("installed_apps") or [] if isinstance(a, dict) and a.get("name")],
+        "available_app_updates": [u for u in payload.get("available_app_updates") or [] if isinstance(u, dict)],
+        "pending_os_updates": os_updates,
+    }
+
+def state_entry_key(section, entry):
+    if section == "pending_os_updates": return entry.get("Title") or ""
+    return entry.get("id") or entry.get("name") or ""
+
+def compute_state_hash(state):
+    canonical = {section: sorted([str(e.get(f) or '') for f in fields] for e in state.get(section, []))
+                 for section, fields in STATE_FIELDS.items()}
+    return hashlib.sha256(json.dumps(canonical, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+                          .encode('utf-8')).hexdigest()
+
+def build_state_delta(old_state, new_state):
+    """Zwraca różnicę między stanami lub None, gdy klucze nie są unikalne (wtedy wysyłany jest pełny raport)."""
+    delta = {}
+    for section, fields in STATE_FIELDS.items():
+        old = {state_entry_key(section, e): e for e in old_state.get(section, [])}
+        new = {state_entry_key(section, e): e for e in new_state.get(section, [])}
+        if len(old) != len(old_state.get(section, [])) or len(new) != len(new_state.get(section, [])):
+            return None
+        delta[section] = {
+            "added": [e for k, e in new.items() if k not in old],
+            "removed": [k for k in old if k not in new],
+            "changed": [e for k, e in new.items() if k in old and
+                        any(str(e.get(f) or '') != str(old[k].get(f) or '') for f in fields)],
+        }
+    return delta
+
+def load_report_state():
+    try:
+        with open(REPORT_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_report_state(report_state):
+    try:
+        tmp_path = REPORT_STATE_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(report_state, f, ensure_ascii=False)
+        os.replace(tmp_path, REPORT_STATE_FILE)
+    except OSError as e:
+        logging.error("Nie udało się zapisać stanu raportów: %s", e)
+
+# --- Połączenia HTTP ---
+# Jedna trwała sesja (keep-alive) na serwer, współdzielona przez raporty, long-poll i wyniki zadań.
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+compression_unsupported = set()  # serwery, które nie przyjmują treści z Content-Encoding: gzip
+
+def get_http_session(base_url):
+    with http_sessions_lock:
+        session = http_sessions.get(base_url)
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            session.headers.update({"Content-Type": "application/json", "X-API-Key": API_KEY})
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            http_sessions[base_url] = session
+        return session
+
+def close_http_sessions():
+    with http_sessions_lock:
+        for session in http_sessions.values():
+            session.close()
+        http_sessions.clear()
+
+atexit.register(close_http_sessions)
+
+def encode_body(body):
+    """Koduje zserializowany JSON do wysyłki. Zwraca (bajty, bajty_gzip albo None poniżej progu)."""
+    raw = body.encode("utf-8")
+    if COMPRESS_MIN_BYTES <= 0 or len(raw) < COMPRESS_MIN_BYTES:
+        return raw, None
+    return raw, gzip.compress(raw, compresslevel=6)
+
+def post_body(base_url, url, encoded, timeout=60):
+    """Wysyła treść z encode_body(); przy przeciążeniu serwera (429) czeka Retry-After i ponawia."""
+    for attempt in range(REQUEST_RETRIES + 1):
+        r = post_encoded(base_url, url, encoded, timeout)
+        if r.status_code != 429 or attempt == REQUEST_RETRIES:
+            return r
+        try:
+            delay = min(int(r.headers.get("Retry-After", "30")), MAX_RETRY_AFTER_SECONDS)
+        except ValueError:
+            delay = 30
+        logging.warning("Serwer %s jest przeciążony (429) - ponowienie za %ds.", base_url, delay)
+        time.sleep(delay)
+
+def post_encoded(base_url, url, encoded, timeout):
+    """Wysyła treść przez sesję serwera. Gdy serwer nie przyjmie gzip (400/415),
+    ponawia bez kompresji i zapamiętuje to dla danego serwera."""
+    raw, packed = encoded
+    session = get_http_session(base_url)
+    if packed is not None and base_url not in compression_unsupported:
+        started = time.monotonic()
+        r = session.post(url, data=packed, headers={"Content-Encoding": "gzip"}, timeout=timeout)
+        if r.status_code not in (400, 415):
+            logging.info("Wysłano %s: %d B gzip zamiast %d B (-%.0f%%) w %.2fs", url, len(packed), len(raw),
+                         100 * (1 - len(packed) / len(raw)), time.monotonic() - started)
+            return r
+        r = session.post(url, data=raw, timeout=timeout)
+        if r.status_code not in (400, 415):
+            logging.info("Serwer %s nie przyjmuje treści gzip - dalsze wysyłki bez kompresji.", base_url)
+            compression_unsupported.add(base_url)
+        return r
+    return session.post(url, data=raw, timeout=timeout)
+
+# --- Harmonogram raportów ---
+# Serwer podaje w nagłówkach odpowiedzi slot raportu tego hosta (X-Report-In), cykl raportów (X-Report-Interval)
+# i mnożnik przerw pod obciążeniem (X-Slow-Down). Bez tych nagłówków agent raportuje co
+# FULL_REPORT_INTERVAL_LOOPS pętli, a pierwszy raport po starcie przesuwa o host_jitter().
+report_schedule = {"report_at": None, "interval": FULL_REPORT_INTERVAL_LOOPS * LOOP_INTERVAL_SECONDS, "slow_down": 1.0}
+report_schedule_lock = threading.Lock()
+
+def host_jitter(hostname, span):
+    """Stałe dla hosta opóźnienie z zakresu [0, span) - po restarcie całej floty hosty nie startują razem."""
+    digest = hashlib.sha256(hostname.lower().encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % span if span > 0 else 0
+
+def apply_report_schedule(response):
+    """Przyjmuje harmonogram z nagłówków odpowiedzi serwera (starszy serwer ich nie wysyła)."""
+    if "X-Report-In" not in response.headers:
+        return
+    try:
+        report_in = float(response.headers["X-Report-In"])
+        interval = float(response.headers.get("X-Report-Interval", "0"))
+        slow_down = max(1.0, float(response.headers.get("X-Slow-Down", "1")))
+    except ValueError:
+        return
+    now = time.monotonic()
+    with report_schedule_lock:
+        # Raport, którego termin już minął, nie jest przesuwany - pętla główna wyśle go przy najbliższym obrocie.
+        if report_schedule["report_at"] is None or report_schedule["report_at"] > now:
+            report_schedule["report_at"] = now + report_in
+        if interval > 0:
+            report_schedule["interval"] = interval
+        if slow_down != report_schedule["slow_down"]:
+            logging.info("Serwer zmienia tempo agenta: przerwy x%g (raport za %ds).", slow_down, report_in)
+        report_schedule["slow_down"] = slow_down
+
+def schedule_next_report(delay=None):
+    """Ustawia termin raportu (domyślnie za pełny cykl); serwer doprecyzowuje go w kolejnych odpowiedziach."""
+    with report_schedule_lock:
+        report_schedule["report_at"] = time.monotonic() + (report_schedule["interval"] if delay is None else delay)
+
+def report_due():
+    with report_schedule_lock:
+        return report_schedule["report_at"] is not None and time.monotonic() >= report_schedule["report_at"]
+
+def poll_pause(waited):
+    """Przerwa przed kolejnym zapytaniem o zadania; po long-poll tylko dodatkowa przerwa z X-Slow-Down."""
+    with report_schedule_lock:
+        slow_down = report_schedule["slow_down"]
+    return LOOP_INTERVAL_SECONDS * (slow_down - 1 if waited else slow_down)
+
+# --- Źródło dostępnych aktualizacji ---
+# Serwer z katalogiem wersji pakietów odpowiada X-Update-Source: catalog i sam wylicza dostępne aktualizacje
+# z listy zainstalowanych aplikacji. Gdy robią to wszystkie serwery, agent pomija powolne `winget upgrade`.
+# Ostatnia odpowiedź jest zapisywana w update_source.json - w trybie run_once raport jest zbierany, zanim
+# przyjdzie jakakolwiek odpowiedź serwera, więc bez tego każde uruchomienie robiłoby pełne `winget upgrade`.
+UPDATE_SOURCE_FILE = os.path.join(application_path, 'update_source.json')
+update_source_lock = threading.Lock()
+
+def load_update_sources():
+    try:
+        with open(UPDATE_SOURCE_FILE, "r", encoding="utf-8") as f:
+            sources = json.load(f)
+        return sources if isinstance(sources, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_update_sources():
+    try:
+        tmp_path = UPDATE_SOURCE_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(server_update_source, f, ensure_ascii=False)
+        os.replace(tmp_path, UPDATE_SOURCE_FILE)
+    except OSError as e:
+        logging.error("Nie udało się zapisać źródła aktualizacji: %s", e)
+
+server_update_source = load_update_sources()  # adres API serwera -> 'agent' / 'catalog' z ostatniej odpowiedzi
+
+def apply_update_source(response):
+    source = response.headers.get("X-Update-Source")
+    base_url = next((e.strip().replace('/report', '') for e in API_ENDPOINTS
+                     if e.strip() and response.url.startswith(e.strip().replace('/report', ''))), None)
+    if source not in ("agent", "catalog") or base_url is None:
+        return
+    with update_source_lock:
+        previous = server_update_source.get(base_url)
+        server_update_source[base_url] = source
+        if previous != source:
+            save_update_sources()
+    if previous != source:
+        logging.info("Serwer %s: dostępne aktualizacje aplikacji wylicza %s.", base_url,
+                     "serwer z katalogu pakietów" if source == "catalog" else "agent (winget upgrade)")
+        # Wynik kolektora z pamięci podręcznej pochodzi z poprzedniego trybu - przy zmianie zbieramy go od nowa.
+        if previous is not None or source == "catalog":
+            invalidate_collectors(["available_app_updates"])
+
+def server_computes_updates():
+    if UPDATE_SOURCE == "agent":
+        return False
+    base_urls = [e.strip().replace('/report', '') for e in API_ENDPOINTS if e.strip()]
+    return bool(base_urls) and all(server_update_source.get(b) == "catalog" for b in base_urls)
 
 def get_active_ip():
     try:
@@ -72,150 +392,552 @@ def get_active_ip():
         logging.error(f"Błąd pobierania aktywnego IP: {e}")
         return "127.0.0.1"
 
-def run_command(command):
-    try:
-        full_command = (
-            "[System.Threading.Thread]::CurrentThread.CurrentUICulture = [System.Globalization.CultureInfo]::GetCultureInfo('en-US'); "
-            "[System.Console]::OutputEncoding = [System.Text.Encoding]::UTF8; "
-            "$OutputEncoding = [System.Text.Encoding]::UTF8; "
-            + command
-        )
-        result = subprocess.run(
-            ["powershell.exe", "-NoProfile", "-Command", full_command],
-            capture_output=True, text=True, check=True, encoding='utf-8',
+# --- Trwały proces PowerShell ---
+# Zamiast uruchamiać nowy powershell.exe dla każdego polecenia, agent utrzymuje jeden proces-host.
+# Protokół (jedna linia w każdą stronę): agent wysyła polecenie zakodowane w base64 (UTF-8),
+# host odpowiada linią "@@WA <kod wyjścia> <stdout w base64>". Inne linie na stdout są ignorowane,
+# stderr jest odczytywany w tle i logowany. Dowolny proces mówiący tym protokołem może zastąpić PowerShell -
+# wystarczy przekazać jego argv do PowerShellWorker (zastępczy host dla Linuksa i testy: tests/fake_shell.py).
+RESPONSE_MARKER = "@@WA"
+POWERSHELL_HOST_SCRIPT = r"""
+[System.Threading.Thread]::CurrentThread.CurrentUICulture = [System.Globalization.CultureInfo]::GetCultureInfo('en-US')
+[System.Console]::OutputEncoding = [System.Text.Encoding]::UTF8
+$OutputEncoding = [System.Text.Encoding]::UTF8
+while ($true) {
+    $line = [Console]::In.ReadLine()
+    if ($null -eq $line) { break }
+    $command = [System.Text.Encoding]::UTF8.GetString([Convert]::FromBase64String($line))
+    $global:LASTEXITCODE = 0
+    try {
+        $output = Invoke-Expression $command | Out-String -Width 4096
+        $code = if ($LASTEXITCODE) { $LASTEXITCODE } else { 0 }
+    } catch {
+        [Console]::Error.WriteLine(($_ | Out-String))
+        $output = ''
+        $code = 1
+    }
+    $encoded = [Convert]::ToBase64String([System.Text.Encoding]::UTF8.GetBytes([string]$output))
+    [Console]::Out.WriteLine("@@WA $code $encoded")
+    [Console]::Out.Flush()
+}
+"""
+
+def default_shell_command():
+    encoded = base64.b64encode(POWERSHELL_HOST_SCRIPT.encode('utf-16-le')).decode('ascii')
+    return ["powershell.exe", "-NoProfile", "-NonInteractive", "-EncodedCommand", encoded]
+
+class PowerShellWorker:
+    """Długo żyjący proces powłoki wykonujący polecenia po kolei; restartowany po awarii lub przekroczeniu czasu."""
+
+    def __init__(self, shell_command=None, default_timeout=POWERSHELL_TIMEOUT_SECONDS):
+        self.shell_command = shell_command or default_shell_command()
+        self.default_timeout = default_timeout
+        self.process = None
+        self.responses = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        self.process = subprocess.Popen(
+            self.shell_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            text=True, encoding='utf-8', errors='replace', bufsize=1,
             creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0)
         )
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        logging.error("Błąd podczas wykonywania polecenia '%s': %s", command, e.stderr)
+        self.responses = queue.Queue()
+        threading.Thread(target=self._read_stdout, args=(self.process, self.responses), daemon=True).start()
+        threading.Thread(target=self._read_stderr, args=(self.process,), daemon=True).start()
+        logging.info("Uruchomiono proces powłoki (PID %s).", self.process.pid)
+
+    @staticmethod
+    def _read_stdout(process, responses):
+        for line in process.stdout:
+            if line.startswith(RESPONSE_MARKER + " "):
+                responses.put(line.rstrip("\r\n"))
+        responses.put(None)  # koniec strumienia - proces się zakończył
+
+    @staticmethod
+    def _read_stderr(process):
+        for line in process.stderr:
+            if line.strip():
+                logging.warning("Powłoka (stderr): %s", line.rstrip())
+
+    def _kill(self):
+        if self.process:
+            try:
+                self.process.kill()
+                self.process.wait(timeout=5)
+            except Exception:
+                pass
+        self.process = None
+
+    def execute(self, command, timeout=None):
+        """Wykonuje polecenie i zwraca (kod wyjścia, stdout). Przy przekroczeniu czasu lub awarii zwraca (None, None)."""
+        timeout = timeout or self.default_timeout
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self._start()
+            try:
+                self.process.stdin.write(base64.b64encode(command.encode('utf-8')).decode('ascii') + "\n")
+                self.process.stdin.flush()
+                response = self.responses.get(timeout=timeout)
+            except queue.Empty:
+                logging.error("Polecenie przekroczyło limit czasu %ds - restart powłoki: %s", timeout, command)
+                self._kill()
+                return None, None
+            except OSError as e:
+                logging.error("Utracono połączenie z procesem powłoki (%s) - restart przy następnym poleceniu.", e)
+                self._kill()
+                return None, None
+            if response is None:
+                logging.error("Proces powłoki zakończył się nieoczekiwanie podczas polecenia: %s", command)
+                self._kill()
+                return None, None
+            _, code, encoded = (response.split(" ", 2) + [""])[:3]
+            return int(code), base64.b64decode(encoded).decode('utf-8', errors='replace')
+
+    def close(self):
+        with self.lock:
+            if self.process and self.process.poll() is None:
+                try:
+                    self.process.stdin.close()
+                    self.process.wait(timeout=5)
+                except Exception:
+                    pass
+            self._kill()
+
+# Wątki (kolektory, kolejki zadań, raport) wypożyczają proces powłoki z małej puli (SHELL_WORKERS) na czas
+# jednego polecenia, zamiast trzymać każdy własny, bezczynny powershell.exe. Procesy są tworzone dopiero,
+# gdy brakuje wolnego; ostatnio oddany jest wypożyczany pierwszy (LIFO), więc zwykle pracuje jeden "ciepły" proces.
+shell_local = threading.local()  # deadline kolektora w bieżącym wątku
+shell_pool = queue.LifoQueue()
+shell_workers = []
+shell_workers_lock = threading.Lock()
+
+def acquire_shell_worker(timeout):
+    """Wolny proces powłoki z puli albo nowy, jeśli pula nie jest pełna. None, gdy żaden nie zwolnił się w czasie."""
+    try:
+        return shell_pool.get_nowait()
+    except queue.Empty:
+        pass
+    with shell_workers_lock:
+        if len(shell_workers) < SHELL_WORKERS:
+            worker = PowerShellWorker()
+            shell_workers.append(worker)
+            return worker
+    try:
+        return shell_pool.get(timeout=timeout)
+    except queue.Empty:
         return None
+
+def release_shell_worker(worker):
+    shell_pool.put(worker)
+
+def close_shell_workers():
+    with shell_workers_lock:
+        for worker in shell_workers:
+            worker.close()
+
+atexit.register(close_shell_workers)
+
+# --- Czasy wywołań winget/PowerShell ---
+# Sumowane według etykiety od ostatniego raportu i wysyłane w nim jako command_stats (serwer wystawia je w /metrics).
+command_stats = {}
+command_stats_lock = threading.Lock()
+
+def record_command_timing(label, duration, ok):
+    with command_stats_lock:
+        entry = command_stats.setdefault(label, {"count": 0, "total": 0.0, "max": 0.0, "failed": 0})
+        entry["count"] += 1
+        entry["total"] += duration
+        entry["max"] = max(entry["max"], duration)
+        entry["failed"] += 0 if ok else 1
+
+def take_command_stats():
+    with command_stats_lock:
+        stats = {label: dict(entry, total=round(entry["total"], 3), max=round(entry["max"], 3))
+                 for label, entry in command_stats.items()}
+        command_stats.clear()
+    return stats
+
+def run_command(command, timeout=None, label="powershell"):
+    # W wątku kolektora polecenie nie może trwać dłużej niż pozostały czas kolektora.
+    deadline = getattr(shell_local, "deadline", None)
+    if timeout is None and deadline is not None:
+        timeout = max(1, deadline - time.monotonic())
+    timeout = timeout or POWERSHELL_TIMEOUT_SECONDS
+    started = time.monotonic()
+    worker = acquire_shell_worker(timeout)
+    if worker is None:
+        logging.error("Brak wolnego procesu powłoki przez %ds - pominięto polecenie: %s", timeout, command)
+        record_command_timing(label, time.monotonic() - started, False)
+        return None
+    try:
+        # Czas czekania na proces z puli wlicza się do limitu polecenia.
+        code, output = worker.execute(command, timeout=max(1, timeout - (time.monotonic() - started)))
     except FileNotFoundError:
         logging.error("Nie znaleziono polecenia 'powershell.exe'.")
         return None
+    finally:
+        release_shell_worker(worker)
+    record_command_timing(label, time.monotonic() - started, code == 0)
+    if code is None:
+        return None
+    if code != 0:
+        logging.error("Błąd podczas wykonywania polecenia '%s' (kod %s): %s", command, code, output)
+        return None
+    return output
 
 def get_system_info():
-    hostname = socket.gethostname()
-    ip_address = get_active_ip()
-    return {"hostname": hostname, "ip_address": ip_address}
+    with discovery_lock:
+        entry = discovery_entry()
+        ip_address = entry.get("ip_address")
+        if not ip_address or not address_is_local(ip_address):
+            ip_address = get_active_ip()
+            # Adres zastępczy po błędzie nie trafia do pamięci podręcznej - następnym razem kolejna próba.
+            if ip_address != "127.0.0.1":
+                entry["ip_address"] = ip_address
+                save_discovery_cache()
+        return {"hostname": entry["hostname"], "ip_address": ip_address}
+
+class CollectorError(Exception):
+    """Kolektor nie zebrał danych. Nie wolno wtedy zwracać pustego wyniku - serwer uznałby, że aplikacje
+    lub aktualizacje zniknęły; run_collectors pomija sekcję i nie zapisuje jej w pamięci podręcznej."""
+
+def run_collector_command(command, label):
+    output = run_command(command, label=label)
+    if output is None:
+        raise CollectorError(f"polecenie {label} nie powiodło się")
+    return output
 
 def get_reboot_status():
     logging.info("Sprawdzanie statusu wymaganego restartu...")
     command = "(New-Object -ComObject Microsoft.Update.SystemInfo).RebootRequired"
-    output = run_command(command)
-    return "true" in output.lower() if output else False
+    output = run_collector_command(command, "reboot_status").strip().lower()
+    if output not in ("true", "false"):
+        raise CollectorError(f"nieoczekiwana odpowiedź RebootRequired: {output!r}")
+    return output == "true"
+
+# --- Parser tabel winget ---
+# winget wyrównuje kolumny według szerokości wyświetlanej (znaki CJK zajmują 2 komórki), a za długie
+# wartości skraca znakiem "…". Granice kolumn wyznaczane są raz, z linii nagłówka nad linią "-----",
+# niezależnie od języka nagłówków; wiersze są zwracane na bieżąco, w miarę czytania wyjścia.
+ANSI_ESCAPE_RE = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+TRUNCATION_MARK = "…"
+
+def char_width(ch):
+    if unicodedata.combining(ch) or unicodedata.category(ch) in ("Cc", "Cf"):
+        return 0
+    return 2 if unicodedata.east_asian_width(ch) in ("W", "F") else 1
+
+def clean_table_line(line):
+    line = ANSI_ESCAPE_RE.sub("", line.rstrip("\r\n"))
+    return line.rsplit("\r", 1)[-1].replace("\b", "")
+
+def column_starts(header):
+    starts, pos, prev_space = [], 0, True
+    for ch in header:
+        if ch != " " and prev_space:
+            starts.append(pos)
+        prev_space = ch == " "
+        pos += char_width(ch)
+    return starts
+
+def split_columns(line, starts):
+    """Tnie wiersz na pola według pozycji komórek. Zwraca None, gdy tekst przechodzi przez granicę kolumny
+    bez odstępu - wtedy linia nie jest wierszem tabeli (np. stopka "2 upgrades available.")."""
+    if line.isascii():  # szybka ścieżka: każdy znak zajmuje jedną komórkę
+        if any(b < len(line) and line[b - 1] != " " for b in starts[1:]):
+            return None
+        bounds = starts[1:] + [None]
+        return [line[a:b].strip() for a, b in zip(starts, bounds)]
+    fields, col, pos, prev_space = [[] for _ in starts], 0, 0, True
+    for ch in line:
+        while col + 1 < len(starts) and pos >= starts[col + 1]:
+            if not prev_space:
+                return None
+            col += 1
+        fields[col].append(ch)
+        prev_space = ch == " "
+        pos += char_width(ch)
+    return ["".join(f).strip() for f in fields]
+
+def iter_winget_table(lines):
+    """Zwraca kolejne wiersze tabel z wyjścia winget jako listy pól (w kolejności kolumn nagłówka)."""
+    starts, previous = None, ""
+    for raw_line in lines:
+        line = clean_table_line(raw_line)
+        stripped = line.strip()
+        if len(stripped) >= 3 and set(stripped) == {"-"}:
+            starts = column_starts(previous) if previous.strip() else None
+            if starts and len(starts) < 3:
+                starts = None
+        elif not stripped:
+            starts = None
+        elif starts:
+            fields = split_columns(line, starts)
+            if fields and fields[0] and fields[1]:
+                yield fields
+        previous = line
+
+def stream_process_lines(argv, timeout=None):
+    """Uruchamia proces i zwraca linie jego stdout na bieżąco; proces jest zabijany po przekroczeniu czasu.
+    Po przeczytaniu całego wyjścia rzuca TimeoutExpired (zabity) albo CalledProcessError (niezerowy kod wyjścia)."""
+    deadline = getattr(shell_local, "deadline", None)
+    if timeout is None:
+        timeout = max(1, deadline - time.monotonic()) if deadline is not None else POWERSHELL_TIMEOUT_SECONDS
+    process = subprocess.Popen(
+        argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        text=True, encoding='utf-8', errors='replace', creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+    )
+    timed_out = threading.Event()
+
+    def kill_on_timeout():
+        timed_out.set()
+        process.kill()
+
+    watchdog = threading.Timer(timeout, kill_on_timeout)
+    watchdog.start()
+    try:
+        yield from process.stdout
+    finally:
+        watchdog.cancel()
+        process.stdout.close()
+        process.wait()
+    # Zabity lub zakończony błędem proces mógł wypisać tylko część tabeli - nie wolno jej uznać za pełny wynik.
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(argv, timeout)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, argv)
+
+def read_winget_table(args):
+    started, ok = time.monotonic(), False
+    try:
+        lines = stream_process_lines([get_winget_path()] + args + ["--accept-source-agreements", "--disable-interactivity"])
+        for fields in iter_winget_table(lines):
+            yield (fields + [""] * 5)[:5]
+        ok = True
+    except (OSError, subprocess.SubprocessError) as e:
+        raise CollectorError(f"winget {' '.join(args)} nie powiódł się: {e}") from e
+    finally:
+        record_command_timing(f"winget {args[0]}", time.monotonic() - started, ok)
 
 def get_installed_apps():
-    if not WINGET_PATH or not os.path.exists(WINGET_PATH):
-        logging.error("Ścieżka do winget.exe jest nieprawidłowa lub plik nie istnieje: %s", WINGET_PATH)
-        return []
-    logging.info(f"Pobieranie i filtrowanie listy zainstalowanych aplikacji z: {WINGET_PATH}")
-    command_to_run = f'& "{WINGET_PATH}" list --accept-source-agreements'
-    output = run_command(command_to_run)
-    if not output: return []
-    apps, lines = [], output.strip().splitlines()
-    header_line = ""
-    for line in lines:
-        if "Name" in line and "Id" in line and "Version" in line:
-            header_line = line
-            break
-    if not header_line:
-        logging.warning("Nie znaleziono linii nagłówka w wyniku polecenia winget list.")
-        return []
-    pos_id = header_line.find("Id")
-    pos_version = header_line.find("Version")
-    pos_available = header_line.find("Available")
-    pos_source = header_line.find("Source")
-    if pos_available == -1: pos_available = pos_source if pos_source != -1 else len(header_line) + 20
-    for line in lines:
-        if line.strip().startswith("---") or not line.strip() or line == header_line or len(line) < pos_version: continue
-        try:
-            name, id_ = line[:pos_id].strip(), line[pos_id:pos_version].strip()
-            version, source = line[pos_version:pos_available].strip(), line[pos_available:].strip() if pos_source != -1 else ""
-            if not name or name.lower() == 'name': continue
-            name_lower = name.lower()
-            BLACKLIST_KEYWORDS = ['redistributable', 'visual c++', '.net framework']
-            if any(k in name_lower for k in BLACKLIST_KEYWORDS): continue
-            apps.append({"name": name, "id": id_, "version": version})
-        except Exception as e:
-            logging.warning("Nie udało się sparsować linii aplikacji: %s | Błąd: %s", line, e)
+    winget_path = get_winget_path()
+    if not winget_path:
+        raise CollectorError("nie znaleziono winget.exe")
+    logging.info(f"Pobieranie i filtrowanie listy zainstalowanych aplikacji z: {winget_path}")
+    apps, truncated = [], 0
+    BLACKLIST_KEYWORDS = ['redistributable', 'visual c++', '.net framework']
+    for name, id_, version, *_ in read_winget_table(["list"]):
+        if any(k in name.lower() for k in BLACKLIST_KEYWORDS): continue
+        truncated += id_.endswith(TRUNCATION_MARK)
+        apps.append({"name": name, "id": id_, "version": version})
+    if truncated:
+        logging.warning("winget skrócił identyfikator %d aplikacji (znak '%s') - serwer nie zleci dla nich zadań.",
+                        truncated, TRUNCATION_MARK)
     logging.info("Znaleziono %d przefiltrowanych aplikacji.", len(apps))
     return apps
 
 def get_available_updates():
-    if not WINGET_PATH or not os.path.exists(WINGET_PATH): return []
-    logging.info("Sprawdzanie dostępnych aktualizacji aplikacji...")
-    command_to_run = f'& "{WINGET_PATH}" upgrade --accept-source-agreements'
-    output = run_command(command_to_run)
-    if not output: return []
-    updates, lines = [], output.strip().splitlines()
-    header_line = ""
-    for line in lines:
-        if "Name" in line and "Id" in line and "Version" in line:
-            header_line = line
-            break
-    if not header_line:
-        logging.warning("Nie znaleziono linii nagłówka w wyniku polecenia winget upgrade.")
+    if not get_winget_path():
+        raise CollectorError("nie znaleziono winget.exe")
+    if server_computes_updates():
+        logging.info("Pominięto winget upgrade - dostępne aktualizacje wylicza serwer z katalogu pakietów.")
         return []
-    pos_id = header_line.find("Id")
-    pos_version = header_line.find("Version")
-    pos_available = header_line.find("Available")
-    pos_source = header_line.find("Source")
-    for line in lines:
-        if line.strip().startswith("---") or "upgrades available" in line.lower() or line == header_line or len(line) < pos_available: continue
-        try:
-            name, id_ = line[:pos_id].strip(), line[pos_id:pos_version].strip()
-            current_version, available_version = line[pos_version:pos_available].strip(), line[pos_available:pos_source].strip()
-            if name and name != 'Name':
-                updates.append({"name": name, "id": id_, "current_version": current_version, "available_version": available_version})
-        except Exception as e:
-            logging.warning("Nie udało się inteligentnie sparsować linii aktualizacji: %s | Błąd: %s", line, e)
-    return updates
+    logging.info("Sprawdzanie dostępnych aktualizacji aplikacji...")
+    return [{"name": name, "id": id_, "current_version": current_version, "available_version": available_version}
+            for name, id_, current_version, available_version, _ in read_winget_table(["upgrade"])]
 
 def get_windows_updates():
     logging.info("Sprawdzanie aktualizacji systemu Windows...")
-    command = '''try { (New-Object -ComObject Microsoft.Update.Session).CreateUpdateSearcher().Search("IsInstalled=0 and Type='Software' and IsHidden=0 and RebootRequired=0").Updates | ForEach-Object { [PSCustomObject]@{ Title = $_.Title; KB = $_.KBArticleIDs } } | ConvertTo-Json -Depth 3 } catch { return '[]' }'''
-    output = run_command(command)
-    if output:
+    # Bez try/catch: błąd wyszukiwania daje niezerowy kod wyjścia, a nie pustą listę.
+    command = '''(New-Object -ComObject Microsoft.Update.Session).CreateUpdateSearcher().Search("IsInstalled=0 and Type='Software' and IsHidden=0 and RebootRequired=0").Updates | ForEach-Object { [PSCustomObject]@{ Title = $_.Title; KB = $_.KBArticleIDs } } | ConvertTo-Json -Depth 3'''
+    output = run_collector_command(command, "windows_update_search")
+    if not output.strip():
+        return []  # ConvertTo-Json nic nie wypisuje dla pustej listy
+    try:
+        updates = json.loads(output)
+    except json.JSONDecodeError as e:
+        raise CollectorError(f"błąd dekodowania JSON z Windows Updates: {e}") from e
+    return updates if isinstance(updates, list) else [updates]
+
+# --- Kolektory ---
+# (klucz w raporcie, funkcja, limit czasu [s], co ile sekund odświeżać wynik)
+# Drogie i wolno zmieniające się kolektory (winget upgrade, Windows Update) korzystają z wyniku z pamięci
+# podręcznej, dopóki nie minie ich interwał albo coś go nie unieważni (zadanie, force_report).
+COLLECTORS = [
+    ("reboot_required", get_reboot_status, 120, 0),
+    ("installed_apps", get_installed_apps, 600, int(os.environ.get("AGENT_APPS_REFRESH", "3600"))),
+    ("available_app_updates", get_available_updates, 900, int(os.environ.get("AGENT_UPDATES_REFRESH", "14400"))),
+    ("pending_os_updates", get_windows_updates, 1800, int(os.environ.get("AGENT_OS_UPDATES_REFRESH", "43200"))),
+]
+# Kolektory, których wynik zmienia się po zadaniu update_package / uninstall_package.
+PACKAGE_TASK_COLLECTORS = ("reboot_required", "installed_apps", "available_app_updates")
+COLLECTOR_CACHE_FILE = os.path.join(application_path, 'collector_cache.json')
+collector_pool = ThreadPoolExecutor(max_workers=COLLECTOR_WORKERS, thread_name_prefix="collector")
+collector_cache = None
+collector_cache_lock = threading.Lock()
+
+def get_collector_cache():
+    global collector_cache
+    if collector_cache is None:
         try:
-            return json.loads(output)
-        except json.JSONDecodeError:
-            logging.error("Błąd dekodowania JSON z Windows Updates.")
-            return []
-    return []
+            with open(COLLECTOR_CACHE_FILE, "r", encoding="utf-8") as f:
+                collector_cache = json.load(f)
+        except (OSError, ValueError):
+            collector_cache = {}
+    return collector_cache
+
+def save_collector_cache():
+    try:
+        tmp_path = COLLECTOR_CACHE_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(get_collector_cache(), f, ensure_ascii=False)
+        os.replace(tmp_path, COLLECTOR_CACHE_FILE)
+    except OSError as e:
+        logging.error("Nie udało się zapisać pamięci podręcznej kolektorów: %s", e)
 
-def collect_and_report():
+def invalidate_collectors(keys=None):
+    """Oznacza wyniki kolektorów jako nieaktualne - zostaną zebrane ponownie przy najbliższym raporcie."""
+    with collector_cache_lock:
+        for key, entry in get_collector_cache().items():
+            if keys is None or key in keys:
+                entry["invalidated"] = True
+        save_collector_cache()
+
+def run_collector(func, timeout):
+    shell_local.deadline = time.monotonic() + timeout
+    started = time.monotonic()
+    try:
+        return func(), time.monotonic() - started
+    finally:
+        shell_local.deadline = None
+
+def run_collectors(force=False):
+    """Uruchamia równolegle kolektory, których wynik w pamięci podręcznej jest nieaktualny (wszystkie przy force).
+    Zwraca (wyniki, statystyki); po przekroczeniu czasu lub błędzie kolektora używany jest jego ostatni
+    poprawny wynik, a gdy go nie ma - klucz jest pomijany w wynikach (pusta lista oznaczałaby brak aplikacji
+    lub aktualizacji, więc serwer usunąłby prawdziwe dane)."""
+    started, now = time.monotonic(), time.time()
+    with collector_cache_lock:
+        cache = {key: dict(entry) for key, entry in get_collector_cache().items()}
+    results, stats, futures = {}, {}, []
+    for key, func, timeout, refresh_interval in COLLECTORS:
+        entry = cache.get(key)
+        if not force and entry and not entry.get("invalidated") and now - entry["collected_at"] < refresh_interval:
+            results[key] = entry["value"]
+            stats[key] = {"status": "cached", "duration": 0, "age": round(now - entry["collected_at"])}
+        else:
+            futures.append((key, collector_pool.submit(run_collector, func, timeout), timeout))
+    for key, future, timeout in futures:
+        try:
+            results[key], duration = future.result(timeout=max(0, started + timeout - time.monotonic()))
+            with collector_cache_lock:
+                get_collector_cache()[key] = {"value": results[key], "collected_at": time.time()}
+            stats[key] = {"status": "ok", "duration": round(duration, 3)}
+        except FutureTimeoutError:
+            logging.error("Kolektor %s przekroczył limit czasu %ds - %s.", key, timeout,
+                          "użyto ostatniego znanego wyniku" if key in cache else "sekcja pominięta w raporcie")
+            stats[key] = {"status": "timeout", "duration": round(time.monotonic() - started, 3)}
+        except CollectorError as e:
+            logging.error("Kolektor %s nie zebrał danych: %s", key, e)
+            stats[key] = {"status": "error", "duration": round(time.monotonic() - started, 3)}
+        except Exception as e:
+            logging.error("Kolektor %s zakończył się błędem: %s", key, e, exc_info=True)
+            stats[key] = {"status": "error", "duration": round(time.monotonic() - started, 3)}
+        if key not in results:
+            if key in cache:
+                results[key] = cache[key]["value"]
+            else:
+                stats[key]["missing"] = True
+    if futures:
+        with collector_cache_lock:
+            save_collector_cache()
+    logging.info("Kolektory zakończone w %.1fs: %s", time.monotonic() - started,
+                 ", ".join(f"{k}={v['status']}/{v['duration']}s" for k, v in stats.items()))
+    return results, stats
+
+def collect_and_report(force=False):
     logging.info("Rozpoczynanie cyklu pełnego raportowania.")
     system_info = get_system_info()
+    collected, collector_stats = run_collectors(force=force)
     payload = {
         "hostname": system_info["hostname"], "ip_address": system_info["ip_address"],
-        "reboot_required": get_reboot_status(), "installed_apps": get_installed_apps(),
-        "available_app_updates": get_available_updates(), "pending_os_updates": get_windows_updates()
+        **collected, "collector_stats": collector_stats, "command_stats": take_command_stats()
     }
-    logging.info("[DEBUG] AGENT wysyła payload: installed_apps=%d, available_app_updates=%d, pending_os_updates=%d",
-                 len(payload.get("installed_apps", [])),
-                 len(payload.get("available_app_updates", [])),
-                 len(payload.get("pending_os_updates", [])) if isinstance(payload.get("pending_os_updates", []),
-                                                                          list) else 1
-                 )
-    # (opcjonalnie, dla pełnej treści, np. pierwsze 3 aplikacje)
-    logging.info("[DEBUG] Przykład installed_apps: %s",
-                 json.dumps(payload.get("installed_apps", [])[:3], ensure_ascii=False))
-    logging.info("[DEBUG] Przykład available_app_updates: %s",
-                 json.dumps(payload.get("available_app_updates", [])[:3], ensure_ascii=False))
-    logging.info("[DEBUG] Przykład pending_os_updates: %s",
-                 json.dumps(payload.get("pending_os_updates", []), ensure_ascii=False)[:500])
-    headers = {"Content-Type": "application/json", "X-API-Key": API_KEY}
+    # Próbki treści tylko przy AGENT_LOG_LEVEL=DEBUG - bez tego nie płacimy za ich serializację.
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("AGENT wysyła payload: installed_apps=%d, available_app_updates=%d, pending_os_updates=%d",
+                      len(payload.get("installed_apps", [])),
+                      len(payload.get("available_app_updates", [])),
+                      len(payload.get("pending_os_updates", [])) if isinstance(payload.get("pending_os_updates", []),
+                                                                               list) else 1
+                      )
+        logging.debug("Przykład installed_apps: %s",
+                      json.dumps(payload.get("installed_apps", [])[:3], ensure_ascii=False))
+        logging.debug("Przykład available_app_updates: %s",
+                      json.dumps(payload.get("available_app_updates", [])[:3], ensure_ascii=False))
+        logging.debug("Przykład pending_os_updates: %s",
+                      json.dumps(payload.get("pending_os_updates", []), ensure_ascii=False)[:500])
     results = []
+    state = normalize_report_state(payload)
+    state_hash = compute_state_hash(state)
+    # Sekcje stanu pominięte w raporcie - serwer zostawia dla nich dane z poprzedniego raportu.
+    missing = [section for section in STATE_FIELDS if section not in payload]
+    # Pełny raport serializowany i kompresowany raz dla wszystkich serwerów.
+    full_body = encode_body(json.dumps(dict(payload, protocol_version=REPORT_PROTOCOL_VERSION, state_hash=state_hash)))
+    report_state = load_report_state()
+    state_lock = threading.Lock()
 
     def send_to_endpoint(endpoint):
+        acked = report_state.get(endpoint)
+        sent_state, sent_hash, sent_full = state, state_hash, full_body
+        if missing and acked:
+            # Sekcję, której kolektor nie zebrał, bierzemy ze stanu potwierdzonego przez ten serwer - raport jej
+            # nie zmienia, a skróty stanu po obu stronach pozostają zgodne.
+            sent_state = dict(state, **{section: acked["state"].get(section, []) for section in missing})
+            sent_hash = compute_state_hash(sent_state)
+            sent_full = encode_body(json.dumps(dict(payload, **sent_state, protocol_version=REPORT_PROTOCOL_VERSION,
+                                                    state_hash=sent_hash)))
         try:
-            logging.info("Wysyłanie pełnego raportu do %s dla %s", endpoint, system_info['hostname'])
-            r = requests.post(endpoint, data=json.dumps(payload), headers=headers, timeout=60)
+            body = sent_full
+            delta = build_state_delta(acked["state"], sent_state) if acked else None
+            if delta is not None:
+                body = encode_body(json.dumps({
+                    "hostname": payload["hostname"], "ip_address": payload["ip_address"],
+                    "reboot_required": payload.get("reboot_required"), "collector_stats": payload["collector_stats"],
+                    "command_stats": payload["command_stats"],
+                    "protocol_version": REPORT_PROTOCOL_VERSION, "mode": "delta", "base_hash": acked["state_hash"], "state_hash": sent_hash, "delta": delta
+                }))
+                logging.info("Wysyłanie raportu różnicowego do %s dla %s (%d B zamiast %d B)",
+                             endpoint, system_info['hostname'], len(body[0]), len(sent_full[0]))
+            else:
+                logging.info("Wysyłanie pełnego raportu do %s dla %s", endpoint, system_info['hostname'])
+            base_url = endpoint.replace('/report', '')
+            r = post_body(base_url, endpoint, body)
+            if r.status_code == 409 and body is not sent_full:
+                logging.info("Serwer %s zażądał pełnej synchronizacji - wysyłanie pełnego raportu.", endpoint)
+                r = post_body(base_url, endpoint, sent_full)
             r.raise_for_status()
-            logging.info("Pełny raport wysłany pomyślnie do %s.", endpoint)
+            apply_report_schedule(r)
+            apply_update_source(r)
+            try:
+                server_hash = r.json().get("state_hash")
+            except ValueError:
+                server_hash = None  # starszy serwer bez obsługi protokołu delta
+            with state_lock:
+                if server_hash == sent_hash:
+                    report_state[endpoint] = {"state_hash": sent_hash, "state": sent_state}
+                else:
+                    report_state.pop(endpoint, None)
+            remove_spool_file(f"report-{spool_key(endpoint)}.json")  # zaległy raport jest już nieaktualny
+            note_delivery(base_url, True)
+            logging.info("Raport wysłany pomyślnie do %s.", endpoint)
             results.append((endpoint, True))
         except Exception as e:
-            logging.error("Nie udało się wysłać pełnego raportu do %s. Błąd: %s", endpoint, e)
+            logging.error("Nie udało się wysłać raportu do %s. Błąd: %s", endpoint, e)
+            # Zebrane dane nie przepadają - pełny raport czeka w kolejce offline na powrót serwera.
+            spool_report(endpoint, sent_full[0].decode("utf-8"), sent_hash, sent_state)
+            note_delivery(endpoint.replace('/report', ''), False)
             results.append((endpoint, False))
 
     threads = []
@@ -226,70 +948,346 @@ def collect_and_report():
             threads.append(t)
     for t in threads:
         t.join()
+    save_report_state(report_state)
     return results
 
-def process_tasks(hostname):
-    if not WINGET_PATH or not os.path.exists(WINGET_PATH): return
-    logging.info("Sprawdzanie dostępnych zadań...")
-    headers = {"Content-Type": "application/json", "X-API-Key": API_KEY}
-    tasks_list = []
-    for endpoint in API_ENDPOINTS:
-        base_url = endpoint.strip().replace('/report', '')
+# --- Kolejka offline (spool) ---
+# Gdy serwer jest nieosiągalny, raport i wyniki zadań trafiają na dysk zamiast przepadać. Z raportów zostaje
+# tylko najnowszy pełny raport na serwer (kolejny cykl go zastępuje), wyniki zadań czekają w kolejności
+# zgłoszenia. flush_spool() ponawia wysyłkę z wykładniczym odstępem liczonym osobno dla każdego serwera.
+SPOOL_DIR = os.path.join(application_path, 'spool')
+spool_lock = threading.Lock()
+spool_flush_lock = threading.Lock()
+spool_backoff = {}  # serwer -> (porażki z rzędu, time.monotonic() następnej próby)
+
+def spool_key(url):
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+
+def write_spool_file(name, data):
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    path = os.path.join(SPOOL_DIR, name)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def read_spool_file(name):
+    try:
+        with open(os.path.join(SPOOL_DIR, name), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error("Uszkodzony plik kolejki offline %s - usuwanie: %s", name, e)
+        remove_spool_file(name)
+        return None
+
+def remove_spool_file(name):
+    try:
+        os.remove(os.path.join(SPOOL_DIR, name))
+    except OSError:
+        pass
+
+def list_spool(prefix=""):
+    try:
+        return sorted(n for n in os.listdir(SPOOL_DIR) if n.startswith(prefix) and n.endswith(".json"))
+    except FileNotFoundError:
+        return []
+
+def spool_report(endpoint, body, state_hash, state):
+    """Zapamiętuje pełny raport dla serwera; poprzedni niewysłany raport tego serwera jest zastępowany."""
+    try:
+        write_spool_file(f"report-{spool_key(endpoint)}.json",
+                         {"endpoint": endpoint, "body": body, "state_hash": state_hash, "state": state})
+        logging.warning("Raport dla %s zapisany w kolejce offline.", endpoint)
+    except OSError as e:
+        logging.error("Nie udało się zapisać raportu w kolejce offline: %s", e)
+
+def spool_task_result(base_url, payload):
+    prefix = f"result-{spool_key(base_url)}-"
+    with spool_lock:
         try:
-            response = requests.get(base_url + "/tasks/" + hostname, headers=headers, timeout=15)
+            pending = list_spool(prefix)
+            for name in pending[:max(0, len(pending) - SPOOL_MAX_RESULTS + 1)]:
+                logging.warning("Kolejka offline wyników dla %s pełna - usuwanie najstarszego (%s).", base_url, name)
+                remove_spool_file(name)
+            write_spool_file(f"{prefix}{time.time_ns():020d}.json", {"base_url": base_url, "payload": payload})
+            logging.warning("Wynik zadania %s dla %s zapisany w kolejce offline.", payload.get("task_id"), base_url)
+        except OSError as e:
+            logging.error("Nie udało się zapisać wyniku zadania w kolejce offline: %s", e)
+
+def has_spooled_results(base_url):
+    return bool(list_spool(f"result-{spool_key(base_url)}-"))
+
+def note_delivery(base_url, delivered):
+    with spool_lock:
+        if delivered:
+            spool_backoff.pop(base_url, None)
+            return
+        failures = spool_backoff.get(base_url, (0, 0))[0] + 1
+        delay = min(SPOOL_RETRY_MAX_SECONDS, SPOOL_RETRY_BASE_SECONDS * 2 ** (failures - 1))
+        spool_backoff[base_url] = (failures, time.monotonic() + delay)
+
+def spool_ready(base_url):
+    with spool_lock:
+        return spool_backoff.get(base_url, (0, 0))[1] <= time.monotonic()
+
+def deliver_spooled(base_url, url, body):
+    """Wysyła treść z kolejki. Zwraca True (dostarczono), False (ponowić później) albo None (serwer odrzucił - usunąć)."""
+    import requests
+    try:
+        r = post_encoded(base_url, url, encode_body(body), timeout=60)
+    except requests.RequestException as e:
+        logging.warning("Serwer %s nadal nieosiągalny: %s", base_url, e)
+        note_delivery(base_url, False)
+        return False
+    if r.status_code == 429 or r.status_code >= 500:
+        note_delivery(base_url, False)
+        return False
+    note_delivery(base_url, True)
+    if r.status_code >= 400:
+        logging.error("Serwer %s odrzucił treść z kolejki offline (%d) - usuwanie.", base_url, r.status_code)
+        return None
+    return r
+
+def flush_spool():
+    """Wysyła zaległe wyniki zadań (po kolei) i raporty serwerom, dla których minął czas do ponowienia."""
+    if not spool_flush_lock.acquire(blocking=False):
+        return
+    try:
+        blocked = set()
+        for name in list_spool("result-"):
+            entry = read_spool_file(name)
+            if entry is None or entry["base_url"] in blocked:
+                continue
+            base_url = entry["base_url"]
+            if not spool_ready(base_url):
+                blocked.add(base_url)
+                continue
+            r = deliver_spooled(base_url, base_url + "/tasks/result", json.dumps(entry["payload"]))
+            if r is False:
+                blocked.add(base_url)  # kolejne wyniki tego serwera czekają, żeby zachować kolejność
+                continue
+            remove_spool_file(name)
+            if r is not None:
+                logging.info("Dostarczono zaległy wynik zadania %s do %s.", entry["payload"].get("task_id"), base_url)
+        for name in list_spool("report-"):
+            entry = read_spool_file(name)
+            if entry is None:
+                continue
+            base_url = entry["endpoint"].replace('/report', '')
+            if base_url in blocked or not spool_ready(base_url):
+                continue
+            # Cykl raportowania w toku wyśle świeższy raport - zaległego nie wysyłamy równolegle.
+            if not report_lock.acquire(blocking=False):
+                continue
+            try:
+                r = deliver_spooled(base_url, entry["endpoint"], entry["body"])
+                if r is False:
+                    continue
+                remove_spool_file(name)
+                if r is None:
+                    continue
+                report_state = load_report_state()
+                try:
+                    server_hash = r.json().get("state_hash")
+                except ValueError:
+                    server_hash = None
+                if server_hash == entry["state_hash"]:
+                    report_state[entry["endpoint"]] = {"state_hash": entry["state_hash"], "state": entry["state"]}
+                else:
+                    report_state.pop(entry["endpoint"], None)
+                save_report_state(report_state)
+                apply_report_schedule(r)
+                apply_update_source(r)
+                logging.info("Dostarczono zaległy raport do %s.", entry["endpoint"])
+            finally:
+                report_lock.release()
+    finally:
+        spool_flush_lock.release()
+
+report_thread = None
+report_lock = threading.Lock()  # jeden cykl raportowania naraz (harmonogram, zadanie force_report)
+
+def run_report_cycle(force=False):
+    with report_lock:
+        return collect_and_report(force=force)
+
+def start_background_report():
+    """Uruchamia cykl raportowania w tle, żeby pętla zadań nie czekała na kolektory."""
+    global report_thread
+    if report_thread and report_thread.is_alive():
+        logging.warning("Poprzedni cykl raportowania wciąż trwa - pomijanie.")
+        return
+    report_thread = threading.Thread(target=run_report_cycle, name="report", daemon=True)
+    report_thread.start()
+
+long_poll_unsupported = set()  # serwery bez endpointu /tasks/<hostname>/wait
+
+def fetch_tasks(base_url, hostname, wait):
+    """Pobiera zadania z serwera. Zwraca (zadania, czy_czekano_long_poll)."""
+    session = get_http_session(base_url)
+    if wait and LONG_POLL_SECONDS > 0 and base_url not in long_poll_unsupported:
+        response = session.get(f"{base_url}/tasks/{hostname}/wait", params={"timeout": LONG_POLL_SECONDS},
+                               timeout=LONG_POLL_SECONDS + 15)
+        if response.status_code != 404:
             response.raise_for_status()
-            tasks = response.json()
+            apply_report_schedule(response)
+            apply_update_source(response)
+            # Tylko X-Long-Poll: 1 oznacza, że serwer trzymał żądanie; bez niego (nieznany host, brak wolnych
+            # miejsc na long-poll, starszy serwer) odpowiedź przyszła od razu i pętla musi odczekać zwykłą przerwę.
+            return response.json(), response.headers.get("X-Long-Poll") == "1"
+        logging.info("Serwer %s nie obsługuje long-poll - powrót do zwykłego odpytywania.", base_url)
+        long_poll_unsupported.add(base_url)
+    response = session.get(base_url + "/tasks/" + hostname, timeout=15)
+    response.raise_for_status()
+    apply_report_schedule(response)
+    apply_update_source(response)
+    return response.json(), False
+
+def process_tasks(hostname, wait=False):
+    """Pobiera i wykonuje zadania. Przy wait=True czeka na zadania metodą long-poll; zwraca True,
+    jeśli faktycznie czekano (pętla główna nie musi wtedy dodatkowo usypiać)."""
+    if not get_winget_path(): return False
+    logging.info("Sprawdzanie dostępnych zadań...")
+    tasks_list, waited = [], []
+
+    def fetch_from(base_url):
+        try:
+            tasks, long_polled = fetch_tasks(base_url, hostname, wait)
+            waited.append(long_polled)
             if tasks:
                 logging.info(f"Zadania z {base_url}: {tasks}")
                 tasks_list.extend([(base_url, t) for t in tasks])
         except Exception as e:
             logging.error("Nie udało się pobrać zadań z %s: %s", base_url, e)
 
+    threads = [threading.Thread(target=fetch_from, args=(endpoint.strip().replace('/report', ''),))
+               for endpoint in API_ENDPOINTS if endpoint.strip()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
     for base_url, task in tasks_list:
-        logging.info("Odebrano zadanie ID %s: %s z payloadem %s", task['id'], task['command'], task['payload'])
-        task_result_payload, status_final = {"task_id": task['id']}, 'błąd'
-        if task['command'] == 'update_package':
-            package_id = task['payload']
-            update_command = f'& "{WINGET_PATH}" upgrade --id "{package_id}" --accept-package-agreements --accept-source-agreements --disable-interactivity'
-            if run_command(update_command) is not None:
-                status_final = 'zakończone'
-        elif task['command'] == 'uninstall_package':
-            package_id = task['payload']
-            uninstall_command = f'& "{WINGET_PATH}" uninstall --id "{package_id}" --accept-source-agreements --disable-interactivity --silent'
-            if run_command(uninstall_command) is not None:
-                status_final = 'zakończone'
-        elif task['command'] == 'force_report':
-            collect_and_report()
-            status_final = 'zakończone'
-        task_result_payload['status'] = status_final
+        submit_task(base_url, task)
+    # Bez przerwy tylko wtedy, gdy czekał każdy serwer - inaczej ten, który odpowiada od razu, byłby odpytywany bez końca.
+    return bool(waited) and all(waited)
+
+# Zadania wykonują wątki w tle, każdy z własną kolejką ("pasem"), więc pętla główna dalej odpytuje serwer
+# i wysyła raporty w trakcie długiej instalacji. Operacje winget mają jeden wspólny pas (wykonywane po kolei),
+# a force_report osobny - odświeżenie raportu nie czeka na instalacje.
+TASK_LANES = {"update_package": "winget", "uninstall_package": "winget", "force_report": "report"}
+task_queues = {}
+queued_tasks = set()  # (serwer, id zadania) przyjęte do wykonania i jeszcze niezakończone
+task_queues_lock = threading.Lock()
+
+def submit_task(base_url, task):
+    key, lane = (base_url, task['id']), TASK_LANES.get(task['command'], "winget")
+    with task_queues_lock:
+        if key in queued_tasks:
+            return False
+        queued_tasks.add(key)
+        task_queue = task_queues.get(lane)
+        if task_queue is None:
+            task_queue = task_queues[lane] = queue.Queue()
+            threading.Thread(target=task_worker, args=(task_queue,), name=f"tasks-{lane}", daemon=True).start()
+    task_queue.put((base_url, task, time.monotonic()))
+    logging.info("Odebrano zadanie ID %s: %s z payloadem %s (kolejka '%s', oczekujących: %d)",
+                 task['id'], task['command'], task['payload'], lane, task_queue.qsize())
+    return True
+
+def task_worker(task_queue):
+    while True:
+        base_url, task, queued_at = task_queue.get()
         try:
-            requests.post(base_url + "/tasks/result", headers=headers, data=json.dumps(task_result_payload))
-            logging.info("Zakończono przetwarzanie zadania %s ze statusem: %s", task['id'], status_final)
-        except Exception as e:
-            logging.error(f"Nie udało się wysłać wyniku zadania do {base_url}: {e}")
+            execute_task(base_url, task, queued_at)
+        except Exception:
+            logging.exception("Nieoczekiwany błąd zadania %s", task['id'])
+        finally:
+            with task_queues_lock:
+                queued_tasks.discard((base_url, task['id']))
+            task_queue.task_done()
+
+def wait_for_tasks():
+    """Czeka, aż wszystkie przyjęte zadania zostaną wykonane (tryb jednorazowy)."""
+    with task_queues_lock:
+        queues = list(task_queues.values())
+    for task_queue in queues:
+        task_queue.join()
+
+def execute_task(base_url, task, queued_at):
+    started = time.monotonic()
+    status_final = 'błąd'
+    winget_path = get_winget_path()
+    if task['command'] in ('update_package', 'uninstall_package') and (task['payload'] or "").endswith(TRUNCATION_MARK):
+        # Skrócony identyfikator mógłby wskazać inny pakiet - nie przekazujemy go do winget.
+        logging.error("Odrzucono zadanie %s: identyfikator pakietu '%s' jest skrócony.", task['id'], task['payload'])
+    elif task['command'] == 'update_package':
+        package_id = task['payload']
+        update_command = f'& "{winget_path}" upgrade --id "{package_id}" --accept-package-agreements --accept-source-agreements --disable-interactivity'
+        if run_command(update_command, label="winget upgrade") is not None:
+            status_final = 'zakończone'
+    elif task['command'] == 'uninstall_package':
+        package_id = task['payload']
+        uninstall_command = f'& "{winget_path}" uninstall --id "{package_id}" --accept-source-agreements --disable-interactivity --silent'
+        if run_command(uninstall_command, label="winget uninstall") is not None:
+            status_final = 'zakończone'
+    elif task['command'] == 'force_report':
+        run_report_cycle(force=True)
+        status_final = 'zakończone'
+    if task['command'] in ('update_package', 'uninstall_package'):
+        invalidate_collectors(PACKAGE_TASK_COLLECTORS)
+    task_result_payload = {"task_id": task['id'], "status": status_final,
+                           "duration": round(time.monotonic() - started, 1), "queue_wait": round(started - queued_at, 1)}
+    logging.info("Zakończono przetwarzanie zadania %s ze statusem: %s (%.1fs, w kolejce %.1fs)", task['id'],
+                 status_final, task_result_payload['duration'], task_result_payload['queue_wait'])
+    if has_spooled_results(base_url):
+        # Starsze wyniki czekają w kolejce offline - ten dołącza za nimi, żeby serwer dostał je po kolei.
+        spool_task_result(base_url, task_result_payload)
+        flush_spool()
+        return
+    try:
+        r = post_body(base_url, base_url + "/tasks/result", encode_body(json.dumps(task_result_payload)))
+        if r.status_code == 429 or r.status_code >= 500:
+            r.raise_for_status()
+        note_delivery(base_url, True)
+    except Exception as e:
+        logging.error(f"Nie udało się wysłać wyniku zadania do {base_url}: {e}")
+        spool_task_result(base_url, task_result_payload)
+        note_delivery(base_url, False)
 
 if __name__ == '__main__':
     logging.info("Agent uruchomiony. Sprawdzanie ścieżki do winget...")
-    if not WINGET_PATH or not os.path.exists(WINGET_PATH):
-        logging.critical("Ścieżka WINGET_PATH jest nieprawidłowa lub nieustawiona. Agent nie będzie mógł zarządzać aplikacjami.")
+    if not get_winget_path():
+        logging.critical("Nie znaleziono winget.exe (WINGET_PATH_CONF, PATH, profile użytkowników). Agent nie będzie mógł zarządzać aplikacjami.")
 
     current_hostname = get_system_info()["hostname"]
+    # Import requests w tle, równolegle z kolektorami - pierwsza wysyłka nie czeka już na niego.
+    threading.Thread(target=__import__, args=("requests",), name="import-requests", daemon=True).start()
 
     if len(sys.argv) > 1 and sys.argv[1] == 'run_once':
         logging.info("Agent uruchomiony w trybie jednorazowym.")
-        collect_and_report()
+        flush_spool()
+        run_report_cycle()
         process_tasks(current_hostname)
+        wait_for_tasks()
         logging.info("Zakończono działanie w trybie jednorazowym.")
     else:
         logging.info("Agent uruchomiony w trybie pętli (usługi).")
-        collect_and_report()
-        report_counter = 0
+        # Pierwszy raport nie od razu: po masowym starcie komputerów flota rozkłada się w czasie. Zapytanie
+        # o zadania bez long-poll od razu przynosi slot raportu z serwera, który zastępuje to opóźnienie.
+        startup_delay = host_jitter(current_hostname, min(STARTUP_REPORT_SPREAD_SECONDS, report_schedule["interval"]))
+        schedule_next_report(startup_delay)
+        process_tasks(current_hostname)
+        waited = True  # po zapytaniu startowym od razu long-poll, bez przerwy LOOP_INTERVAL_SECONDS
         while True:
-            process_tasks(current_hostname)
-            report_counter += 1
-            if report_counter >= FULL_REPORT_INTERVAL_LOOPS:
-                collect_and_report()
+            flush_spool()
+            if report_due():
+                schedule_next_report()
+                start_background_report()
                 current_hostname = get_system_info()["hostname"]
-                report_counter = 0
-            logging.info("Cykl zakończony. Następne sprawdzenie za %ds. Pełny raport za %d cykli.", LOOP_INTERVAL_SECONDS, FULL_REPORT_INTERVAL_LOOPS - report_counter)
-            time.sleep(LOOP_INTERVAL_SECONDS)
+            pause = poll_pause(waited)
+            if pause > 0:
+                with report_schedule_lock:
+                    report_in = report_schedule["report_at"] - time.monotonic()
+                logging.info("Cykl zakończony. Następne sprawdzenie za %ds. Pełny raport za %ds.", pause, report_in)
+                time.sleep(pause)
+            waited = process_tasks(current_hostname, wait=True)
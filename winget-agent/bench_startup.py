@@ -0,0 +1,116 @@
+"""Benchmark startu agenta (tryb run_once) z zapisanym wynikiem wykrywania i bez niego.
+
+Działa na Linuksie bez winget: kopiuje agent.py do katalogu tymczasowego (katalog stanu agenta), a wykrywanie
+winget zastępuje atrapą - PATH z wieloma katalogami bez winget.exe i skrypt `where`, który po opóźnieniu
+(--where-delay, jak na Windows) wskazuje sztuczny winget.exe. Każdy pomiar to osobny proces Pythona, który
+robi to samo co agent przed pierwszym kolektorem: import agenta, ścieżka winget i informacje o systemie.
+
+Tryby: "zimny" (bez discovery_cache.json, jak pierwsze uruchomienie) i "ciepły" (z pamięcią podręczną).
+--baseline stary_agent.py mierzy dodatkowo inną wersję agenta, np. sprzed zmiany:
+    git show HEAD~1:winget-agent/agent.py > /tmp/agent_old.py
+
+Użycie: python bench_startup.py [--runs 10] [--path-dirs 40] [--where-delay 0.15] [--baseline stary_agent.py]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+AGENT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent.py")
+
+STARTUP_SNIPPET = """
+import json, sys, time
+started = time.perf_counter()
+import agent
+imported = time.perf_counter()
+winget_path = agent.get_winget_path() if hasattr(agent, "get_winget_path") else agent.WINGET_PATH
+agent.get_system_info()
+done = time.perf_counter()
+print(json.dumps({"import": imported - started, "discovery": done - imported, "total": done - started,
+                  "requests": "requests" in sys.modules, "winget_path": winget_path}))
+"""
+
+
+def build_stub_environment(root, path_dirs, where_delay):
+    """Tworzy atrapę środowiska Windows i zwraca (zmienne środowiskowe, ścieżka sztucznego winget.exe)."""
+    winget_dir = os.path.join(root, "WindowsApps")
+    os.makedirs(winget_dir)
+    winget_path = os.path.join(winget_dir, "winget.exe")
+    open(winget_path, "w").close()
+    path = []
+    for i in range(path_dirs):
+        directory = os.path.join(root, "path", f"dir{i:03d}")
+        os.makedirs(directory)
+        for j in range(20):
+            open(os.path.join(directory, f"tool{j}.exe"), "w").close()
+        path.append(directory)
+    stub_bin = os.path.join(root, "bin")
+    os.makedirs(stub_bin)
+    where = os.path.join(stub_bin, "where")
+    with open(where, "w") as f:
+        f.write(f"#!/bin/sh\nsleep {where_delay}\necho {winget_path}\n")
+    os.chmod(where, 0o755)
+    path += [stub_bin, os.environ.get("PATH", "")]
+    env = dict(os.environ, PATH=os.pathsep.join(path), WINGET_PATH_CONF="", AGENT_API_ENDPOINT="")
+    return env, winget_path
+
+
+def run_startup(state_dir, env):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", STARTUP_SNIPPET], cwd=state_dir, env=env,
+                            capture_output=True, text=True, check=True)
+    sample = json.loads(result.stdout.strip().splitlines()[-1])
+    sample["process"] = time.perf_counter() - started
+    return sample
+
+
+def measure(label, agent_file, root, env, runs, cold, expected_path):
+    state_dir = os.path.join(root, label)
+    os.makedirs(state_dir)
+    shutil.copy(agent_file, os.path.join(state_dir, "agent.py"))
+    run_startup(state_dir, env)  # rozgrzewka: pliki .pyc, pamięć podręczna wykrywania dla trybu ciepłego
+    samples = []
+    for _ in range(runs):
+        if cold:
+            for name in ("discovery_cache.json", "discovery_cache.json.tmp"):
+                if os.path.exists(os.path.join(state_dir, name)):
+                    os.remove(os.path.join(state_dir, name))
+        samples.append(run_startup(state_dir, env))
+    found = all(s["winget_path"] == expected_path for s in samples)
+    median = lambda key: statistics.median(s[key] for s in samples) * 1000
+    print(f"{label:<16} {median('import'):>10.1f} {median('discovery'):>12.1f} {median('total'):>10.1f} "
+          f"{median('process'):>10.1f} {'tak' if samples[-1]['requests'] else 'nie':>9} {'tak' if found else 'NIE':>7}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="liczba uruchomień w każdym trybie")
+    parser.add_argument("--path-dirs", type=int, default=40, help="liczba katalogów w PATH przed atrapą `where`")
+    parser.add_argument("--where-delay", type=float, default=0.15, help="opóźnienie atrapy `where winget` [s]")
+    parser.add_argument("--baseline", help="inna wersja agent.py do porównania")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="agent-startup-")
+    try:
+        env, winget_path = build_stub_environment(root, args.path_dirs, args.where_delay)
+        print(f"mediana z {args.runs} uruchomień [ms]")
+        print(f"{'tryb':<16} {'import':>10} {'wykrywanie':>12} {'razem':>10} {'proces':>10} {'requests':>9} {'winget':>7}")
+        ok = True
+        if args.baseline:
+            ok &= measure("baseline-zimny", args.baseline, root, env, args.runs, True, winget_path)
+            ok &= measure("baseline-ciepły", args.baseline, root, env, args.runs, False, winget_path)
+        ok &= measure("zimny", AGENT_FILE, root, env, args.runs, True, winget_path)
+        ok &= measure("ciepły", AGENT_FILE, root, env, args.runs, False, winget_path)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""Benchmark i kontrola poprawności parsera tabel winget (iter_winget_table) na nagranych wyjściach.
+
+Działa na Linuksie bez winget: czyta pliki z fixtures/winget/, porównuje wynik z plikami *.expected.json,
+mierzy przepustowość na korpusie i na syntetycznej tabeli z wieloma tysiącami wierszy, a na koniec
+przepuszcza dużą tabelę przez prawdziwy potok procesu (stream_process_lines), tak jak robi to agent.
+
+Użycie: python bench_winget_parser.py [--rows 5000] [--repeat 20]
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+
+import agent
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "winget")
+
+
+def legacy_parse(lines):
+    """Dawny parser (cięcie po indeksach znaków, nagłówek po angielsku) - tylko do porównania."""
+    header_line = next((l for l in lines if "Name" in l and "Id" in l and "Version" in l), "")
+    if not header_line:
+        return []
+    pos_id, pos_version = header_line.find("Id"), header_line.find("Version")
+    rows = []
+    for line in lines:
+        if line.strip().startswith("---") or not line.strip() or line == header_line or len(line) < pos_version:
+            continue
+        rows.append([line[:pos_id].strip(), line[pos_id:pos_version].strip()])
+    return rows
+
+
+def synthetic_table(rows):
+    names = ["Google Chrome", "秀丸エディタ", "Menedżer plików Żółć", "Visual Studio Build Tools 2022", "LINE"]
+    header = ["Name", "Id", "Version", "Available", "Source"]
+    data = [[f"{names[i % len(names)]} {i}", f"Vendor{i % 97}.Package{i}", f"{i % 40}.{i % 7}.{i}",
+             f"{i % 40}.{i % 7 + 1}.0" if i % 3 == 0 else "", "winget" if i % 5 else ""] for i in range(rows)]
+    widths = [max(agent_width(h), *(agent_width(r[c]) for r in data)) for c, h in enumerate(header)]
+    fmt = lambda cells: " ".join(v + " " * (widths[c] - agent_width(v)) for c, v in enumerate(cells)).rstrip()
+    return [fmt(header), "-" * (sum(widths) + len(widths) - 1)] + [fmt(r) for r in data], data
+
+
+def agent_width(text):
+    return sum(agent.char_width(ch) for ch in text)
+
+
+def timed(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - started) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000, help="liczba wierszy syntetycznej tabeli")
+    parser.add_argument("--repeat", type=int, default=20, help="liczba powtórzeń każdego pomiaru")
+    args = parser.parse_args()
+
+    failures = 0
+    print(f"{'plik':<22} {'wiersze':>7} {'poprawnie':>9} {'stary parser':>12} {'czas [ms]':>10}")
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.txt"))):
+        with open(path, "r", encoding="utf-8", newline=None) as f:
+            lines = f.read().splitlines()
+        with open(path[:-4] + ".expected.json", "r", encoding="utf-8") as f:
+            expected = json.load(f)
+        elapsed, rows = timed(lambda: list(agent.iter_winget_table(lines)), args.repeat)
+        legacy_ok = legacy_parse(lines) == [r[:2] for r in expected]
+        failures += rows != expected
+        print(f"{os.path.basename(path):<22} {len(rows):>7} {'tak' if rows == expected else 'NIE':>9} "
+              f"{'tak' if legacy_ok else 'nie':>12} {elapsed * 1000:>10.3f}")
+
+    lines, data = synthetic_table(args.rows)
+    elapsed, rows = timed(lambda: list(agent.iter_winget_table(lines)), args.repeat)
+    failures += rows != data
+    print(f"\nsyntetyczna tabela: {len(rows)} wierszy w {elapsed * 1000:.1f} ms "
+          f"({len(rows) / elapsed:,.0f} wierszy/s), poprawnie: {'tak' if rows == data else 'NIE'}")
+
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt", delete=False) as f:
+        f.write("\n".join(lines) + "\n")
+    try:
+        cat = [sys.executable, "-c", "import sys; sys.stdout.buffer.write(open(sys.argv[1], 'rb').read())", f.name]
+        started = time.perf_counter()
+        first_row_at, count = None, 0
+        for _ in agent.iter_winget_table(agent.stream_process_lines(cat, timeout=60)):
+            first_row_at = first_row_at or time.perf_counter() - started
+            count += 1
+        total = time.perf_counter() - started
+        print(f"potok procesu: {count} wierszy, pierwszy po {first_row_at * 1000:.1f} ms, całość {total * 1000:.1f} ms")
+    finally:
+        os.remove(f.name)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
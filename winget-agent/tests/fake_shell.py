@@ -0,0 +1,29 @@
+"""Zastępczy host powłoki dla PowerShellWorker - ten sam protokół co POWERSHELL_HOST_SCRIPT, bez Windows.
+
+Czyta z stdin polecenia zakodowane w base64 (UTF-8), wykonuje je przez /bin/sh (na Windows cmd.exe) i odpowiada
+linią "@@WA <kod wyjścia> <stdout w base64>". Jak prawdziwy host wypisuje też linie spoza protokołu na stdout
+i przekazuje stderr polecenia. Polecenie "exit [kod]" kończy sam host, tak jak `exit` w PowerShell.
+
+Użycie: PowerShellWorker(shell_command=[sys.executable, "tests/fake_shell.py"])
+"""
+import base64
+import subprocess
+import sys
+
+
+def main():
+    for line in sys.stdin:
+        command = base64.b64decode(line.strip()).decode("utf-8")
+        if command.split()[:1] == ["exit"]:
+            return int(command.split()[1]) if len(command.split()) > 1 else 0
+        print("Transcript: " + command, flush=True)  # szum, który agent ma pominąć
+        result = subprocess.run(command, shell=True, capture_output=True)
+        if result.stderr:
+            sys.stderr.write(result.stderr.decode("utf-8", errors="replace"))
+            sys.stderr.flush()
+        print("@@WA", result.returncode, base64.b64encode(result.stdout).decode("ascii"), flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""Kolektory raportu: nieudany kolektor nie może zwrócić pustej sekcji, bo serwer usunąłby prawdziwe dane."""
+import json
+
+import pytest
+
+import agent
+
+
+@pytest.fixture(autouse=True)
+def collector_cache(tmp_path, monkeypatch):
+    path = tmp_path / "collector_cache.json"
+    monkeypatch.setattr(agent, "COLLECTOR_CACHE_FILE", str(path))
+    monkeypatch.setattr(agent, "collector_cache", None)
+    return path
+
+
+def fake_commands(monkeypatch, outputs):
+    """Podmienia run_command: wynik według etykiety polecenia, None oznacza błąd polecenia."""
+    monkeypatch.setattr(agent, "run_command", lambda command, timeout=None, label="powershell": outputs[label])
+
+
+def test_failed_collectors_are_left_out_of_the_report(monkeypatch, collector_cache):
+    fake_commands(monkeypatch, {"reboot_status": "False\r\n", "windows_update_search": None})
+    monkeypatch.setattr(agent, "get_winget_path", lambda: None)
+    results, stats = agent.run_collectors(force=True)
+    assert results == {"reboot_required": False}
+    assert {key: (s["status"], s.get("missing", False)) for key, s in stats.items()} == {
+        "reboot_required": ("ok", False), "installed_apps": ("error", True),
+        "available_app_updates": ("error", True), "pending_os_updates": ("error", True)}
+    with open(collector_cache, encoding="utf-8") as f:
+        assert list(json.load(f)) == ["reboot_required"]
+
+
+def test_failed_collector_falls_back_to_last_good_result(monkeypatch):
+    update = {"Title": "2024-05 Cumulative Update (KB5037771)", "KB": ["5037771"]}
+    monkeypatch.setattr(agent, "get_winget_path", lambda: None)
+    fake_commands(monkeypatch, {"reboot_status": "True", "windows_update_search": json.dumps([update])})
+    agent.run_collectors(force=True)
+    fake_commands(monkeypatch, {"reboot_status": None, "windows_update_search": "not json"})
+    results, stats = agent.run_collectors(force=True)
+    assert results == {"reboot_required": True, "pending_os_updates": [update]}
+    assert stats["pending_os_updates"]["status"] == "error"
+    assert "missing" not in stats["pending_os_updates"]
+
+
+@pytest.mark.parametrize("output, expected", [
+    ("", []),
+    ('{"Title": "KB1", "KB": ["1"]}', [{"Title": "KB1", "KB": ["1"]}]),
+    ('[{"Title": "KB1", "KB": ["1"]}]', [{"Title": "KB1", "KB": ["1"]}]),
+])
+def test_windows_updates_output(monkeypatch, output, expected):
+    fake_commands(monkeypatch, {"windows_update_search": output})
+    assert agent.get_windows_updates() == expected
+
+
+@pytest.mark.parametrize("output", [None, "[{", "access denied"])
+def test_windows_update_search_errors_raise(monkeypatch, output):
+    fake_commands(monkeypatch, {"windows_update_search": output})
+    with pytest.raises(agent.CollectorError):
+        agent.get_windows_updates()
+
+
+@pytest.mark.parametrize("output", [None, "", "Exception calling RebootRequired"])
+def test_reboot_status_errors_raise(monkeypatch, output):
+    fake_commands(monkeypatch, {"reboot_status": output})
+    with pytest.raises(agent.CollectorError):
+        agent.get_reboot_status()
@@ -0,0 +1,98 @@
+"""Protokół PowerShellWorker sprawdzany przez zastępczy host (fake_shell.py) - działa bez Windows."""
+import os
+import sys
+import time
+
+import pytest
+
+import agent
+
+FAKE_SHELL = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_shell.py")]
+
+
+@pytest.fixture
+def worker():
+    worker = agent.PowerShellWorker(shell_command=FAKE_SHELL, default_timeout=10)
+    yield worker
+    worker.close()
+
+
+def test_request_response(worker):
+    assert worker.execute("echo hello") == (0, "hello\n")
+    assert worker.execute("printf 'Zażółć\\ngęślą'") == (0, "Zażółć\ngęślą")
+    assert worker.execute("echo na stderr >&2; exit 3") == (3, "")
+
+
+def test_commands_reuse_one_process(worker):
+    worker.execute("true")
+    pid = worker.process.pid
+    for i in range(20):
+        assert worker.execute(f"echo {i}") == (0, f"{i}\n")
+    assert worker.process.pid == pid
+
+
+def test_timeout_kills_and_restarts_shell(worker):
+    worker.execute("true")
+    pid = worker.process.pid
+    started = time.monotonic()
+    assert worker.execute("sleep 30", timeout=0.5) == (None, None)
+    assert time.monotonic() - started < 5
+    assert worker.process is None
+    assert worker.execute("echo po restarcie") == (0, "po restarcie\n")
+    assert worker.process.pid != pid
+
+
+def test_restart_after_shell_exit(worker):
+    worker.execute("true")
+    pid = worker.process.pid
+    assert worker.execute("exit 1") == (None, None)
+    assert worker.execute("echo dalej") == (0, "dalej\n")
+    assert worker.process.pid != pid
+
+
+def test_close_stops_shell(worker):
+    worker.execute("true")
+    process = worker.process
+    worker.close()
+    assert process.poll() is not None
+    assert worker.process is None
+
+
+@pytest.fixture
+def shell_pool(monkeypatch):
+    """Pusta pula procesów powłoki z zastępczym hostem zamiast powershell.exe."""
+    monkeypatch.setattr(agent, "default_shell_command", lambda: FAKE_SHELL)
+    monkeypatch.setattr(agent, "shell_pool", agent.queue.LifoQueue())
+    monkeypatch.setattr(agent, "shell_workers", [])
+    monkeypatch.setattr(agent, "SHELL_WORKERS", 2)
+    yield
+    agent.close_shell_workers()
+
+
+def test_threads_share_a_bounded_pool_of_shells(shell_pool):
+    results = []
+    threads = [agent.threading.Thread(target=lambda i=i: results.append(agent.run_command(f"sleep 0.2; echo {i}")))
+               for i in range(6)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert sorted(results) == [f"{i}\n" for i in range(6)]
+    assert len(agent.shell_workers) == 2
+    assert agent.shell_pool.qsize() == 2  # wszystkie procesy wróciły do puli
+
+
+def test_sequential_commands_reuse_one_shell(shell_pool):
+    for i in range(5):
+        assert agent.run_command(f"echo {i}") == f"{i}\n"
+    assert len(agent.shell_workers) == 1
+
+
+def test_waiting_for_a_busy_pool_times_out(shell_pool, monkeypatch):
+    monkeypatch.setattr(agent, "SHELL_WORKERS", 1)
+    busy = agent.threading.Thread(target=agent.run_command, args=("sleep 2",))
+    busy.start()
+    time.sleep(0.5)
+    started = time.monotonic()
+    assert agent.run_command("echo x", timeout=0.5) is None
+    assert time.monotonic() - started < 1.5
+    busy.join()
+    assert agent.run_command("echo x") == "x\n"
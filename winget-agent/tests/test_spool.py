@@ -0,0 +1,130 @@
+"""Kolejka offline (spool): zapis niewysłanych raportów i wyników zadań oraz ich ponowna wysyłka."""
+import json
+
+import pytest
+import requests
+
+import agent
+
+BASE_URL = "http://panel:5000/api"
+ENDPOINT = BASE_URL + "/report"
+
+
+class FakeResponse:
+    def __init__(self, url, status_code, body=None):
+        self.url, self.status_code, self.headers, self.body = url, status_code, {}, body or {}
+
+    def json(self):
+        return self.body
+
+
+class FakeServer:
+    """Zastępuje post_encoded: zapisuje wysłane treści, a gdy serwer "leży", rzuca ConnectionError."""
+
+    def __init__(self):
+        self.up, self.status, self.posts = True, 200, []
+
+    def __call__(self, base_url, url, encoded, timeout):
+        if not self.up:
+            raise requests.ConnectionError("serwer nieosiągalny")
+        body = json.loads(encoded[0].decode("utf-8"))
+        self.posts.append((url, body))
+        return FakeResponse(url, self.status, {"state_hash": body.get("state_hash")})
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(agent, "SPOOL_DIR", str(tmp_path / "spool"))
+    monkeypatch.setattr(agent, "REPORT_STATE_FILE", str(tmp_path / "report_state.json"))
+    monkeypatch.setattr(agent, "UPDATE_SOURCE_FILE", str(tmp_path / "update_source.json"))
+    monkeypatch.setattr(agent, "API_ENDPOINTS", [ENDPOINT])
+    monkeypatch.setattr(agent, "spool_backoff", {})
+    fake = FakeServer()
+    monkeypatch.setattr(agent, "post_encoded", fake)
+    return fake
+
+
+def spool_result(task_id):
+    agent.spool_task_result(BASE_URL, {"task_id": task_id, "status": "zakończone"})
+
+
+def test_results_are_delivered_in_order(server):
+    for task_id in (3, 1, 2):
+        spool_result(task_id)
+    agent.flush_spool()
+    assert [body["task_id"] for _, body in server.posts] == [3, 1, 2]
+    assert all(url == BASE_URL + "/tasks/result" for url, _ in server.posts)
+    assert agent.list_spool() == []
+
+
+def test_unreachable_server_keeps_spool_and_backs_off(server, monkeypatch):
+    spool_result(1)
+    spool_result(2)
+    server.up = False
+    agent.flush_spool()
+    assert len(agent.list_spool("result-")) == 2
+    assert agent.spool_backoff[BASE_URL][0] == 1
+    server.up = True
+    agent.flush_spool()  # czas do ponowienia jeszcze nie minął
+    assert server.posts == []
+    monkeypatch.setattr(agent, "spool_backoff", {})
+    agent.flush_spool()
+    assert [body["task_id"] for _, body in server.posts] == [1, 2]
+
+
+def test_backoff_doubles_up_to_the_limit(server, monkeypatch):
+    monkeypatch.setattr(agent, "SPOOL_RETRY_BASE_SECONDS", 30)
+    monkeypatch.setattr(agent, "SPOOL_RETRY_MAX_SECONDS", 100)
+    now = agent.time.monotonic()
+    delays = []
+    for _ in range(4):
+        agent.note_delivery(BASE_URL, False)
+        delays.append(round(agent.spool_backoff[BASE_URL][1] - now))
+    assert delays == [30, 60, 100, 100]
+    agent.note_delivery(BASE_URL, True)
+    assert agent.spool_ready(BASE_URL)
+
+
+def test_result_spool_drops_oldest_when_full(server, monkeypatch):
+    monkeypatch.setattr(agent, "SPOOL_MAX_RESULTS", 3)
+    for task_id in range(5):
+        spool_result(task_id)
+    assert len(agent.list_spool("result-")) == 3
+    agent.flush_spool()
+    assert [body["task_id"] for _, body in server.posts] == [2, 3, 4]
+
+
+def test_rejected_entry_is_removed(server):
+    spool_result(1)
+    server.status = 400
+    agent.flush_spool()
+    assert agent.list_spool() == []
+
+
+def test_newer_report_replaces_spooled_one(server):
+    state = {"installed_apps": [], "available_app_updates": [], "pending_os_updates": []}
+    agent.spool_report(ENDPOINT, json.dumps({"hostname": "pc01", "state_hash": "a"}), "a", state)
+    agent.spool_report(ENDPOINT, json.dumps({"hostname": "pc01", "state_hash": "b"}), "b", state)
+    assert len(agent.list_spool("report-")) == 1
+    agent.flush_spool()
+    assert server.posts == [(ENDPOINT, {"hostname": "pc01", "state_hash": "b"})]
+    # Serwer potwierdził stan, więc kolejny raport może być deltą względem niego.
+    assert agent.load_report_state()[ENDPOINT]["state_hash"] == "b"
+    assert agent.list_spool() == []
+
+
+def test_results_go_before_reports(server):
+    state = {"installed_apps": [], "available_app_updates": [], "pending_os_updates": []}
+    agent.spool_report(ENDPOINT, json.dumps({"hostname": "pc01", "state_hash": "a"}), "a", state)
+    spool_result(7)
+    agent.flush_spool()
+    assert [url for url, _ in server.posts] == [BASE_URL + "/tasks/result", ENDPOINT]
+
+
+def test_corrupted_spool_file_is_discarded(server, tmp_path):
+    spool_result(1)
+    name = agent.list_spool("result-")[0]
+    (tmp_path / "spool" / name).write_text("{nie json", encoding="utf-8")
+    agent.flush_spool()
+    assert agent.list_spool() == []
+    assert server.posts == []
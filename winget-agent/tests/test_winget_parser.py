@@ -0,0 +1,79 @@
+"""Parser tabel winget na nagranych wyjściach (fixtures/winget) i odczyt wyjścia procesu winget."""
+import glob
+import json
+import os
+import stat
+import subprocess
+import sys
+
+import pytest
+
+import agent
+
+FIXTURES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                         "fixtures", "winget", "*.txt")))
+
+
+def read_fixture(path):
+    with open(path, "r", encoding="utf-8", newline=None) as f:
+        return f.read().splitlines(keepends=True)
+
+
+@pytest.mark.parametrize("path", FIXTURES, ids=os.path.basename)
+def test_recorded_tables(path):
+    with open(path[:-4] + ".expected.json", "r", encoding="utf-8") as f:
+        expected = json.load(f)
+    assert list(agent.iter_winget_table(read_fixture(path))) == expected
+
+
+def test_progress_output_and_footer_are_skipped():
+    lines = ["\r   - \r   \\ \r\x1b[2K",
+             "Name            Id                 Version  Available Source",
+             "--------------------------------------------------------------",
+             "Google Chrome   Google.Chrome      123.0    124.0     winget",
+             "7-Zip 23.01     7zip.7zip          23.01    24.05     winget",
+             "2 upgrades available."]
+    assert list(agent.iter_winget_table(lines)) == [["Google Chrome", "Google.Chrome", "123.0", "124.0", "winget"],
+                                                    ["7-Zip 23.01", "7zip.7zip", "23.01", "24.05", "winget"]]
+
+
+def test_wide_characters_count_as_two_cells():
+    lines = ["Name      Id          Version", "-----------------------------", "秀丸エ    Hidemaru.H  9.25"]
+    assert list(agent.iter_winget_table(lines)) == [["秀丸エ", "Hidemaru.H", "9.25"]]
+
+
+@pytest.fixture
+def fake_winget(tmp_path, monkeypatch):
+    """Skrypt udający winget.exe: wypisuje nagrane wyjście i kończy się podanym kodem."""
+    def make(fixture, exit_code=0, sleep=0):
+        script = tmp_path / "winget"
+        script.write_text(f"#!{sys.executable}\nimport sys, time\n"
+                          f"sys.stdout.write(open({fixture!r}, encoding='utf-8').read())\nsys.stdout.flush()\n"
+                          f"time.sleep({sleep})\nsys.exit({exit_code})\n", encoding="utf-8")
+        script.chmod(script.stat().st_mode | stat.S_IEXEC)
+        monkeypatch.setattr(agent, "get_winget_path", lambda: str(script))
+        agent.take_command_stats()
+        return str(script)
+    return make
+
+
+LIST_EN = next(p for p in FIXTURES if p.endswith("list_en.txt"))
+
+
+def test_read_winget_table_success(fake_winget):
+    fake_winget(LIST_EN)
+    assert len(list(agent.read_winget_table(["list"]))) > 0
+    assert agent.take_command_stats()["winget list"]["failed"] == 0
+
+
+def test_nonzero_exit_code_is_an_error(fake_winget):
+    fake_winget(LIST_EN, exit_code=1)
+    with pytest.raises(agent.CollectorError):
+        agent.get_installed_apps()
+    assert agent.take_command_stats()["winget list"]["failed"] == 1
+
+
+def test_killed_process_is_an_error(fake_winget):
+    script = fake_winget(LIST_EN, sleep=30)
+    with pytest.raises(subprocess.TimeoutExpired):
+        list(agent.stream_process_lines([script, "list"], timeout=1))
@@ -1,15 +1,33 @@
 import sqlite3
 import json
+import collections
+import contextlib
+import csv
+import hashlib
+import io
+import itertools
 import logging
+import math
 import os
+import queue
+import re
+import secrets
 import subprocess
 import tempfile
 import shutil
 import uuid
+import threading
+import time
+import zipfile
+import zlib
+import click
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
 from dotenv import load_dotenv
 from flask import Flask, request, g, render_template, abort, Response, jsonify, send_from_directory, flash, redirect, \
     url_for, send_file
 from functools import wraps
+from werkzeug.wsgi import get_input_stream
 from datetime import datetime, UTC
 from zoneinfo import ZoneInfo
 
@@ -24,16 +42,241 @@ with open(AGENT_TEMPLATE_PATH, "r", encoding="utf-8") as f:
 DATABASE = os.getenv('DATABASE_FILE', 'winget_dashboard.db')
 API_KEY = os.getenv('API_KEY')
 SECRET_KEY = os.getenv('SECRET_KEY', 'default-secret-key-for-dev-only')
+# Long-poll zadań: maksymalny czas trzymania żądania i limit jednocześnie czekających agentów
+# (każdy czekający agent zajmuje wątek serwera; po przekroczeniu limitu odpowiedź wraca od razu).
+TASK_LONG_POLL_MAX_SECONDS = int(os.getenv('TASK_LONG_POLL_MAX_SECONDS', '60'))
+TASK_LONG_POLL_MAX_WAITERS = int(os.getenv('TASK_LONG_POLL_MAX_WAITERS', '200'))
+TASK_LONG_POLL_RECHECK_SECONDS = 10
+# Limit rozmiaru treści żądania API po rozpakowaniu (ochrona przed "bombami" gzip)
+MAX_REQUEST_BODY_BYTES = int(os.getenv('MAX_REQUEST_BODY_BYTES', str(64 * 1024 * 1024)))
+# Przyjmowanie raportów: 'sync' (zapis w wątku żądania, odpowiedź 200) albo 'async' (kolejka + wątek zapisujący, 202)
+REPORT_INGEST_MODE = os.getenv('REPORT_INGEST_MODE', 'sync').strip().lower()
+INGEST_QUEUE_MAX = int(os.getenv('INGEST_QUEUE_MAX', '500'))
+INGEST_BATCH_MAX = int(os.getenv('INGEST_BATCH_MAX', '50'))
+INGEST_SPOOL_DIR = os.getenv('INGEST_SPOOL_DIR', 'ingest_spool')
+INGEST_RETRY_AFTER_SECONDS = int(os.getenv('INGEST_RETRY_AFTER_SECONDS', '30'))
+# Retencja historii raportów, np. 'all:7,daily:90,weekly' - wszystkie raporty z 7 dni, potem jeden dziennie
+# do 90 dni, starsze jeden na tydzień. Pusta wartość = raporty nie są usuwane.
+REPORT_RETENTION_POLICY = os.getenv('REPORT_RETENTION_POLICY', '')
+RETENTION_INTERVAL_HOURS = float(os.getenv('RETENTION_INTERVAL_HOURS', '24'))
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '500'))
+# Migracja v1 (migawki aplikacji) przenosi tyle raportów na transakcję - ogranicza też zużycie pamięci.
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', '500'))
+# Wdrożenie zbiorcze sprawdza próg błędów dopiero po tylu zakończonych zadaniach.
+ROLLOUT_MIN_RESULTS = int(os.getenv('ROLLOUT_MIN_RESULTS', '5'))
+# Zadanie wdrożenia, które tyle minut czeka na agenta ('oczekuje') albo na wynik ('w toku'), jest uznawane za
+# nieudane i liczy się do progu błędów - inaczej jeden wyłączony komputer wstrzymałby kolejne fale na zawsze.
+# 0 = bez limitu.
+ROLLOUT_TASK_TIMEOUT_MINUTES = int(os.getenv('ROLLOUT_TASK_TIMEOUT_MINUTES', '240'))
+ROLLOUT_WATCHDOG_INTERVAL_SECONDS = 60
+# Liczba wyrenderowanych stron panelu trzymanych w pamięci (LRU).
+PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', '128'))
+# Raport zbiorczy jest generowany i wysyłany partiami po tylu komputerów.
+REPORT_STREAM_BATCH = int(os.getenv('REPORT_STREAM_BATCH', '100'))
+# Harmonogram raportów agentów: każdy host dostaje stały slot w cyklu, tak żeby flota raportowała średnio
+# najwyżej REPORT_MAX_RATE razy na sekundę. Cykl trwa co najmniej REPORT_MIN_INTERVAL_SECONDS i wydłuża się
+# z liczbą komputerów; przy przeciążeniu serwer każe agentom zwolnić (najwyżej REPORT_MAX_SLOW_DOWN razy).
+REPORT_MIN_INTERVAL_SECONDS = int(os.getenv('REPORT_MIN_INTERVAL_SECONDS', '3600'))
+REPORT_MAX_RATE = float(os.getenv('REPORT_MAX_RATE', '2'))
+REPORT_MAX_SLOW_DOWN = float(os.getenv('REPORT_MAX_SLOW_DOWN', '8'))
+# Nowy komputer (jeszcze bez raportu) wysyła pierwszy raport w tym oknie, a nie dopiero w swoim slocie.
+REPORT_NEW_HOST_WINDOW_SECONDS = int(os.getenv('REPORT_NEW_HOST_WINDOW_SECONDS', '300'))
+# Poziom logowania; przy DEBUG serwer zapisuje też próbki treści każdego raportu (kosztowne przy dużej flocie).
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').strip().upper()
+# Serwer produkcyjny (`flask serve` albo `python app.py`, waitress): adres, port i liczba wątków obsługujących żądania.
+SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('SERVER_PORT', '5000'))
+SERVER_THREADS = int(os.getenv('SERVER_THREADS', '32'))
+# Połączenia z bazą: pamięć podręczna stron SQLite na połączenie i rozmiar pliku mapowanego w pamięci (MB).
+DB_CACHE_SIZE_MB = int(os.getenv('DB_CACHE_SIZE_MB', '16'))
+DB_MMAP_SIZE_MB = int(os.getenv('DB_MMAP_SIZE_MB', '256'))
+# Źródło dostępnych aktualizacji aplikacji: 'agent' (winget upgrade na każdym komputerze) albo 'catalog' - serwer
+# wylicza je z katalogu wersji pakietów (flask import-catalog), a agenty pomijają winget upgrade.
+UPDATE_SOURCE = os.getenv('UPDATE_SOURCE', 'agent').strip().lower()
+# Generator agenta: katalog ze zbudowanym agent.exe (jeden na wersję szablonu) i tajny tekst, z którego powstaje
+# klucz prywatny Ed25519 podpisu agent_config.json (pusty = losowy, zapisany przy pierwszym użyciu
+# w AGENT_BUILD_DIR/config_signing.key). Do agent.exe trafia tylko klucz publiczny.
+AGENT_BUILD_DIR = os.getenv('AGENT_BUILD_DIR', 'agent_build')
+AGENT_CONFIG_SIGNING_KEY = os.getenv('AGENT_CONFIG_SIGNING_KEY', '')
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = SECRET_KEY
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.INFO), format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- Funkcje i reszta aplikacji (bez zmian) ---
 
+# --- Metryki (format tekstowy Prometheusa, GET /metrics) ---
+# Histogramy i liczniki trzymane w pamięci procesu; wartości typu "stan" (zadania wg statusu, kolejka raportów)
+# są liczone dopiero przy odczycie /metrics.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+AGENT_DURATION_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+METRICS = {  # nazwa -> (typ, opis, kubełki histogramu)
+    'winget_http_request_duration_seconds': ('histogram', 'Czas obsługi żądania HTTP według trasy.', LATENCY_BUCKETS),
+    'winget_http_requests_total': ('counter', 'Liczba żądań HTTP według trasy i kodu odpowiedzi.', None),
+    'winget_http_request_body_bytes': ('histogram', 'Rozmiar treści żądań API przed rozpakowaniem.', SIZE_BUCKETS),
+    'winget_report_payload_bytes': ('histogram', 'Rozmiar raportu agenta po rozpakowaniu.', SIZE_BUCKETS),
+    'winget_sqlite_statement_duration_seconds': ('histogram', 'Czas wykonania polecenia SQLite (bez pobierania '
+                                                 'kolejnych wierszy) według rodzaju polecenia.', LATENCY_BUCKETS),
+    'winget_agent_collector_duration_seconds': ('histogram', 'Czas kolektorów zgłoszony przez agentów.',
+                                                AGENT_DURATION_BUCKETS),
+    'winget_agent_command_duration_seconds': ('summary', 'Łączny czas wywołań winget/PowerShell zgłoszony przez '
+                                              'agentów.', None),
+    'winget_long_poll_rejected_total': ('counter', 'Zapytania long-poll obsłużone od razu, bo wszystkie miejsca '
+                                        'na czekających agentów były zajęte.', None),
+    'winget_agent_command_failures_total': ('counter', 'Nieudane wywołania winget/PowerShell zgłoszone przez agentów.',
+                                            None),
+}
+SQL_STATEMENT_KINDS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT',
+                       'RELEASE', 'PRAGMA'}
+metrics_lock = threading.Lock()
+metric_values = {}  # (nazwa, etykiety) -> licznik albo [trafienia kubełków..., suma, liczba]
+
+
+def observe(name, value, **labels):
+    """Dopisuje obserwację do histogramu albo podsumowania (summary) `name`."""
+    buckets = METRICS[name][2] or ()
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        entry = metric_values.get(key)
+        if entry is None:
+            entry = metric_values[key] = [0] * len(buckets) + [0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                entry[i] += 1
+                break
+        entry[-2] += value
+        entry[-1] += 1
+
+
+def inc_metric(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metric_values[key] = metric_values.get(key, 0) + amount
+
+
+def metric_labels(labels):
+    if not labels: return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def render_metrics(gauges):
+    """Składa tekst w formacie Prometheusa z metryk procesu i przekazanych wartości chwilowych (gauge)."""
+    with metrics_lock:
+        values = {key: (list(v) if isinstance(v, list) else v) for key, v in metric_values.items()}
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for (metric, labels), value in sorted(values.items()):
+            if metric != name: continue
+            if kind == 'counter':
+                lines.append(f"{name}{metric_labels(labels)} {value}")
+                continue
+            if kind == 'histogram':
+                cumulative = 0
+                for bound, hits in zip(buckets, value):
+                    cumulative += hits
+                    lines.append(f"{name}_bucket{metric_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+                lines.append(f"{name}_bucket{metric_labels(labels + (('le', '+Inf'),))} {value[-1]}")
+            lines.append(f"{name}_sum{metric_labels(labels)} {round(value[-2], 6)}")
+            lines.append(f"{name}_count{metric_labels(labels)} {value[-1]}")
+    for name, help_text, samples in gauges:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        lines += [f"{name}{metric_labels(tuple(labels.items()))} {value}" for labels, value in samples]
+    return "\n".join(lines) + "\n"
+
+
+def statement_kind(sql):
+    word = sql.lstrip()[:9].split(None, 1)
+    word = word[0].upper() if word else ''
+    return word if word in SQL_STATEMENT_KINDS else 'OTHER'
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Kursor mierzący czas execute/executemany (metryka winget_sqlite_statement_duration_seconds)."""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            observe('winget_sqlite_statement_duration_seconds', time.perf_counter() - started,
+                    statement=statement_kind(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            observe('winget_sqlite_statement_duration_seconds', time.perf_counter() - started,
+                    statement=statement_kind(sql))
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            observe('winget_sqlite_statement_duration_seconds', time.perf_counter() - started, statement='COMMIT')
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if request.path.startswith('/api/') and request.content_length:
+        observe('winget_http_request_body_bytes', request.content_length,
+                encoding=request.headers.get('Content-Encoding', 'identity').strip().lower() or 'identity')
+
+
+@app.before_request
+def decompress_request_body():
+    """Rozpakowuje skompresowaną treść żądań agenta (Content-Encoding: gzip), zanim trafi do get_json()."""
+    encoding = request.headers.get('Content-Encoding', '').strip().lower()
+    if not encoding or encoding == 'identity' or not request.path.startswith('/api/'):
+        return None
+    if request.headers.get('X-API-Key') != API_KEY:
+        return None  # endpoint i tak odrzuci żądanie - nie rozpakowujemy danych od nieuwierzytelnionych klientów
+    if encoding != 'gzip':
+        return "Unsupported Content-Encoding", 415
+    # Czytamy bezpośrednio ze strumienia WSGI, żeby request.stream powstał dopiero z rozpakowanej treści.
+    compressed = get_input_stream(request.environ, max_content_length=MAX_REQUEST_BODY_BYTES).read()
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    try:
+        body = decompressor.decompress(compressed, MAX_REQUEST_BODY_BYTES + 1)
+    except zlib.error:
+        return "Bad Request", 400
+    if len(body) > MAX_REQUEST_BODY_BYTES or decompressor.unconsumed_tail:
+        return "Payload Too Large", 413
+    request.environ['wsgi.input'] = io.BytesIO(body)
+    request.environ['CONTENT_LENGTH'] = str(len(body))
+    request.environ.pop('HTTP_CONTENT_ENCODING', None)
+    logging.info("Rozpakowano treść %s: %d B -> %d B", request.path, len(compressed), len(body))
+    return None
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        observe('winget_http_request_duration_seconds', time.perf_counter() - g.request_started,
+                route=route, method=request.method)
+        inc_metric('winget_http_requests_total', route=route, method=request.method, status=response.status_code)
+    return response
+
 @app.after_request
 def add_header(response):
-    if 'text/html' in response.content_type:
+    # Strony z ETag (cached_page) same ustawiają Cache-Control i mogą być rewalidowane przez przeglądarkę.
+    if 'text/html' in response.content_type and not response.get_etag()[0]:
         response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
         response.headers['Pragma'] = 'no-cache'
         response.headers['Expires'] = '-1'
@@ -49,30 +292,590 @@ def to_local_time_filter(utc_str):
     except (ValueError, TypeError):
         return utc_str
 
+# winget skraca za długie wartości w tabeli znakiem "…" - taki identyfikator nie wskazuje jednoznacznie pakietu
+# i nie może trafić do `winget upgrade/uninstall --id` (zadanie nie powiodłoby się albo trafiło w inny pakiet).
+TRUNCATION_MARK = '…'
+
+
+@app.template_test('dispatchable_package')
+def is_dispatchable_package_id(package_id):
+    return bool(package_id) and not str(package_id).endswith(TRUNCATION_MARK)
+
 @app.context_processor
 def inject_year():
     return {'current_year': datetime.now(UTC).year}
 
+def connect_db(**kwargs):
+    """Otwiera połączenie z bazą z ustawieniami wspólnymi dla żądań, wątku zapisującego i poleceń CLI."""
+    db = sqlite3.connect(DATABASE, factory=TimedConnection, **kwargs)
+    db.row_factory = sqlite3.Row
+    if db.execute("PRAGMA journal_mode").fetchone()[0] == 'wal':
+        db.execute("PRAGMA synchronous = NORMAL")  # w trybie WAL bezpieczne, a znacznie tańsze niż FULL
+    return db
+
+# --- Pula połączeń ---
+# Każdy wątek serwera ma własne połączenie tylko do odczytu, otwierane raz i używane przez kolejne żądania.
+# W trybie WAL odczyty nie czekają na zapis, więc strony panelu nie blokują się na raportach agentów.
+# Wszystkie zapisy w procesie idą przez jedno wspólne połączenie (write_db) po kolei, pod blokadą -
+# wątki nie rywalizują o blokadę pliku bazy i nie czekają w busy_timeout SQLite.
+db_readers = threading.local()
+db_writer = None
+db_write_lock = threading.Lock()
+
+
+def tune_connection(db):
+    db.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_MB * 1024}")
+    db.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE_MB * 1024 * 1024}")
+    return db
+
+
+def open_read_connection():
+    """Połączenie do odczytu: PRAGMA query_only odrzuca każdą próbę zapisu przez nie."""
+    db = tune_connection(connect_db())
+    db.execute("PRAGMA query_only = ON")
+    return db
+
+
 def get_db():
-    if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = sqlite3.connect(DATABASE)
-        g.sqlite_db.row_factory = sqlite3.Row
-    return g.sqlite_db
+    """Połączenie do odczytu dla bieżącego wątku (z puli - nie jest zamykane po żądaniu)."""
+    db = getattr(db_readers, 'db', None)
+    if db is None:
+        db = db_readers.db = open_read_connection()
+        check_schema_version(db)
+        start_retention_worker()
+        start_rollout_watchdog()
+    return db
+
+
+@contextlib.contextmanager
+def write_db():
+    """Wspólne połączenie zapisujące na czas bloku `with`; niezatwierdzone zmiany są na końcu wycofywane."""
+    global db_writer
+    with db_write_lock:
+        if db_writer is None:
+            db_writer = tune_connection(connect_db(timeout=30, check_same_thread=False))
+        try:
+            yield db_writer
+        finally:
+            if db_writer.in_transaction: db_writer.rollback()
+
 
 @app.teardown_appcontext
 def close_db(error):
-    if hasattr(g, 'sqlite_db'):
-        g.sqlite_db.close()
+    db = getattr(db_readers, 'db', None)
+    if db is not None and db.in_transaction:
+        db.rollback()
 
 @app.cli.command('init-db')
 def init_db_command():
-    db = sqlite3.connect(DATABASE)
+    db = connect_db()
+    db.execute("PRAGMA auto_vacuum = INCREMENTAL")
     with app.open_resource('schema.sql', mode='r') as f:
         db.cursor().executescript(f.read())
+    db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     db.commit();
+    db.execute("VACUUM")  # auto_vacuum zaczyna działać dopiero po przebudowie pliku
+    db.execute("PRAGMA journal_mode = WAL")
     db.close()
     print('Zainicjowano bazę danych.')
 
+# --- Migracje schematu ---
+# Wersja schematu jest zapisana w PRAGMA user_version. schema.sql zawsze opisuje najnowszą wersję (init-db
+# ustawia SCHEMA_VERSION), a `flask migrate-db` podnosi istniejącą bazę krok po kroku bez utraty danych.
+# Każda migracja jest idempotentna - przerwaną migrację można bezpiecznie uruchomić ponownie.
+
+def table_columns(db, table):
+    return {c['name'] for c in db.execute(f"PRAGMA table_info({table})")}
+
+def migrate_app_snapshots(db):
+    """v1: przenosi wiersze applications do deduplikowanych migawek i dodaje kolumny snapshot_id i state_hash."""
+    tables = {r['name'] for r in db.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")}
+    report_columns = table_columns(db, 'reports')
+    if 'state_hash' not in report_columns:
+        db.execute("ALTER TABLE reports ADD COLUMN state_hash TEXT")
+        db.commit()
+    if 'applications' not in tables:
+        return
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS app_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content_hash TEXT UNIQUE NOT NULL,
+            app_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS snapshot_apps (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            snapshot_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            version TEXT,
+            app_id TEXT,
+            FOREIGN KEY (snapshot_id) REFERENCES app_snapshots (id) ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS idx_snapshot_apps_snapshot ON snapshot_apps (snapshot_id);
+    """)
+    if 'snapshot_id' not in report_columns:
+        db.execute("ALTER TABLE reports ADD COLUMN snapshot_id INTEGER REFERENCES app_snapshots (id)")
+    db.commit()
+    # Raporty są przenoszone partiami (po id), więc w pamięci jest naraz tylko jedna partia wierszy aplikacji -
+    # także przy milionach wierszy. Tymczasowy indeks po report_id (znika razem z tabelą) zastępuje pełne
+    # przeszukanie applications dla każdej partii.
+    db.execute("CREATE INDEX IF NOT EXISTS idx_applications_report_migration ON applications (report_id)")
+    db.commit()
+    cur, migrated, last_id = db.cursor(), 0, 0
+    while True:
+        report_ids = [r['id'] for r in db.execute(
+            "SELECT id FROM reports WHERE snapshot_id IS NULL AND id > ? ORDER BY id LIMIT ?",
+            (last_id, MIGRATION_BATCH_SIZE))]
+        if not report_ids: break
+        last_id = report_ids[-1]
+        rows = db.execute("""
+            SELECT report_id, name, app_id, version FROM applications
+            WHERE report_id BETWEEN ? AND ? ORDER BY report_id
+        """, (report_ids[0], last_id)).fetchall()
+        for report_id, group in itertools.groupby(rows, key=lambda r: r['report_id']):
+            apps = [{'name': r['name'], 'id': r['app_id'], 'version': r['version']} for r in group]
+            cur.execute("UPDATE reports SET snapshot_id = ? WHERE id = ? AND snapshot_id IS NULL",
+                        (store_app_snapshot(cur, apps), report_id))
+            migrated += cur.rowcount
+        db.commit()
+        print(f'Przeniesiono {migrated} raportów...')
+    # Raporty bez żadnych aplikacji dostają pustą migawkę.
+    if db.execute("SELECT 1 FROM reports WHERE snapshot_id IS NULL LIMIT 1").fetchone():
+        empty_id = store_app_snapshot(cur, [])
+        migrated += cur.execute("UPDATE reports SET snapshot_id = ? WHERE snapshot_id IS NULL", (empty_id,)).rowcount
+    db.commit()
+    old_rows = db.execute("SELECT COUNT(*) FROM applications").fetchone()[0]
+    new_rows = db.execute("SELECT COUNT(*) FROM snapshot_apps").fetchone()[0]
+    snapshots = db.execute("SELECT COUNT(*) FROM app_snapshots").fetchone()[0]
+    db.executescript("""
+        DROP TABLE applications;
+        DROP VIEW IF EXISTS report_applications;
+        CREATE VIEW report_applications AS
+            SELECT r.id AS report_id, sa.name, sa.version, sa.app_id
+            FROM reports r JOIN snapshot_apps sa ON sa.snapshot_id = r.snapshot_id;
+    """)
+    db.commit()
+    db.execute("VACUUM")
+    print(f'Zmigrowano {migrated} raportów: {old_rows} wierszy aplikacji -> {new_rows} wierszy w {snapshots} migawkach.')
+
+def migrate_hot_path_indexes(db):
+    """v2: indeksy dla najczęstszych zapytań (ostatni raport komputera, aktualizacje raportu, zadania, historia)."""
+    db.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_reports_computer_time ON reports (computer_id, report_timestamp DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_updates_report ON updates (report_id, update_type);
+        CREATE INDEX IF NOT EXISTS idx_tasks_computer_status ON tasks (computer_id, status);
+        CREATE INDEX IF NOT EXISTS idx_action_history_computer_time ON action_history (computer_id, timestamp);
+    """)
+    db.execute("ANALYZE")
+    db.commit()
+
+def migrate_latest_report_pointer(db):
+    """v3: computers.latest_report_id - wskaźnik na ostatni raport, aktualizowany przy każdym zapisie raportu."""
+    if 'latest_report_id' not in table_columns(db, 'computers'):
+        db.execute("ALTER TABLE computers ADD COLUMN latest_report_id INTEGER REFERENCES reports (id)")
+    db.execute("""
+        UPDATE computers SET latest_report_id = (
+            SELECT id FROM reports r WHERE r.computer_id = computers.id
+            ORDER BY r.report_timestamp DESC, r.id DESC LIMIT 1)
+    """)
+    db.commit()
+
+def migrate_incremental_vacuum(db):
+    """v4: indeks reports.snapshot_id (sprzątanie migawek po retencji) i auto_vacuum = INCREMENTAL."""
+    db.execute("CREATE INDEX IF NOT EXISTS idx_reports_snapshot ON reports (snapshot_id)")
+    db.commit()
+    if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute("VACUUM")  # jednorazowa przebudowa pliku - na dużej bazie może potrwać
+
+def migrate_fleet_index(db):
+    """v5: indeks aplikacji i aktualizacji całej floty (stan z ostatniego raportu każdego komputera)."""
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS fleet_apps (
+            computer_id INTEGER NOT NULL,
+            app_key TEXT NOT NULL,
+            name TEXT,
+            app_id TEXT,
+            version TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (computer_id, app_key)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_fleet_apps_app ON fleet_apps (app_key, version);
+        CREATE TABLE IF NOT EXISTS fleet_app_versions (
+            app_key TEXT NOT NULL,
+            version TEXT NOT NULL,
+            name TEXT,
+            hosts INTEGER NOT NULL,
+            PRIMARY KEY (app_key, version)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS fleet_updates (
+            computer_id INTEGER NOT NULL,
+            update_type TEXT NOT NULL,
+            app_key TEXT NOT NULL,
+            name TEXT,
+            app_id TEXT,
+            current_version TEXT,
+            available_version TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (computer_id, update_type, app_key)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_fleet_updates_app ON fleet_updates (update_type, app_key);
+        CREATE TABLE IF NOT EXISTS fleet_update_counts (
+            update_type TEXT NOT NULL,
+            app_key TEXT NOT NULL,
+            available_version TEXT NOT NULL,
+            name TEXT,
+            hosts INTEGER NOT NULL,
+            PRIMARY KEY (update_type, app_key, available_version)
+        ) WITHOUT ROWID;
+        CREATE TRIGGER IF NOT EXISTS fleet_apps_insert AFTER INSERT ON fleet_apps BEGIN
+            INSERT INTO fleet_app_versions (app_key, version, name, hosts) VALUES (NEW.app_key, NEW.version, NEW.name, 1)
+            ON CONFLICT (app_key, version) DO UPDATE SET hosts = hosts + 1, name = excluded.name;
+        END;
+        CREATE TRIGGER IF NOT EXISTS fleet_apps_delete AFTER DELETE ON fleet_apps BEGIN
+            UPDATE fleet_app_versions SET hosts = hosts - 1 WHERE app_key = OLD.app_key AND version = OLD.version;
+            DELETE FROM fleet_app_versions WHERE app_key = OLD.app_key AND version = OLD.version AND hosts <= 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS fleet_updates_insert AFTER INSERT ON fleet_updates BEGIN
+            INSERT INTO fleet_update_counts (update_type, app_key, available_version, name, hosts)
+            VALUES (NEW.update_type, NEW.app_key, NEW.available_version, NEW.name, 1)
+            ON CONFLICT (update_type, app_key, available_version) DO UPDATE SET hosts = hosts + 1, name = excluded.name;
+        END;
+        CREATE TRIGGER IF NOT EXISTS fleet_updates_delete AFTER DELETE ON fleet_updates BEGIN
+            UPDATE fleet_update_counts SET hosts = hosts - 1
+            WHERE update_type = OLD.update_type AND app_key = OLD.app_key AND available_version = OLD.available_version;
+            DELETE FROM fleet_update_counts
+            WHERE update_type = OLD.update_type AND app_key = OLD.app_key AND available_version = OLD.available_version
+              AND hosts <= 0;
+        END;
+    """)
+    db.execute("DELETE FROM fleet_apps")
+    db.execute("DELETE FROM fleet_updates")
+    db.execute("""
+        INSERT OR IGNORE INTO fleet_apps (computer_id, app_key, name, app_id, version)
+        SELECT c.id, COALESCE(NULLIF(ra.app_id, ''), ra.name), ra.name, ra.app_id, COALESCE(ra.version, '')
+        FROM computers c JOIN report_applications ra ON ra.report_id = c.latest_report_id
+    """)
+    db.execute("""
+        INSERT OR IGNORE INTO fleet_updates (computer_id, update_type, app_key, name, app_id, current_version, available_version)
+        SELECT c.id, u.update_type, CASE WHEN u.update_type = 'OS' THEN u.name ELSE COALESCE(NULLIF(u.app_id, ''), u.name) END,
+               u.name, u.app_id, u.current_version, COALESCE(u.available_version, '')
+        FROM computers c JOIN updates u ON u.report_id = c.latest_report_id
+    """)
+    db.commit()
+
+def migrate_page_version(db):
+    """v6: computers.page_version - licznik zmian komputera dla ETag i pamięci podręcznej stron."""
+    if 'page_version' not in table_columns(db, 'computers'):
+        db.execute("ALTER TABLE computers ADD COLUMN page_version INTEGER NOT NULL DEFAULT 0")
+    db.commit()
+
+def migrate_typed_action_history(db):
+    """v7: dziennik zdarzeń z typowanymi kolumnami zamiast JSON w details, kluczem deduplikacji i flagą is_latest."""
+    if 'details' not in table_columns(db, 'action_history'):
+        return
+    db.executescript(f"""
+        DROP TABLE IF EXISTS action_history_new;
+        CREATE TABLE action_history_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            computer_id INTEGER NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            action_type TEXT NOT NULL,
+            name TEXT NOT NULL DEFAULT '',
+            from_version TEXT,
+            to_version TEXT,
+            task_id INTEGER,
+            dedupe_key TEXT,
+            is_latest INTEGER NOT NULL DEFAULT 1,
+            FOREIGN KEY (computer_id) REFERENCES computers (id) ON DELETE CASCADE
+        );
+        INSERT INTO action_history_new (id, computer_id, timestamp, action_type, name, from_version, to_version,
+                                        dedupe_key, is_latest)
+        SELECT id, computer_id, timestamp, action_type, name, from_version, to_version,
+               CASE WHEN action_type = 'OS_UPDATE_SUCCESS' AND ROW_NUMBER() OVER (
+                        PARTITION BY computer_id, action_type, name, bucket ORDER BY id) = 1
+                    THEN 'OS_UPDATE_SUCCESS|' || name || '|' || bucket END,
+               ROW_NUMBER() OVER (PARTITION BY computer_id, action_type, name ORDER BY timestamp DESC, id DESC) = 1
+        FROM (
+            SELECT id, computer_id, timestamp, action_type,
+                   COALESCE(CASE WHEN json_valid(details) THEN json_extract(details, '$.name') END, '') AS name,
+                   CASE WHEN json_valid(details) THEN json_extract(details, '$.from') END AS from_version,
+                   CASE WHEN json_valid(details) THEN json_extract(details, '$.to') END AS to_version,
+                   CAST(strftime('%s', timestamp) AS INTEGER) / {EVENT_DEDUPE_BUCKET_SECONDS} AS bucket
+            FROM action_history
+        );
+        DROP TABLE action_history;
+        ALTER TABLE action_history_new RENAME TO action_history;
+        CREATE INDEX idx_action_history_computer_time ON action_history (computer_id, timestamp);
+        CREATE UNIQUE INDEX idx_action_history_dedupe ON action_history (computer_id, dedupe_key);
+        CREATE INDEX idx_action_history_latest_key ON action_history (computer_id, action_type, name) WHERE is_latest = 1;
+        CREATE INDEX idx_action_history_latest_time ON action_history (computer_id, timestamp DESC, id DESC)
+            WHERE is_latest = 1;
+    """)
+    db.commit()
+
+def migrate_rollouts(db):
+    """v8: wdrożenia zbiorcze - tabela rollouts oraz tasks.rollout_id i tasks.wave."""
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS rollouts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            package_id TEXT NOT NULL,
+            name TEXT,
+            status TEXT NOT NULL DEFAULT 'aktywne',
+            wave_size INTEGER NOT NULL,
+            max_concurrent INTEGER NOT NULL,
+            failure_threshold REAL NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+    columns = table_columns(db, 'tasks')
+    if 'rollout_id' not in columns:
+        db.execute("ALTER TABLE tasks ADD COLUMN rollout_id INTEGER REFERENCES rollouts (id)")
+    if 'wave' not in columns:
+        db.execute("ALTER TABLE tasks ADD COLUMN wave INTEGER")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_rollout ON tasks (rollout_id, wave, status)")
+    db.commit()
+
+def migrate_task_timings(db):
+    """v9: tasks.duration_seconds i tasks.queue_wait_seconds zgłaszane przez agenta z wynikiem zadania."""
+    columns = table_columns(db, 'tasks')
+    for column in ('duration_seconds', 'queue_wait_seconds'):
+        if column not in columns:
+            db.execute(f"ALTER TABLE tasks ADD COLUMN {column} REAL")
+    db.commit()
+
+def migrate_update_catalog(db):
+    """v10: katalog wersji pakietów (catalog_packages) i updates.from_catalog dla aktualizacji wyliczonych z niego."""
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_packages (
+            package_id TEXT PRIMARY KEY COLLATE NOCASE,
+            name TEXT,
+            latest_version TEXT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    """)
+    if 'from_catalog' not in table_columns(db, 'updates'):
+        db.execute("ALTER TABLE updates ADD COLUMN from_catalog INTEGER NOT NULL DEFAULT 0")
+    db.commit()
+
+MIGRATIONS = [
+    (1, 'migawki aplikacji', migrate_app_snapshots),
+    (2, 'indeksy zapytań', migrate_hot_path_indexes),
+    (3, 'wskaźnik ostatniego raportu', migrate_latest_report_pointer),
+    (4, 'przyrostowe odzyskiwanie miejsca', migrate_incremental_vacuum),
+    (5, 'indeks aplikacji floty', migrate_fleet_index),
+    (6, 'wersje stron panelu', migrate_page_version),
+    (7, 'typowany dziennik zdarzeń', migrate_typed_action_history),
+    (8, 'wdrożenia zbiorcze', migrate_rollouts),
+    (9, 'czasy wykonania zadań', migrate_task_timings),
+    (10, 'katalog wersji pakietów', migrate_update_catalog),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+schema_checked = False
+
+def run_migrations(db):
+    """Stosuje brakujące migracje i włącza tryb WAL. Zwraca (wersja_początkowa, lista_zastosowanych)."""
+    start_version = db.execute("PRAGMA user_version").fetchone()[0]
+    applied = []
+    for version, label, migration in MIGRATIONS:
+        if version <= start_version: continue
+        started = time.perf_counter()
+        migration(db)
+        db.execute(f"PRAGMA user_version = {version}")
+        db.commit()
+        applied.append(version)
+        print(f'Migracja {version} ({label}) zastosowana w {time.perf_counter() - started:.2f}s.')
+    db.execute("PRAGMA journal_mode = WAL")
+    return start_version, applied
+
+def check_schema_version(db):
+    """Raz na proces sprawdza, czy baza ma aktualny schemat (bez niego zapis raportów się nie powiedzie)."""
+    global schema_checked
+    if schema_checked: return
+    schema_checked = True
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        logging.error("Schemat bazy danych jest nieaktualny (wersja %d, wymagana %d) - uruchom `flask migrate-db`.",
+                      version, SCHEMA_VERSION)
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Aktualizuje schemat istniejącej bazy danych do najnowszej wersji bez utraty danych."""
+    db = connect_db()
+    if 'computers' not in {r['name'] for r in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}:
+        print('Baza danych jest pusta - użyj `flask init-db`.')
+        db.close()
+        return
+    start_version, applied = run_migrations(db)
+    db.close()
+    if applied:
+        print(f'Zaktualizowano schemat z wersji {start_version} do {applied[-1]}.')
+    else:
+        print(f'Schemat jest aktualny (wersja {start_version}).')
+
+@app.cli.command('migrate-snapshots')
+def migrate_snapshots_command():
+    """Dawna nazwa `flask migrate-db` (zachowana dla zgodności)."""
+    migrate_db_command.callback()
+
+# --- Retencja historii raportów ---
+# Raporty starsze niż kolejne progi polityki są przerzedzane do jednego (najnowszego) na godzinę/dzień/tydzień/
+# miesiąc. Ostatni raport komputera (computers.latest_report_id) nigdy nie jest usuwany - od niego liczone są
+# delty i wyniki zadań. Usuwanie idzie małymi partiami, każda w osobnym bloku write_db() - między partiami
+# wspólne połączenie zapisujące jest zwalniane i czekające raporty agentów zapisują się bez blokady pliku bazy.
+RETENTION_BUCKETS = {'all': None, 'hourly': '%Y-%m-%d %H', 'daily': '%Y-%m-%d', 'weekly': '%Y-%W', 'monthly': '%Y-%m'}
+retention_worker = None
+
+
+def parse_retention_policy(text):
+    """'all:7,daily:90,weekly' -> [('all', 7), ('daily', 90), ('weekly', None)]. Brak dni = bez limitu wieku."""
+    tiers = []
+    for part in filter(None, (p.strip() for p in (text or '').split(','))):
+        granularity, _, days = part.partition(':')
+        granularity = granularity.strip().lower()
+        if granularity not in RETENTION_BUCKETS:
+            raise ValueError(f"nieznana szczegółowość '{granularity}' (dozwolone: {', '.join(RETENTION_BUCKETS)})")
+        if tiers and tiers[-1][1] is None:
+            raise ValueError("próg bez liczby dni musi być ostatni")
+        days = int(days) if days.strip() else None
+        if days is not None and tiers and days <= tiers[-1][1]:
+            raise ValueError("liczby dni w kolejnych progach muszą rosnąć")
+        tiers.append((granularity, days))
+    return tiers
+
+
+def find_prunable_reports(db, tiers):
+    """Zwraca id raportów do usunięcia: w każdym przedziale czasu danego progu zostaje najnowszy raport,
+    a raporty starsze niż ostatni próg z limitem dni są usuwane w całości."""
+    if not tiers: return []
+    cases, params = [], []
+    for granularity, days in tiers:
+        bucket = "'r' || r.id" if RETENTION_BUCKETS[granularity] is None else \
+            f"'{granularity[0]}' || strftime('{RETENTION_BUCKETS[granularity]}', r.report_timestamp)"
+        if days is None:
+            cases.append(f"ELSE {bucket}")
+        else:
+            cases.append(f"WHEN r.report_timestamp >= datetime('now', ?) THEN {bucket}")
+            params.append(f"-{days} days")
+    sql = f"""
+        SELECT id FROM (
+            SELECT id, bucket, ROW_NUMBER() OVER (
+                PARTITION BY computer_id, bucket ORDER BY report_timestamp DESC, id DESC) AS position
+            FROM (SELECT r.id, r.computer_id, r.report_timestamp, CASE {' '.join(cases)} END AS bucket FROM reports r))
+        WHERE (bucket IS NULL OR position > 1)
+          AND id NOT IN (SELECT latest_report_id FROM computers WHERE latest_report_id IS NOT NULL)
+        ORDER BY id
+    """
+    return [r['id'] for r in db.execute(sql, params)]
+
+
+def prune_reports(tiers, batch_size=RETENTION_BATCH_SIZE, pause=0.05, dry_run=False):
+    """Usuwa raporty według polityki, sprząta nieużywane migawki i zwalnia miejsce. Zwraca statystyki."""
+    started = time.perf_counter()
+    stats = {'candidates': 0, 'reports': 0, 'updates': 0, 'snapshots': 0, 'freed_pages': 0}
+    reader = open_read_connection()
+    try:
+        report_ids = find_prunable_reports(reader, tiers)
+        stats['candidates'] = len(report_ids)
+        if dry_run: return stats
+        for i in range(0, len(report_ids), batch_size):
+            batch = report_ids[i:i + batch_size]
+            marks = ','.join('?' * len(batch))
+            with write_db() as db:
+                db.execute(f"UPDATE computers SET page_version = page_version + 1 "
+                           f"WHERE id IN (SELECT DISTINCT computer_id FROM reports WHERE id IN ({marks}))", batch)
+                stats['updates'] += db.execute(f"DELETE FROM updates WHERE report_id IN ({marks})", batch).rowcount
+                stats['reports'] += db.execute(
+                    f"DELETE FROM reports WHERE id IN ({marks}) "
+                    f"AND id NOT IN (SELECT latest_report_id FROM computers WHERE latest_report_id IS NOT NULL)",
+                    batch).rowcount
+                db.commit()
+            time.sleep(pause)  # przerwa na zapisy raportów czekające na write_db()
+        orphaned = [r['id'] for r in reader.execute(
+            "SELECT id FROM app_snapshots s WHERE NOT EXISTS (SELECT 1 FROM reports r WHERE r.snapshot_id = s.id)")]
+    finally:
+        reader.close()
+    for i in range(0, len(orphaned), batch_size):
+        batch = orphaned[i:i + batch_size]
+        marks = ','.join('?' * len(batch))
+        # Lista sierot mogła się zdezaktualizować - raport przyjęty w międzyczasie mógł ponownie użyć migawki
+        # (INSERT OR IGNORE). Oba usunięcia sprawdzają to jeszcze raz w tej samej transakcji zapisu.
+        with write_db() as db:
+            db.execute(f"DELETE FROM snapshot_apps WHERE snapshot_id IN ({marks}) "
+                       f"AND NOT EXISTS (SELECT 1 FROM reports r WHERE r.snapshot_id = snapshot_apps.snapshot_id)", batch)
+            stats['snapshots'] += db.execute(
+                f"DELETE FROM app_snapshots WHERE id IN ({marks}) "
+                f"AND NOT EXISTS (SELECT 1 FROM reports r WHERE r.snapshot_id = app_snapshots.id)", batch).rowcount
+            db.commit()
+        time.sleep(pause)
+    stats['freed_pages'] = reclaim_free_pages(pause=pause)
+    stats['duration'] = round(time.perf_counter() - started, 2)
+    return stats
+
+
+def reclaim_free_pages(step_pages=2000, pause=0.05):
+    """Oddaje wolne strony do systemu plików krokami PRAGMA incremental_vacuum (wymaga auto_vacuum = INCREMENTAL)."""
+    with write_db() as db:
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2: return 0
+        initial = free_pages = db.execute("PRAGMA freelist_count").fetchone()[0]
+    while free_pages:
+        with write_db() as db:
+            # executescript wykonuje pragmę do końca; execute() zwolniłby tylko jedną stronę na wywołanie.
+            db.executescript(f"PRAGMA incremental_vacuum({step_pages});")
+            remaining = db.execute("PRAGMA freelist_count").fetchone()[0]
+        if remaining >= free_pages: break
+        free_pages = remaining
+        time.sleep(pause)
+    with write_db() as db:
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()  # w trybie WAL plik maleje dopiero po checkpoincie
+    return initial - free_pages
+
+
+def retention_loop(tiers):
+    while True:
+        try:
+            stats = prune_reports(tiers)
+            logging.info("Retencja raportów: usunięto %d raportów, %d aktualizacji, %d migawek, zwolniono %d stron "
+                         "w %.1fs.", stats['reports'], stats['updates'], stats['snapshots'], stats['freed_pages'],
+                         stats['duration'])
+        except Exception as e:
+            logging.error("Błąd zadania retencji raportów: %s", e, exc_info=True)
+        time.sleep(RETENTION_INTERVAL_HOURS * 3600)
+
+
+def start_retention_worker():
+    """Uruchamia (raz na proces) okresowe przerzedzanie historii, jeśli ustawiono REPORT_RETENTION_POLICY."""
+    global retention_worker
+    if retention_worker is not None or not REPORT_RETENTION_POLICY or RETENTION_INTERVAL_HOURS <= 0: return
+    try:
+        tiers = parse_retention_policy(REPORT_RETENTION_POLICY)
+    except ValueError as e:
+        logging.error("Niepoprawna REPORT_RETENTION_POLICY: %s - retencja wyłączona.", e)
+        retention_worker = False
+        return
+    retention_worker = threading.Thread(target=retention_loop, args=(tiers,), name="report-retention", daemon=True)
+    retention_worker.start()
+
+
+@app.cli.command('prune-reports')
+@click.option('--policy', default=None, help="Polityka retencji (domyślnie REPORT_RETENTION_POLICY), np. 'all:7,daily:90,weekly'.")
+@click.option('--dry-run', is_flag=True, help="Tylko policz raporty do usunięcia.")
+def prune_reports_command(policy, dry_run):
+    """Przerzedza historię raportów według polityki retencji i zwalnia miejsce w pliku bazy."""
+    try:
+        tiers = parse_retention_policy(policy if policy is not None else REPORT_RETENTION_POLICY)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--policy')
+    if not tiers:
+        print('Polityka retencji jest pusta - nic do zrobienia.')
+        return
+    stats = prune_reports(tiers, dry_run=dry_run)
+    if dry_run:
+        print(f"Do usunięcia: {stats['candidates']} raportów.")
+    else:
+        print(f"Usunięto {stats['reports']} raportów, {stats['updates']} aktualizacji, {stats['snapshots']} migawek; "
+              f"zwolniono {stats['freed_pages']} stron w {stats['duration']}s.")
+
+
 def require_api_key(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -87,54 +890,124 @@ def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'), 'favicon.ico',
                                mimetype='image/vnd.microsoft.icon')
 
+# --- Pamięć podręczna stron panelu i warunkowy GET ---
+# Strona jest zapamiętywana razem z wersją danych, z których powstała (computers.page_version, podbijany przy
+# raporcie, zleceniu zadania i wyniku zadania). Ta sama wersja wyznacza ETag, więc automatyczne przeładowania
+# niezmienionej strony kończą się odpowiedzią 304 bez zapytań o treść i bez renderowania szablonu.
+
+def compute_page_etag_salt():
+    """Skrót kodu i szablonów - po wdrożeniu nowej wersji panelu stare ETagi przestają pasować."""
+    digest = hashlib.sha1()
+    templates_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+    paths = [os.path.abspath(__file__)] + [os.path.join(templates_dir, n) for n in sorted(os.listdir(templates_dir))]
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+PAGE_ETAG_SALT = compute_page_etag_salt()
+page_cache = collections.OrderedDict()
+page_cache_lock = threading.Lock()
+page_cache_stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+
+
+def bump_page_version(db, computer_id):
+    db.execute("UPDATE computers SET page_version = page_version + 1 WHERE id = ?", (computer_id,))
+
+
+def cached_page(key, version, render):
+    """Zwraca stronę dla (key, version): 304 przy zgodnym If-None-Match, HTML z pamięci albo świeżo wyrenderowany."""
+    etag = hashlib.sha1(f"{PAGE_ETAG_SALT}:{key}:{version}".encode()).hexdigest()[:24]
+    if etag in request.if_none_match:
+        with page_cache_lock:
+            page_cache_stats['not_modified'] += 1
+        response = Response(status=304)
+    else:
+        with page_cache_lock:
+            entry = page_cache.get(key)
+            hit = entry is not None and entry[0] == version
+            page_cache_stats['hits' if hit else 'misses'] += 1
+            if hit: page_cache.move_to_end(key)
+        html = entry[1] if hit else render()
+        if not hit:
+            with page_cache_lock:
+                page_cache[key] = (version, html)
+                page_cache.move_to_end(key)
+                while len(page_cache) > PAGE_CACHE_SIZE:
+                    page_cache.popitem(last=False)
+        response = Response(html, mimetype='text/html')
+    response.set_etag(etag)
+    # no-cache = przeglądarka może trzymać kopię, ale przed użyciem pyta serwer (If-None-Match).
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @app.route('/')
 def index():
-    computers = get_db().execute(
-        "SELECT id, hostname, ip_address, last_report, reboot_required FROM computers ORDER BY hostname COLLATE NOCASE").fetchall()
-    return render_template('index.html', computers=computers)
+    db = get_db()
+    version = tuple(db.execute("SELECT COUNT(*), TOTAL(page_version) FROM computers").fetchone())
+
+    def render():
+        computers = db.execute(
+            "SELECT id, hostname, ip_address, last_report, reboot_required FROM computers ORDER BY hostname COLLATE NOCASE").fetchall()
+        return render_template('index.html', computers=computers)
+    return cached_page(('index',), version, render)
 
 @app.route('/computer/<hostname>')
 def computer_details(hostname):
     db = get_db()
-    computer = db.execute("SELECT * FROM computers WHERE hostname = ?", (hostname,)).fetchone()
+    computer = db.execute("SELECT id, page_version FROM computers WHERE hostname = ?", (hostname,)).fetchone()
     if not computer: abort(404)
-    latest_report = db.execute("SELECT id FROM reports WHERE computer_id = ? ORDER BY report_timestamp DESC LIMIT 1",
-                               (computer['id'],)).fetchone()
-    apps, updates = [], []
-    if latest_report:
-        report_id = latest_report['id']
-        apps = db.execute(
-            "SELECT name, version, app_id FROM applications WHERE report_id = ? ORDER BY name COLLATE NOCASE",
-            (report_id,)).fetchall()
-        updates = db.execute(
-            "SELECT id, name, app_id, status, current_version, available_version, update_type FROM updates WHERE report_id = ? ORDER BY update_type, name COLLATE NOCASE",
-            (report_id,)).fetchall()
-    return render_template('computer.html', computer=computer, apps=apps, updates=updates)
+
+    def render():
+        computer = db.execute("SELECT * FROM computers WHERE hostname = ?", (hostname,)).fetchone()
+        apps, updates = [], []
+        if computer['latest_report_id']:
+            report_id = computer['latest_report_id']
+            apps = db.execute(
+                "SELECT name, version, app_id FROM report_applications WHERE report_id = ? ORDER BY name COLLATE NOCASE",
+                (report_id,)).fetchall()
+            updates = db.execute(
+                "SELECT id, name, app_id, status, current_version, available_version, update_type, from_catalog FROM updates WHERE report_id = ? ORDER BY update_type, name COLLATE NOCASE",
+                (report_id,)).fetchall()
+        return render_template('computer.html', computer=computer, apps=apps, updates=updates)
+    return cached_page(('computer', hostname), computer['page_version'], render)
 
 @app.route('/computer/<hostname>/history')
 def computer_history(hostname):
     db = get_db()
-    computer = db.execute("SELECT * FROM computers WHERE hostname = ?", (hostname,)).fetchone()
+    computer = db.execute("SELECT id, page_version FROM computers WHERE hostname = ?", (hostname,)).fetchone()
     if not computer: abort(404)
-    reports = db.execute(
-        "SELECT id, report_timestamp FROM reports WHERE computer_id = ? ORDER BY report_timestamp DESC",
-        (computer['id'],)).fetchall()
-    return render_template('history.html', computer=computer, reports=reports)
+
+    def render():
+        reports = db.execute(
+            "SELECT id, report_timestamp FROM reports WHERE computer_id = ? ORDER BY report_timestamp DESC",
+            (computer['id'],)).fetchall()
+        return render_template('history.html', computer=db.execute(
+            "SELECT * FROM computers WHERE id = ?", (computer['id'],)).fetchone(), reports=reports)
+    return cached_page(('history', hostname), computer['page_version'], render)
 
 
 @app.route('/report/<int:report_id>')
 def view_report(report_id):
+    """Migawka aplikacji się nie zmienia, ale strona pokazuje też bieżący adres IP komputera, a aktualizacje
+    z katalogu są przeliczane w miejscu - wersją strony jest więc page_version komputera, nie stała."""
     db = get_db()
-    report = db.execute(
-        "SELECT r.id, r.report_timestamp, c.hostname, c.ip_address FROM reports r JOIN computers c ON r.computer_id = c.id WHERE r.id = ?",
-        (report_id,)).fetchone()
-    if not report: abort(404)
-    apps = db.execute("SELECT name, version, app_id FROM applications WHERE report_id = ? ORDER BY name COLLATE NOCASE",
-                      (report_id,)).fetchall()
-    updates = db.execute(
-        "SELECT name, app_id, current_version, available_version, update_type FROM updates WHERE report_id = ? ORDER BY update_type, name COLLATE NOCASE",
-        (report_id,)).fetchall()
-    return render_template('report_view.html', report=report, apps=apps, updates=updates)
+    row = db.execute("SELECT c.page_version FROM reports r JOIN computers c ON r.computer_id = c.id WHERE r.id = ?",
+                     (report_id,)).fetchone()
+    if not row: abort(404)
+
+    def render():
+        report = db.execute(
+            "SELECT r.id, r.report_timestamp, c.hostname, c.ip_address FROM reports r JOIN computers c ON r.computer_id = c.id WHERE r.id = ?",
+            (report_id,)).fetchone()
+        apps = db.execute("SELECT name, version, app_id FROM report_applications WHERE report_id = ? ORDER BY name COLLATE NOCASE",
+                          (report_id,)).fetchall()
+        updates = db.execute(
+            "SELECT name, app_id, current_version, available_version, update_type FROM updates WHERE report_id = ? ORDER BY update_type, name COLLATE NOCASE",
+            (report_id,)).fetchall()
+        return render_template('report_view.html', report=report, apps=apps, updates=updates)
+    return cached_page(('report', report_id), row['page_version'], render)
 
 
 @app.route('/settings')
@@ -153,121 +1026,948 @@ teams
 outlook
 store
     """
-    return render_template('settings.html', server_api_key=API_KEY, default_blacklist_keywords=default_blacklist_keywords)
+    # Samo wyświetlenie strony niczego nie buduje ani nie tworzy klucza podpisu - budowanie zleca przycisk
+    # "Zbuduj agenta" (POST /settings/agent_build), pobranie agenta albo `flask build-agent`.
+    return render_template('settings.html', server_api_key=API_KEY, default_blacklist_keywords=default_blacklist_keywords,
+                           agent_build=agent_build_status())
+
+# --- Widoki floty: kto ma aplikację X, rozkład wersji, hosty na oczekującą aktualizację ---
+
+def fleet_app_summary(db, query=''):
+    sql = """
+        SELECT v.app_key, MAX(v.name) AS name, SUM(v.hosts) AS hosts, COUNT(*) AS versions,
+               COALESCE(MAX(p.hosts), 0) AS pending_hosts
+        FROM fleet_app_versions v
+        LEFT JOIN (SELECT app_key, SUM(hosts) AS hosts FROM fleet_update_counts
+                   WHERE update_type = 'APP' GROUP BY app_key) p ON p.app_key = v.app_key
+        {where}
+        GROUP BY v.app_key ORDER BY hosts DESC, name COLLATE NOCASE
+    """
+    if not query:
+        return db.execute(sql.format(where='')).fetchall()
+    pattern = f"%{query}%"
+    return db.execute(sql.format(where="WHERE v.name LIKE ? OR v.app_key LIKE ?"), (pattern, pattern)).fetchall()
+
+
+def fleet_app_details(db, app_key, version_prefix=''):
+    versions = db.execute("SELECT version, hosts, name FROM fleet_app_versions WHERE app_key = ? ORDER BY hosts DESC",
+                          (app_key,)).fetchall()
+    hosts = db.execute("""
+        SELECT c.id, c.hostname, c.ip_address, c.last_report, fa.version, fu.available_version
+        FROM fleet_apps fa
+        JOIN computers c ON c.id = fa.computer_id
+        LEFT JOIN fleet_updates fu ON fu.computer_id = fa.computer_id AND fu.update_type = 'APP' AND fu.app_key = fa.app_key
+        WHERE fa.app_key = ? AND substr(fa.version, 1, length(?)) = ?
+        ORDER BY c.hostname COLLATE NOCASE
+    """, (app_key, version_prefix, version_prefix)).fetchall()
+    return versions, hosts
+
+
+def fleet_update_summary(db):
+    return db.execute("""
+        SELECT update_type, app_key, MAX(name) AS name, SUM(hosts) AS hosts,
+               group_concat(available_version, ', ') AS available_versions
+        FROM fleet_update_counts GROUP BY update_type, app_key ORDER BY hosts DESC, name COLLATE NOCASE
+    """).fetchall()
+
+
+def fleet_update_hosts(db, update_type, app_key):
+    return db.execute("""
+        SELECT c.id, c.hostname, c.ip_address, c.last_report, fu.name, fu.app_id, fu.current_version, fu.available_version
+        FROM fleet_updates fu JOIN computers c ON c.id = fu.computer_id
+        WHERE fu.update_type = ? AND fu.app_key = ?
+        ORDER BY c.hostname COLLATE NOCASE
+    """, (update_type, app_key)).fetchall()
+
+
+@app.route('/fleet/apps')
+def fleet_apps():
+    query = request.args.get('q', '').strip()
+    return render_template('fleet_apps.html', apps=fleet_app_summary(get_db(), query), query=query)
+
+
+@app.route('/fleet/app')
+def fleet_app():
+    app_key, version = request.args.get('key', ''), request.args.get('version', '')
+    versions, hosts = fleet_app_details(get_db(), app_key, version)
+    if not versions: abort(404)
+    return render_template('fleet_app.html', app_key=app_key, name=versions[0]['name'], versions=versions,
+                           hosts=hosts, version=version)
+
+
+@app.route('/fleet/updates')
+def fleet_updates():
+    return render_template('fleet_updates.html', updates=fleet_update_summary(get_db()))
+
+
+@app.route('/fleet/update')
+def fleet_update():
+    update_type, app_key = request.args.get('type', 'APP'), request.args.get('key', '')
+    hosts = fleet_update_hosts(get_db(), update_type, app_key)
+    if not hosts: abort(404)
+    return render_template('fleet_update.html', update_type=update_type, app_key=app_key, hosts=hosts)
+
+
+@app.route('/api/fleet/apps', methods=['GET'])
+@require_api_key
+def api_fleet_apps():
+    return jsonify([dict(r) for r in fleet_app_summary(get_db(), request.args.get('q', '').strip())])
+
+
+@app.route('/api/fleet/app', methods=['GET'])
+@require_api_key
+def api_fleet_app():
+    versions, hosts = fleet_app_details(get_db(), request.args.get('key', ''), request.args.get('version', ''))
+    if not versions: abort(404)
+    return jsonify({"app_key": request.args.get('key', ''), "versions": [dict(v) for v in versions],
+                    "hosts": [dict(h) for h in hosts]})
+
+
+@app.route('/api/fleet/updates', methods=['GET'])
+@require_api_key
+def api_fleet_updates():
+    return jsonify([dict(r) for r in fleet_update_summary(get_db())])
+
+
+@app.route('/api/fleet/update', methods=['GET'])
+@require_api_key
+def api_fleet_update():
+    hosts = fleet_update_hosts(get_db(), request.args.get('type', 'APP'), request.args.get('key', ''))
+    if not hosts: abort(404)
+    return jsonify([dict(h) for h in hosts])
+
+
+def compute_snapshot_hash(apps):
+    """Zwraca skrót SHA-256 listy aplikacji niezależny od kolejności wpisów."""
+    canonical = sorted((a.get('id') or '', a.get('name') or '', a.get('version') or '') for a in apps)
+    return hashlib.sha256(json.dumps(canonical, ensure_ascii=False, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def store_app_snapshot(cur, apps):
+    """Zapisuje migawkę listy aplikacji (tylko jeśli takiej jeszcze nie ma) i zwraca jej id."""
+    apps = [a for a in apps if isinstance(a, dict) and a.get('name')]
+    content_hash = compute_snapshot_hash(apps)
+    cur.execute("INSERT OR IGNORE INTO app_snapshots (content_hash, app_count) VALUES (?, ?)",
+                (content_hash, len(apps)))
+    if cur.rowcount == 0:
+        return cur.execute("SELECT id FROM app_snapshots WHERE content_hash = ?", (content_hash,)).fetchone()[0]
+    snapshot_id = cur.lastrowid
+    if apps: cur.executemany(
+        "INSERT INTO snapshot_apps (snapshot_id, name, app_id, version) VALUES (?, ?, ?, ?)",
+        [(snapshot_id, a.get('name'), a.get('id'), a.get('version')) for a in apps])
+    return snapshot_id
+
+
+# --- Protokół raportów różnicowych (delta) ---
+# Pola stanu porównywane przy liczeniu skrótu i różnic - muszą być zgodne z agentem.
+REPORT_PROTOCOL_VERSION = 2
+STATE_FIELDS = {
+    'installed_apps': ('id', 'name', 'version'),
+    'available_app_updates': ('id', 'name', 'current_version', 'available_version'),
+    'pending_os_updates': ('Title', 'KB'),
+}
+
+
+def normalize_report_state(data):
+    """Sprowadza listy z raportu do postaci, w jakiej są zapisywane w bazie (KB jako tekst, aplikacje z nazwą)."""
+    pending_os_updates = data.get('pending_os_updates') or []
+    if isinstance(pending_os_updates, dict): pending_os_updates = [pending_os_updates]
+    os_updates = []
+    for os_update in pending_os_updates:
+        if not isinstance(os_update, dict): continue
+        kb = ", ".join(os_update.get('KB', [])) if isinstance(os_update.get('KB'), list) else os_update.get('KB', 'N/A')
+        os_updates.append({'Title': os_update.get('Title', 'Brak tytułu'), 'KB': kb})
+    return {
+        'installed_apps': [a for a in data.get('installed_apps') or [] if isinstance(a, dict) and a.get('name')],
+        'available_app_updates': [u for u in data.get('available_app_updates') or [] if isinstance(u, dict)],
+        'pending_os_updates': os_updates,
+    }
+
+
+def unreported_sections(data):
+    """Sekcje stanu, których brakuje w pełnym raporcie - agent pomija sekcję, gdy jej kolektor zawiódł, a nie miał
+    wcześniejszego wyniku. Dla takiej sekcji obowiązuje stan z poprzedniego raportu, a nie pusta lista."""
+    return [section for section in STATE_FIELDS if section not in data]
+
+
+def state_entry_key(section, entry):
+    if section == 'pending_os_updates': return entry.get('Title') or ''
+    return entry.get('id') or entry.get('name') or ''
+
+
+def compute_state_hash(state):
+    canonical = {section: sorted([str(e.get(f) or '') for f in fields] for e in state.get(section, []))
+                 for section, fields in STATE_FIELDS.items()}
+    return hashlib.sha256(json.dumps(canonical, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+                          .encode('utf-8')).hexdigest()
+
+
+def load_report_state(db, report_id):
+    """Odtwarza z bazy stan (listy aplikacji i aktualizacji) zapisany w danym raporcie - tak, jak go wysłał agent
+    (bez aktualizacji wyliczonych z katalogu)."""
+    apps = db.execute("SELECT name, app_id, version FROM report_applications WHERE report_id = ?", (report_id,))
+    updates = db.execute("SELECT name, app_id, current_version, available_version, update_type FROM updates "
+                         "WHERE report_id = ? AND from_catalog = 0", (report_id,)).fetchall()
+    return {
+        'installed_apps': [{'name': a['name'], 'id': a['app_id'], 'version': a['version']} for a in apps],
+        'available_app_updates': [{'name': u['name'], 'id': u['app_id'], 'current_version': u['current_version'],
+                                   'available_version': u['available_version']} for u in updates
+                                  if u['update_type'] == 'APP'],
+        'pending_os_updates': [{'Title': u['name'], 'KB': u['available_version']} for u in updates
+                               if u['update_type'] == 'OS'],
+    }
+
+
+def apply_report_delta(state, delta):
+    """Nakłada różnicę od agenta na poprzedni stan. Zwraca None, gdy różnicy nie da się jednoznacznie zastosować."""
+    new_state = {}
+    for section in STATE_FIELDS:
+        entries = {state_entry_key(section, e): e for e in state.get(section, [])}
+        if len(entries) != len(state.get(section, [])): return None
+        section_delta = delta.get(section) or {}
+        for key in section_delta.get('removed', []):
+            if entries.pop(key, None) is None: return None
+        for entry in section_delta.get('changed', []):
+            if state_entry_key(section, entry) not in entries: return None
+            entries[state_entry_key(section, entry)] = entry
+        for entry in section_delta.get('added', []):
+            if state_entry_key(section, entry) in entries: return None
+            entries[state_entry_key(section, entry)] = entry
+        new_state[section] = list(entries.values())
+    return new_state
+
+
+# --- Dziennik zdarzeń ---
+# Powtórki odrzuca unikalny indeks (computer_id, dedupe_key) przy zapisie, zamiast wyszukiwania w historii;
+# dla aktualizacji systemu klucz zawiera numer okna czasowego, więc ten sam KB może wrócić w kolejnym tygodniu.
+EVENT_DEDUPE_BUCKET_SECONDS = 7 * 24 * 3600
+
+
+def record_event(cur, computer_id, action_type, name, from_version=None, to_version=None, task_id=None,
+                 dedupe_key=None):
+    """Dopisuje zdarzenie i przenosi na nie flagę is_latest. Zwraca False, gdy klucz deduplikacji już istnieje."""
+    cur.execute("INSERT OR IGNORE INTO action_history (computer_id, action_type, name, from_version, to_version, "
+                "task_id, dedupe_key) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (computer_id, action_type, name or '', from_version, to_version, task_id, dedupe_key))
+    if not cur.rowcount: return False
+    cur.execute("UPDATE action_history SET is_latest = 0 "
+                "WHERE computer_id = ? AND action_type = ? AND name = ? AND is_latest = 1 AND id != ?",
+                (computer_id, action_type, name or '', cur.lastrowid))
+    return True
+
+
+# --- Indeks aplikacji floty ---
+# fleet_apps/fleet_updates trzymają stan z ostatniego raportu każdego komputera, a fleet_app_versions/
+# fleet_update_counts (utrzymywane przez triggery) - gotowe liczniki hostów. Przy zapisie raportu zmieniane są
+# tylko wiersze, które się różnią; raport bez zmian (ten sam state_hash) nie dotyka indeksu wcale.
+
+def fleet_app_key(app_id, name):
+    return app_id or name or ''
+
+
+def update_fleet_index(cur, computer_id, state):
+    apps = {fleet_app_key(a.get('id'), a.get('name')): (a.get('name'), a.get('id'), a.get('version') or '')
+            for a in state['installed_apps']}
+    current = {r['app_key']: (r['name'], r['app_id'], r['version']) for r in cur.execute(
+        "SELECT app_key, name, app_id, version FROM fleet_apps WHERE computer_id = ?", (computer_id,))}
+    cur.executemany("DELETE FROM fleet_apps WHERE computer_id = ? AND app_key = ?",
+                    [(computer_id, k) for k, v in current.items() if apps.get(k) != v])
+    cur.executemany("INSERT INTO fleet_apps (computer_id, app_key, name, app_id, version) VALUES (?, ?, ?, ?, ?)",
+                    [(computer_id, k, *v) for k, v in apps.items() if current.get(k) != v])
+
+    updates = {('APP', fleet_app_key(u.get('id'), u.get('name'))):
+               (u.get('name'), u.get('id'), u.get('current_version'), u.get('available_version') or '')
+               for u in state['available_app_updates']}
+    updates.update({('OS', u['Title']): (u['Title'], None, None, u['KB'] or '') for u in state['pending_os_updates']})
+    current = {(r['update_type'], r['app_key']): (r['name'], r['app_id'], r['current_version'], r['available_version'])
+               for r in cur.execute("SELECT update_type, app_key, name, app_id, current_version, available_version "
+                                    "FROM fleet_updates WHERE computer_id = ?", (computer_id,))}
+    cur.executemany("DELETE FROM fleet_updates WHERE computer_id = ? AND update_type = ? AND app_key = ?",
+                    [(computer_id, *k) for k, v in current.items() if updates.get(k) != v])
+    cur.executemany("INSERT INTO fleet_updates (computer_id, update_type, app_key, name, app_id, current_version, "
+                    "available_version) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(computer_id, *k, *v) for k, v in updates.items() if current.get(k) != v])
+
+
+# --- Katalog wersji pakietów ---
+# Najnowsza wersja każdego pakietu z lokalnej kopii repozytorium manifestów winget (winget-pkgs) albo z pliku
+# importu. Przy UPDATE_SOURCE=catalog dostępne aktualizacje aplikacji wynikają z porównania wersji zainstalowanych
+# (z raportu) z katalogiem, więc agent nie musi uruchamiać `winget upgrade`. Aktualizacje zgłoszone mimo to przez
+# agenta (np. ze źródła msstore) mają pierwszeństwo; wyliczone przez serwer mają updates.from_catalog = 1.
+UNCOMPARABLE_VERSIONS = {'', 'unknown'}
+MANIFEST_EXTRA_FILE_RE = re.compile(r'.+\.(installer|locale\.[A-Za-z0-9-]+)')
+MANIFEST_NAME_RE = re.compile(r'^PackageName:\s*(.+?)\s*$', re.MULTILINE)
+catalog_size_cache = {'value': 0, 'expires': 0.0}
+
+
+def version_parts(version):
+    """Części wersji jak w winget: rozdzielone kropkami, każda to liczba i opcjonalny przyrostek (małymi literami)."""
+    parts = []
+    for part in version.strip().split('.'):
+        digits, other = re.match(r'\s*(\d*)(.*)', part).groups()
+        other = other.strip().lower()
+        parts.append((int(digits) if digits else 0, not other, other))
+    return parts
+
+
+def compare_versions(a, b):
+    """Porównuje wersje (-1, 0, 1). Brakujące części liczą się jak 0 (1.2 == 1.2.0), a część z przyrostkiem jest
+    starsza od samej liczby (1.0-beta < 1.0 < 1.0.1); przyrostki porównywane bez rozróżniania wielkości liter."""
+    for x, y in itertools.zip_longest(version_parts(a), version_parts(b), fillvalue=(0, True, '')):
+        if x != y: return 1 if x > y else -1
+    return 0
+
+
+def comparable_version(version):
+    """Wersji 'Unknown' ani przybliżonych z winget list ('< 1.2', '> 3.0') nie da się porównać z katalogiem."""
+    return (isinstance(version, str) and version.strip().lower() not in UNCOMPARABLE_VERSIONS
+            and version.strip()[0] not in '<>')
+
+
+def is_newer_version(candidate, installed):
+    return (comparable_version(candidate) and comparable_version(installed)
+            and compare_versions(candidate, installed) > 0)
+
+
+def catalog_updates(db, installed_apps, skip_keys=()):
+    """Aktualizacje wynikające z katalogu dla zainstalowanych aplikacji (z pominięciem kluczy floty skip_keys)."""
+    apps = [a for a in installed_apps if a.get('id') and comparable_version(a.get('version'))
+            and fleet_app_key(a['id'], a.get('name')) not in skip_keys]
+    if not apps: return []
+    latest = {r['package_id'].lower(): r['latest_version'] for r in db.execute(
+        "SELECT package_id, latest_version FROM catalog_packages WHERE package_id IN (SELECT value FROM json_each(?))",
+        (json.dumps([a['id'] for a in apps]),))}
+    return [{'name': a.get('name'), 'id': a['id'], 'current_version': a['version'],
+             'available_version': latest[a['id'].lower()]}
+            for a in apps if a['id'].lower() in latest and is_newer_version(latest[a['id'].lower()], a['version'])]
+
+
+def catalog_size(db):
+    now = time.monotonic()
+    if catalog_size_cache['expires'] <= now:
+        catalog_size_cache['value'] = db.execute("SELECT COUNT(*) FROM catalog_packages").fetchone()[0]
+        catalog_size_cache['expires'] = now + 60
+    return catalog_size_cache['value']
+
+
+def effective_update_source(db):
+    """'catalog', gdy serwer sam wylicza aktualizacje (tryb catalog i niepusty katalog), w przeciwnym razie 'agent'."""
+    return 'catalog' if UPDATE_SOURCE == 'catalog' and catalog_size(db) else 'agent'
+
+
+def iter_manifest_tree(root):
+    """Wpisy (id, wersja, None, katalog) z kopii winget-pkgs: manifests/<litera>/<wydawca>/<pakiet>/<wersja>/<Id>.yaml.
+
+    Identyfikator pochodzi z nazwy pliku manifestu wersji (albo jednoplikowego), wersja - z nazwy katalogu.
+    """
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            stem, ext = os.path.splitext(filename)
+            if ext.lower() != '.yaml' or MANIFEST_EXTRA_FILE_RE.fullmatch(stem): continue
+            yield stem, os.path.basename(dirpath), None, dirpath
+
+
+def read_manifest_name(manifest_dir, package_id):
+    """PackageName z manifestu jednoplikowego albo z manifestu lokalizacji pakietu."""
+    for filename in sorted(os.listdir(manifest_dir)):
+        if not filename.startswith(package_id + '.') or not filename.endswith('.yaml'): continue
+        try:
+            with open(os.path.join(manifest_dir, filename), 'r', encoding='utf-8-sig') as f:
+                match = MANIFEST_NAME_RE.search(f.read())
+        except (OSError, UnicodeDecodeError):
+            continue
+        if match: return match.group(1).strip('\'"')
+    return None
+
+
+def iter_catalog_file(path):
+    """Wpisy (id, wersja, nazwa, None) z pliku CSV (kolumny id, version[, name]) albo JSON - listy obiektów
+    {"id", "version", "name"} (także PackageIdentifier/PackageVersion/PackageName) lub słownika {id: wersja}."""
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        if path.lower().endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            data = json.load(f)
+            rows = [{'id': k, 'version': v} for k, v in data.items()] if isinstance(data, dict) else data
+    for row in rows:
+        if not isinstance(row, dict): continue
+        yield (row.get('id') or row.get('PackageIdentifier'), row.get('version') or row.get('PackageVersion'),
+               row.get('name') or row.get('PackageName'), None)
+
+
+def read_catalog_source(path):
+    """Zwraca {id małymi literami: (id, najnowsza wersja, nazwa)} z katalogu manifestów albo pliku importu."""
+    entries = iter_manifest_tree(path) if os.path.isdir(path) else iter_catalog_file(path)
+    latest = {}
+    for package_id, version, name, manifest_dir in entries:
+        if not isinstance(package_id, str) or not package_id.strip() or not comparable_version(version): continue
+        package_id, version = package_id.strip(), version.strip()
+        current = latest.get(package_id.lower())
+        if current is None or compare_versions(version, current[1]) > 0:
+            latest[package_id.lower()] = (package_id, version, name or (current[2] if current else None), manifest_dir)
+    for key, (package_id, version, name, manifest_dir) in latest.items():
+        if manifest_dir and not name:
+            name = read_manifest_name(manifest_dir, package_id)
+        latest[key] = (package_id, version, name)
+    return latest
+
+
+def import_catalog(db, latest, merge=False):
+    """Zapisuje katalog (bez --merge usuwa pakiety spoza źródła). Zwraca (zmienione, usunięte) id pakietów."""
+    current = {r['package_id'].lower(): (r['latest_version'], r['name'])
+               for r in db.execute("SELECT package_id, latest_version, name FROM catalog_packages")}
+    upserts = [(package_id, name, version) for key, (package_id, version, name) in latest.items()
+               if current.get(key, (None, None))[0] != version or (name and current[key][1] != name)]
+    removed = [] if merge else [key for key in current if key not in latest]
+    db.executemany("INSERT INTO catalog_packages (package_id, name, latest_version) VALUES (?, ?, ?) "
+                   "ON CONFLICT (package_id) DO UPDATE SET name = COALESCE(excluded.name, name), "
+                   "latest_version = excluded.latest_version, updated_at = CURRENT_TIMESTAMP", upserts)
+    db.executemany("DELETE FROM catalog_packages WHERE package_id = ?", [(key,) for key in removed])
+    db.commit()
+    changed = [package_id for package_id, _, version in upserts if current.get(package_id.lower(), (None,))[0] != version]
+    return changed, removed
+
+
+def refresh_catalog_updates(db, package_ids=None, batch_size=200):
+    """Przelicza aktualizacje z katalogu w ostatnich raportach komputerów, które mają któryś z pakietów
+    package_ids (przy None - wszystkich). Zatwierdza partiami; zwraca (sprawdzone komputery, zmienione)."""
+    if package_ids is None:
+        computer_ids = [r[0] for r in db.execute("SELECT id FROM computers WHERE latest_report_id IS NOT NULL")]
+    else:
+        computer_ids = [r[0] for r in db.execute(
+            "SELECT DISTINCT computer_id FROM fleet_apps WHERE app_id COLLATE NOCASE IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(package_ids)),))]
+    changed = 0
+    for i, computer_id in enumerate(computer_ids, 1):
+        report_id = db.execute("SELECT latest_report_id FROM computers WHERE id = ?", (computer_id,)).fetchone()[0]
+        if not report_id: continue
+        state = load_report_state(db, report_id)
+        computed = []
+        if UPDATE_SOURCE == 'catalog':
+            computed = catalog_updates(db, state['installed_apps'],
+                                       {fleet_app_key(u['id'], u['name']) for u in state['available_app_updates']})
+        current = {(r['app_id'], r['available_version']): r['id'] for r in db.execute(
+            "SELECT id, app_id, available_version FROM updates WHERE report_id = ? AND from_catalog = 1", (report_id,))}
+        wanted = {(u['id'], u['available_version']): u for u in computed}
+        stale = [(row_id,) for key, row_id in current.items() if key not in wanted]
+        added = [(report_id, u['name'], u['id'], u['current_version'], u['available_version'])
+                 for key, u in wanted.items() if key not in current]
+        if stale or added:
+            db.executemany("DELETE FROM updates WHERE id = ?", stale)
+            db.executemany("INSERT INTO updates (report_id, name, app_id, current_version, available_version, "
+                           "update_type, from_catalog) VALUES (?, ?, ?, ?, ?, 'APP', 1)", added)
+            update_fleet_index(db.cursor(), computer_id,
+                               dict(state, available_app_updates=state['available_app_updates'] + computed))
+            # Unieważnia stronę komputera i /report/<id> (obie są wersjonowane przez page_version).
+            bump_page_version(db, computer_id)
+            changed += 1
+        if i % batch_size == 0: db.commit()
+    db.commit()
+    return len(computer_ids), changed
+
+
+@app.cli.command('import-catalog')
+@click.argument('source', type=click.Path(exists=True))
+@click.option('--merge', is_flag=True, help="Tylko dopisz i zaktualizuj pakiety ze źródła, bez usuwania pozostałych.")
+def import_catalog_command(source, merge):
+    """Wczytuje katalog wersji pakietów (kopia repozytorium winget-pkgs, plik JSON albo CSV) i przelicza
+    aktualizacje floty dla pakietów, których wersja się zmieniła."""
+    started = time.perf_counter()
+    try:
+        latest = read_catalog_source(source)
+    except (OSError, ValueError, csv.Error) as e:
+        raise click.ClickException(f"Nie udało się wczytać katalogu {source}: {e}")
+    db = connect_db(timeout=30)
+    changed, removed = import_catalog(db, latest, merge)
+    print(f"Katalog: {len(latest)} pakietów w źródle, zmienionych wersji {len(changed)}, usuniętych {len(removed)} "
+          f"({time.perf_counter() - started:.1f}s).")
+    if UPDATE_SOURCE != 'catalog':
+        print("UPDATE_SOURCE nie jest ustawione na 'catalog' - aktualizacje floty nadal pochodzą od agentów.")
+    elif changed or removed:
+        checked, updated = refresh_catalog_updates(db, changed + removed)
+        print(f"Przeliczono aktualizacje: {checked} komputerów, zmiany u {updated} ({time.perf_counter() - started:.1f}s).")
+    db.close()
+
+
+def apply_report(db, data):
+    """Zapisuje raport w bieżącej transakcji (bez commit). Zwraca (report_id, state_hash) albo None,
+    gdy raport różnicowy nie pasuje do stanu serwera i agent musi wysłać pełny raport."""
+    hostname = data['hostname']
+    is_delta = data.get('mode') == 'delta' and data.get('protocol_version', 1) >= REPORT_PROTOCOL_VERSION
+    cur = db.cursor()
+    computer = cur.execute("SELECT id, latest_report_id FROM computers WHERE hostname = ?", (hostname,)).fetchone()
+    if computer:
+        computer_id = computer['id']
+        cur.execute(
+            "UPDATE computers SET ip_address = ?, reboot_required = COALESCE(?, reboot_required), "
+            "last_report = CURRENT_TIMESTAMP WHERE id = ?",
+            (data.get('ip_address'), data.get('reboot_required'), computer_id))
+    else:
+        cur.execute("INSERT INTO computers (hostname, ip_address, reboot_required) VALUES (?, ?, ?)",
+                    (hostname, data.get('ip_address'), data.get('reboot_required') or False))
+        computer_id = cur.lastrowid
+    previous_report = db.execute("SELECT id, state_hash FROM reports WHERE id = ?",
+                                 (computer['latest_report_id'] if computer else None,)).fetchone()
+    if is_delta:
+        state = None
+        if previous_report and previous_report['state_hash'] == data.get('base_hash'):
+            state = apply_report_delta(load_report_state(db, previous_report['id']), data.get('delta') or {})
+        if state is None or (data.get('state_hash') and compute_state_hash(state) != data['state_hash']):
+            return None
+    else:
+        state = normalize_report_state(data)
+        missing = unreported_sections(data)
+        if missing and previous_report:
+            previous_state = load_report_state(db, previous_report['id'])
+            state.update({section: previous_state[section] for section in missing})
+    state_hash = compute_state_hash(state)
+    snapshot_id = store_app_snapshot(cur, state['installed_apps'])
+    cur.execute("INSERT INTO reports (computer_id, snapshot_id, state_hash) VALUES (?, ?, ?)",
+                (computer_id, snapshot_id, state_hash))
+    report_id = cur.lastrowid
+    cur.execute("UPDATE computers SET latest_report_id = ?, page_version = page_version + 1 WHERE id = ?",
+                (report_id, computer_id))
+    app_updates = state['available_app_updates']
+    computed = []
+    if UPDATE_SOURCE == 'catalog':
+        computed = catalog_updates(db, state['installed_apps'],
+                                   {fleet_app_key(u.get('id'), u.get('name')) for u in app_updates})
+    app_updates_to_insert = [
+        (report_id, upd.get('name'), upd.get('id'), upd.get('current_version'), upd.get('available_version'), from_catalog)
+        for from_catalog, group in ((0, app_updates), (1, computed)) for upd in group]
+    if app_updates_to_insert: cur.executemany(
+        "INSERT INTO updates (report_id, name, app_id, current_version, available_version, update_type, from_catalog) VALUES (?, ?, ?, ?, ?, 'APP', ?)",
+        app_updates_to_insert)
+    os_updates_to_insert = [(report_id, u['Title'], u['KB']) for u in state['pending_os_updates']]
+    if os_updates_to_insert: cur.executemany(
+        "INSERT INTO updates (report_id, name, available_version, update_type) VALUES (?, ?, ?, 'OS')",
+        os_updates_to_insert)
+    if previous_report:
+        old_updates_q = db.execute("SELECT name FROM updates WHERE report_id = ? AND update_type = 'OS'",
+                                   (previous_report['id'],)).fetchall()
+        old_updates = {u['name'] for u in old_updates_q}
+        new_updates = {u['Title'] for u in state['pending_os_updates']}
+        installed_updates = old_updates - new_updates
+
+        for update_name in installed_updates:
+            # Ta sama aktualizacja zgłoszona ponownie w tym samym tygodniu trafia na unikalny klucz i jest pomijana.
+            record_event(cur, computer_id, 'OS_UPDATE_SUCCESS', update_name,
+                         dedupe_key=f"OS_UPDATE_SUCCESS|{update_name}|{int(time.time()) // EVENT_DEDUPE_BUCKET_SECONDS}")
+    # W trybie catalog indeks jest uzgadniany przy każdym raporcie - wyliczone aktualizacje zależą też od katalogu.
+    if not previous_report or previous_report['state_hash'] != state_hash or UPDATE_SOURCE == 'catalog':
+        update_fleet_index(cur, computer_id, dict(state, available_app_updates=app_updates + computed))
+    return report_id, state_hash
+
+
+def validate_report(data):
+    """Szybka kontrola struktury raportu przed zapisem lub kolejkowaniem. Zwraca opis błędu albo None."""
+    if not isinstance(data, dict) or not isinstance(data.get('hostname'), str) or not data['hostname']:
+        return "brak nazwy hosta"
+    if not isinstance(data.get('ip_address'), str): return "brak adresu IP"
+    if data.get('mode') == 'delta':
+        if not isinstance(data.get('delta'), dict): return "brak sekcji delta"
+        return None
+    for section in ('installed_apps', 'available_app_updates'):
+        if not isinstance(data.get(section) or [], list): return f"pole {section} nie jest listą"
+    if not isinstance(data.get('pending_os_updates') or [], (list, dict)): return "pole pending_os_updates ma zły typ"
+    return None
+
+
+# --- Asynchroniczne przyjmowanie raportów (REPORT_INGEST_MODE=async) ---
+# Endpoint tylko sprawdza raport, zapisuje go w katalogu kolejki (przetrwa restart serwera) i odpowiada 202.
+# Jeden wątek zapisujący nakłada raporty na bazę partiami - wiele raportów w jednej transakcji SQLite.
+# Zakłada jeden proces serwera (katalog kolejki nie jest współdzielony między procesami).
+ingest_ready = threading.Condition()
+ingest_pending = collections.deque()  # (ścieżka pliku w kolejce, raport) w kolejności przyjęcia
+ingest_heads = {}  # hostname -> state_hash ostatniego przyjętego raportu (baza dla kolejnej delty)
+ingest_writer = None
+ingest_sequence = itertools.count()
+ingest_stats = {"accepted": 0, "rejected_full": 0, "committed": 0, "failed": 0, "resync": 0, "batches": 0,
+                "last_batch_size": 0, "last_commit_ms": 0.0, "max_commit_ms": 0.0, "total_commit_ms": 0.0}
+
+
+def start_ingest_writer():
+    """Uruchamia wątek zapisujący; najpierw wczytuje raporty, które zostały w kolejce po poprzednim uruchomieniu."""
+    global ingest_writer
+    with ingest_ready:
+        if ingest_writer is not None: return
+        os.makedirs(INGEST_SPOOL_DIR, exist_ok=True)
+        for name in sorted(os.listdir(INGEST_SPOOL_DIR)):
+            if not name.endswith('.json'): continue
+            path = os.path.join(INGEST_SPOOL_DIR, name)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+                ingest_pending.append((path, entry['data']))
+                ingest_heads[entry['data']['hostname']] = entry['state_hash']
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logging.error("Uszkodzony plik w kolejce raportów %s: %s", name, e)
+                os.replace(path, path + '.bad')
+        if ingest_pending:
+            logging.info("Wczytano %d raportów z kolejki na dysku.", len(ingest_pending))
+        ingest_writer = threading.Thread(target=ingest_writer_loop, name="report-ingest", daemon=True)
+        ingest_writer.start()
+
+
+def enqueue_report(data, state_hash):
+    """Dopisuje raport do kolejki. Zwraca False, gdy kolejka jest pełna."""
+    with ingest_ready:
+        if len(ingest_pending) >= INGEST_QUEUE_MAX:
+            ingest_stats['rejected_full'] += 1
+            return False
+        path = os.path.join(INGEST_SPOOL_DIR, f"{time.time_ns():020d}-{next(ingest_sequence):08d}.json")
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({"state_hash": state_hash, "data": data}, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+        ingest_pending.append((path, data))
+        ingest_heads[data['hostname']] = state_hash
+        ingest_stats['accepted'] += 1
+        ingest_ready.notify()
+    return True
+
+
+def ingest_writer_loop():
+    while True:
+        with ingest_ready:
+            while not ingest_pending:
+                ingest_ready.wait()
+            batch = list(itertools.islice(ingest_pending, INGEST_BATCH_MAX))
+        started = time.perf_counter()
+        outcomes = []
+        try:
+            with write_db() as db:
+                db.execute("BEGIN IMMEDIATE")
+                for path, data in batch:
+                    db.execute("SAVEPOINT report")
+                    try:
+                        result = apply_report(db, data)
+                    except Exception as e:
+                        logging.error("Błąd zapisu raportu od %s z kolejki: %s", data.get('hostname'), e, exc_info=True)
+                        result = False
+                    if result:
+                        db.execute("RELEASE report")
+                    else:
+                        db.execute("ROLLBACK TO report")
+                        db.execute("RELEASE report")
+                    outcomes.append(result)
+                db.commit()
+        except sqlite3.Error as e:
+            logging.error("Nie udało się zapisać partii %d raportów - ponowienie: %s", len(batch), e)
+            time.sleep(1)
+            continue
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with ingest_ready:
+            for _ in batch:
+                ingest_pending.popleft()
+            for (path, data), result in zip(batch, outcomes):
+                if result:
+                    ingest_stats['committed'] += 1
+                    continue
+                ingest_stats['resync' if result is None else 'failed'] += 1
+                # Kolejna delta od tego hosta zostanie porównana ze stanem w bazie i dostanie 409 (pełna synchronizacja).
+                ingest_heads.pop(data['hostname'], None)
+                logging.warning("Raport od %s z kolejki odrzucony (%s).", data['hostname'],
+                                "niezgodna delta" if result is None else "błąd zapisu")
+            ingest_stats['batches'] += 1
+            ingest_stats['last_batch_size'] = len(batch)
+            ingest_stats['last_commit_ms'] = round(elapsed_ms, 2)
+            ingest_stats['max_commit_ms'] = round(max(ingest_stats['max_commit_ms'], elapsed_ms), 2)
+            ingest_stats['total_commit_ms'] += elapsed_ms
+            depth = len(ingest_pending)
+        for path, _ in batch:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        logging.info("Zapisano partię %d raportów w %.1f ms (w kolejce: %d).", len(batch), elapsed_ms, depth)
+
+
+def get_ingest_stats():
+    with ingest_ready:
+        stats = dict(ingest_stats, depth=len(ingest_pending), capacity=INGEST_QUEUE_MAX, mode=REPORT_INGEST_MODE)
+    stats['avg_commit_ms'] = round(stats['total_commit_ms'] / stats['batches'], 2) if stats['batches'] else 0.0
+    stats['total_commit_ms'] = round(stats['total_commit_ms'], 2)
+    return stats
+
+
+def accept_report_async(data, db):
+    """Przyjmuje raport do kolejki. Deltę sprawdza względem ostatniego przyjętego (także niezapisanego) stanu."""
+    start_ingest_writer()
+    hostname = data['hostname']
+    if data.get('mode') == 'delta' and data.get('protocol_version', 1) >= REPORT_PROTOCOL_VERSION:
+        with ingest_ready:
+            head = ingest_heads.get(hostname)
+        if head is None:
+            latest = db.execute("""
+                SELECT r.state_hash FROM computers c JOIN reports r ON r.id = c.latest_report_id WHERE c.hostname = ?
+            """, (hostname,)).fetchone()
+            head = latest['state_hash'] if latest else None
+        if not data.get('state_hash') or head is None or head != data.get('base_hash'):
+            logging.warning("Raport różnicowy od %s nie pasuje do stanu serwera - żądanie pełnej synchronizacji.",
+                            hostname)
+            return jsonify({"status": "resync_required"}), 409
+        state_hash = data['state_hash']
+    elif unreported_sections(data):
+        # Pominięte sekcje zostaną uzupełnione z poprzedniego raportu dopiero przy zapisie - skrót nie jest jeszcze
+        # znany, więc agent nie zapamięta stanu i kolejny raport wyśle w całości.
+        state_hash = None
+    else:
+        state_hash = compute_state_hash(normalize_report_state(data))
+    if not enqueue_report(data, state_hash):
+        logging.warning("Kolejka raportów pełna (%d) - odrzucono raport od %s.", INGEST_QUEUE_MAX, hostname)
+        response = jsonify({"status": "busy", "retry_after": INGEST_RETRY_AFTER_SECONDS})
+        response.headers['Retry-After'] = str(INGEST_RETRY_AFTER_SECONDS)
+        return response, 429
+    return jsonify({"status": "queued", "state_hash": state_hash, "protocol_version": REPORT_PROTOCOL_VERSION}), 202
+
+
+def record_agent_timings(data):
+    """Przenosi do metryk czasy kolektorów (collector_stats) i wywołań winget/PowerShell (command_stats) z raportu."""
+    collector_stats, command_stats = data.get('collector_stats'), data.get('command_stats')
+    if isinstance(collector_stats, dict):
+        for key, stat in collector_stats.items():
+            if isinstance(stat, dict) and stat.get('status') != 'cached' and isinstance(stat.get('duration'), (int, float)):
+                observe('winget_agent_collector_duration_seconds', stat['duration'], collector=str(key)[:64],
+                        status=str(stat.get('status'))[:16])
+    if isinstance(command_stats, dict):
+        for command, stat in command_stats.items():
+            if not isinstance(stat, dict): continue
+            try:
+                count, total, failed = int(stat.get('count', 0)), float(stat.get('total', 0)), int(stat.get('failed', 0))
+            except (TypeError, ValueError):
+                continue
+            key = ('winget_agent_command_duration_seconds', (('command', str(command)[:64]),))
+            with metrics_lock:
+                entry = metric_values.setdefault(key, [0.0, 0])
+                entry[0] += total
+                entry[1] += count
+            if failed:
+                inc_metric('winget_agent_command_failures_total', failed, command=str(command)[:64])
+
 
 @app.route('/api/report', methods=['POST'])
 @require_api_key
 def receive_report():
 
     data, db = request.get_json(), get_db()
-    if not data or 'hostname' not in data: return "Bad Request", 400
+    error = validate_report(data)
+    if error:
+        logging.warning("Odrzucono niepoprawny raport: %s", error)
+        return "Bad Request", 400
     hostname = data.get('hostname')
     logging.info(f"Przetwarzanie raportu od: {hostname}")
-    logging.info("[DEBUG] SERVER odebrał raport: installed_apps=%d, available_app_updates=%d, pending_os_updates=%d",
-                 len(data.get("installed_apps", [])),
-                 len(data.get("available_app_updates", [])),
-                 len(data.get("pending_os_updates", [])) if isinstance(data.get("pending_os_updates", []), list) else 1
-                 )
-    # (opcjonalnie, dla podglądu co w środku)
-    logging.info("[DEBUG] Przykład installed_apps: %s",
-                 json.dumps(data.get("installed_apps", [])[:3], ensure_ascii=False))
-    logging.info("[DEBUG] Przykład available_app_updates: %s",
-                 json.dumps(data.get("available_app_updates", [])[:3], ensure_ascii=False))
-    logging.info("[DEBUG] Przykład pending_os_updates: %s",
-                 json.dumps(data.get("pending_os_updates", []), ensure_ascii=False)[:500])
+    # Próbki treści tylko przy LOG_LEVEL=DEBUG - serializacja list przy każdym raporcie sporo kosztuje.
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("SERVER odebrał raport: installed_apps=%d, available_app_updates=%d, pending_os_updates=%d",
+                      len(data.get("installed_apps", [])),
+                      len(data.get("available_app_updates", [])),
+                      len(data.get("pending_os_updates", [])) if isinstance(data.get("pending_os_updates", []), list) else 1
+                      )
+        logging.debug("Przykład installed_apps: %s",
+                      json.dumps(data.get("installed_apps", [])[:3], ensure_ascii=False))
+        logging.debug("Przykład available_app_updates: %s",
+                      json.dumps(data.get("available_app_updates", [])[:3], ensure_ascii=False))
+        logging.debug("Przykład pending_os_updates: %s",
+                      json.dumps(data.get("pending_os_updates", []), ensure_ascii=False)[:500])
+    observe('winget_report_payload_bytes', len(request.get_data()), mode=data.get('mode') or 'full')
+    record_agent_timings(data)
+    if isinstance(data.get('collector_stats'), dict):
+        logging.info("Czasy kolektorów od %s: %s", hostname, ", ".join(
+            f"{k}={v.get('status')}/{v.get('duration')}s" for k, v in data['collector_stats'].items() if isinstance(v, dict)))
+    if data.get('mode') == 'delta':
+        logging.info("Raport różnicowy od %s (bazowy skrót %s)", hostname, data.get('base_hash'))
+    note_report_received()
+    g.schedule_host = (hostname, True)
+    if REPORT_INGEST_MODE == 'async':
+        return accept_report_async(data, db)
     try:
-        cur = db.cursor()
-        computer = cur.execute("SELECT id FROM computers WHERE hostname = ?", (hostname,)).fetchone()
-        if computer:
-            computer_id = computer['id']
-            cur.execute(
-                "UPDATE computers SET ip_address = ?, reboot_required = ?, last_report = CURRENT_TIMESTAMP WHERE id = ?",
-                (data.get('ip_address'), data.get('reboot_required', False), computer_id))
-        else:
-            cur.execute("INSERT INTO computers (hostname, ip_address, reboot_required) VALUES (?, ?, ?)",
-                        (hostname, data.get('ip_address'), data.get('reboot_required', False)))
-            computer_id = cur.lastrowid
-        previous_report = db.execute(
-            "SELECT id FROM reports WHERE computer_id = ? ORDER BY report_timestamp DESC LIMIT 1",
-            (computer_id,)).fetchone()
-        cur.execute("INSERT INTO reports (computer_id) VALUES (?)", (computer_id,))
-        report_id = cur.lastrowid
-        apps_to_insert = [(report_id, app.get('name'), app.get('id'), app.get('version')) for app in
-                          data.get('installed_apps', [])]
-        if apps_to_insert: cur.executemany(
-            "INSERT INTO applications (report_id, name, app_id, version) VALUES (?, ?, ?, ?)", apps_to_insert)
-        app_updates_to_insert = [
-            (report_id, upd.get('name'), upd.get('id'), upd.get('current_version'), upd.get('available_version')) for
-            upd in data.get('available_app_updates', [])]
-        if app_updates_to_insert: cur.executemany(
-            "INSERT INTO updates (report_id, name, app_id, current_version, available_version, update_type) VALUES (?, ?, ?, ?, ?, 'APP')",
-            app_updates_to_insert)
-        os_updates_to_insert = []
-        pending_os_updates = data.get('pending_os_updates', [])
-        if isinstance(pending_os_updates, dict): pending_os_updates = [pending_os_updates]
-        for os_update in pending_os_updates:
-            if not isinstance(os_update, dict): continue
-            kb = ", ".join(os_update.get('KB', [])) if isinstance(os_update.get('KB'), list) else os_update.get('KB',
-                                                                                                                'N/A')
-            title = os_update.get('Title', 'Brak tytułu')
-            os_updates_to_insert.append((report_id, title, kb))
-        if os_updates_to_insert: cur.executemany(
-            "INSERT INTO updates (report_id, name, available_version, update_type) VALUES (?, ?, ?, 'OS')",
-            os_updates_to_insert)
-        if previous_report:
-            old_updates_q = db.execute("SELECT name FROM updates WHERE report_id = ? AND update_type = 'OS'",
-                                       (previous_report['id'],)).fetchall()
-            old_updates = {u['name'] for u in old_updates_q}
-            new_updates_list = [u for u in data.get('pending_os_updates', []) if isinstance(u, dict)]
-            new_updates = {u.get('Title') for u in new_updates_list}
-            installed_updates = old_updates - new_updates
-
-            for update_name in installed_updates:
-                # Sprawdzaj, czy identyczny wpis był już w ostatnich 7 dniach dla tego komputera
-                exists = cur.execute("""
-                    SELECT 1 FROM action_history
-                    WHERE computer_id = ? AND action_type = 'OS_UPDATE_SUCCESS'
-                      AND json_extract(details, '$.name') = ?
-                      AND timestamp > datetime('now', '-7 days')
-                """, (computer_id, update_name)).fetchone()
-                if exists:
-                    continue  # pomiń duplikat
-                cur.execute("INSERT INTO action_history (computer_id, action_type, details) VALUES (?, ?, ?)",
-                            (computer_id, 'OS_UPDATE_SUCCESS', json.dumps({"name": update_name})))
-        db.commit()
+        with write_db() as db:
+            result = apply_report(db, data)
+            if result is None:
+                db.rollback()
+                logging.warning("Raport różnicowy od %s nie pasuje do stanu serwera - żądanie pełnej synchronizacji.",
+                                hostname)
+                return jsonify({"status": "resync_required"}), 409
+            db.commit()
     except Exception as e:
-        db.rollback();
         logging.error(f"Krytyczny błąd podczas przetwarzania raportu od {hostname}: {e}", exc_info=True)
         return "Internal Server Error", 500
-    return "Report received successfully", 200
+    report_id, state_hash = result
+    return jsonify({"status": "success", "report_id": report_id, "state_hash": state_hash,
+                    "protocol_version": REPORT_PROTOCOL_VERSION}), 200
+
+
+@app.route('/api/ingest/stats', methods=['GET'])
+@require_api_key
+def ingest_stats_view():
+    return jsonify(get_ingest_stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Metryki dla Prometheusa; klucz API w nagłówku X-API-Key albo jako token (Authorization: Bearer)."""
+    auth = request.headers.get('Authorization', '')
+    token = auth[7:].strip() if auth.startswith('Bearer ') else request.headers.get('X-API-Key')
+    if not token or token != API_KEY:
+        abort(401)
+    db = get_db()
+    tasks = db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+    ingest = get_ingest_stats()
+    with page_cache_lock:
+        cache = dict(page_cache_stats, size=len(page_cache))
+    gauges = [
+        ('winget_tasks', 'Zadania według statusu.', [({'status': status}, n) for status, n in tasks]),
+        ('winget_computers', 'Liczba komputerów w bazie.', [({}, fleet_size(db))]),
+        ('winget_ingest_queue_depth', 'Raporty w kolejce zapisu (tryb async).', [({}, ingest['depth'])]),
+        ('winget_ingest_reports', 'Raporty kolejki od startu procesu według wyniku.',
+         [({'result': k}, ingest[k]) for k in ('accepted', 'rejected_full', 'committed', 'failed', 'resync')]),
+        ('winget_ingest_pressure', 'Obciążenie przyjmowania raportów (1 = limit).', [({}, round(ingest_pressure(), 3))]),
+        ('winget_page_cache', 'Pamięć podręczna stron panelu od startu procesu.',
+         [({'result': k}, cache[k]) for k in ('hits', 'misses', 'not_modified', 'size')]),
+    ]
+    return Response(render_metrics(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# --- Harmonogram raportów agentów ---
+# Odpowiedzi na raport i na zapytania o zadania niosą nagłówki X-Report-Interval (cykl raportów w sekundach),
+# X-Report-In (sekundy do slotu raportu tego hosta) i X-Slow-Down (mnożnik przerw agenta, 1 = bez zmian).
+# Nagłówki zamiast pól w treści - starsze agenty dalej dostają w /api/tasks zwykłą listę.
+REPORT_RATE_WINDOW_SECONDS = 60
+recent_reports = collections.deque()  # czasy (monotonic) raportów z ostatniego okna
+recent_reports_lock = threading.Lock()
+fleet_size_cache = {'value': 0, 'expires': 0.0}
+
+
+def note_report_received():
+    now = time.monotonic()
+    with recent_reports_lock:
+        recent_reports.append(now)
+        while recent_reports[0] < now - REPORT_RATE_WINDOW_SECONDS:
+            recent_reports.popleft()
+
+
+def ingest_pressure():
+    """Obciążenie przyjmowania raportów: 1.0 = tempo REPORT_MAX_RATE albo pełna kolejka (tryb async)."""
+    now = time.monotonic()
+    with recent_reports_lock:
+        while recent_reports and recent_reports[0] < now - REPORT_RATE_WINDOW_SECONDS:
+            recent_reports.popleft()
+        pressure = len(recent_reports) / REPORT_RATE_WINDOW_SECONDS / REPORT_MAX_RATE
+    if REPORT_INGEST_MODE == 'async':
+        with ingest_ready:
+            pressure = max(pressure, len(ingest_pending) / INGEST_QUEUE_MAX)
+    return pressure
+
+
+def fleet_size(db):
+    now = time.monotonic()
+    if fleet_size_cache['expires'] <= now:
+        fleet_size_cache['value'] = db.execute("SELECT COUNT(*) FROM computers").fetchone()[0]
+        fleet_size_cache['expires'] = now + 60
+    return fleet_size_cache['value']
+
+
+def host_slot(hostname, span):
+    """Stałe dla hosta przesunięcie z zakresu [0, span) - slot nie zmienia się po restarcie agenta ani serwera."""
+    digest = hashlib.sha256(hostname.lower().encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % span if span > 0 else 0
+
+
+def report_schedule(db, hostname, known=True):
+    """Zwraca (cykl raportów, sekundy do slotu raportu hosta, mnożnik spowolnienia)."""
+    interval = max(REPORT_MIN_INTERVAL_SECONDS, math.ceil(fleet_size(db) / REPORT_MAX_RATE))
+    window = interval if known else min(REPORT_NEW_HOST_WINDOW_SECONDS, interval)
+    offset = host_slot(hostname, window)
+    report_in = (offset - int(time.time())) % window
+    slow_down = min(REPORT_MAX_SLOW_DOWN, max(1.0, round(ingest_pressure(), 1)))
+    if slow_down > 1:
+        # Pod obciążeniem raporty rozkładają się na slow_down razy dłuższy okres (przesunięcie zależne od hosta).
+        report_in += int(offset * (slow_down - 1))
+    return interval, report_in, slow_down
+
+
+@app.after_request
+def add_report_schedule_headers(response):
+    if 'schedule_host' in g and response.status_code < 500:
+        hostname, known = g.schedule_host
+        try:
+            interval, report_in, slow_down = report_schedule(get_db(), hostname, known)
+            response.headers['X-Update-Source'] = effective_update_source(get_db())
+        except sqlite3.Error as e:
+            logging.warning("Nie udało się wyznaczyć harmonogramu raportów dla %s: %s", hostname, e)
+            return response
+        response.headers['X-Report-Interval'] = str(interval)
+        response.headers['X-Report-In'] = str(report_in)
+        response.headers['X-Slow-Down'] = f"{slow_down:g}"
+    return response
+
+# --- Powiadamianie czekających agentów o nowych zadaniach ---
+task_signal = threading.Condition()
+task_generation = {}  # computer_id -> licznik zmieniany przy każdym zleceniu zadania
+long_poll_slots = threading.BoundedSemaphore(TASK_LONG_POLL_MAX_WAITERS)
+
+
+def notify_task_queued(computer_id):
+    with task_signal:
+        task_generation[computer_id] = task_generation.get(computer_id, 0) + 1
+        task_signal.notify_all()
+
+
+def claim_pending_tasks(db, computer_id):
+    """Oznacza oczekujące zadania komputera jako 'w toku' i zwraca te, które udało się przejąć.
+
+    Sprawdzenie idzie przez połączenie do odczytu `db`; po połączenie zapisujące sięgamy tylko, gdy jest co przejąć.
+    """
+    tasks = db.execute("SELECT id, command, payload FROM tasks WHERE computer_id = ? AND status = 'oczekuje'",
+                       (computer_id,)).fetchall()
+    if not tasks: return []
+    claimed = []
+    with write_db() as writer:
+        for t in tasks:
+            cur = writer.execute("UPDATE tasks SET status = 'w toku', updated_at = CURRENT_TIMESTAMP "
+                                 "WHERE id = ? AND status = 'oczekuje'", (t['id'],))
+            if cur.rowcount: claimed.append(dict(t))
+        writer.commit()
+    return claimed
+
 
 @app.route('/computer/<int:computer_id>/update', methods=['POST'])
 def request_update(computer_id):
-    data, db = request.get_json(), get_db()
-    db.execute("INSERT INTO tasks (computer_id, command, payload) VALUES (?, ?, ?)",
-               (computer_id, 'update_package', data.get('package_id')))
-    db.execute("UPDATE updates SET status = 'Oczekuje' WHERE id = ?", (data.get('update_id'),))
-    db.commit()
+    data = request.get_json()
+    if not is_dispatchable_package_id(data.get('package_id')):
+        return jsonify({"status": "error", "message": "Identyfikator pakietu jest pusty albo skrócony przez winget."}), 400
+    with write_db() as db:
+        db.execute("INSERT INTO tasks (computer_id, command, payload) VALUES (?, ?, ?)",
+                   (computer_id, 'update_package', data.get('package_id')))
+        db.execute("UPDATE updates SET status = 'Oczekuje' WHERE id = ?", (data.get('update_id'),))
+        bump_page_version(db, computer_id)
+        db.commit()
+    notify_task_queued(computer_id)
     return jsonify({"status": "success", "message": "Zadanie aktualizacji zlecone"})
 
 
 @app.route('/computer/<int:computer_id>/uninstall', methods=['POST'])
 def request_uninstall(computer_id):
-    data, db = request.get_json(), get_db()
-    if not db.execute("SELECT id FROM computers WHERE id = ?", (computer_id,)).fetchone(): abort(404)
-    db.execute("INSERT INTO tasks (computer_id, command, payload) VALUES (?, ?, ?)",
-               (computer_id, 'uninstall_package', data.get('package_id')))
-    db.commit()
+    data = request.get_json()
+    if not get_db().execute("SELECT id FROM computers WHERE id = ?", (computer_id,)).fetchone(): abort(404)
+    if not is_dispatchable_package_id(data.get('package_id')):
+        return jsonify({"status": "error", "message": "Identyfikator pakietu jest pusty albo skrócony przez winget."}), 400
+    with write_db() as db:
+        db.execute("INSERT INTO tasks (computer_id, command, payload) VALUES (?, ?, ?)",
+                   (computer_id, 'uninstall_package', data.get('package_id')))
+        bump_page_version(db, computer_id)
+        db.commit()
+    notify_task_queued(computer_id)
     return jsonify({"status": "success", "message": "Zadanie deinstalacji zlecone"})
 
 
 @app.route('/computer/<int:computer_id>/refresh', methods=['POST'])
 def request_refresh(computer_id):
-    db = get_db()
-    if not db.execute("SELECT id FROM computers WHERE id = ?", (computer_id,)).fetchone(): abort(404)
-    db.execute("INSERT INTO tasks (computer_id, command, payload) VALUES (?, ?, ?)",
-               (computer_id, 'force_report', '{}'))
-    db.commit()
+    if not get_db().execute("SELECT id FROM computers WHERE id = ?", (computer_id,)).fetchone(): abort(404)
+    with write_db() as db:
+        db.execute("INSERT INTO tasks (computer_id, command, payload) VALUES (?, ?, ?)",
+                   (computer_id, 'force_report', '{}'))
+        bump_page_version(db, computer_id)
+        db.commit()
+    notify_task_queued(computer_id)
     return jsonify({"status": "success", "message": "Zadanie odświeżenia zlecone"})
 
 
@@ -276,33 +1976,73 @@ def request_refresh(computer_id):
 def get_tasks(hostname):
     db = get_db()
     computer = db.execute("SELECT id FROM computers WHERE hostname = ?", (hostname,)).fetchone()
+    g.schedule_host = (hostname, computer is not None)
     if not computer: return jsonify([])
-    tasks = db.execute("SELECT id, command, payload FROM tasks WHERE computer_id = ? AND status = 'oczekuje'",
-                       (computer['id'],)).fetchall()
-    if tasks:
-        db.executemany("UPDATE tasks SET status = 'w toku', updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                       [(t['id'],) for t in tasks])
-        db.commit()
-    return jsonify([dict(row) for row in tasks])
+    return jsonify(claim_pending_tasks(db, computer['id']))
 
 
-@app.route('/api/tasks/result', methods=['POST'])
+def long_poll_response(tasks, held):
+    response = jsonify(tasks)
+    response.headers['X-Long-Poll'] = '1' if held else '0'
+    return response
+
+
+@app.route('/api/tasks/<hostname>/wait', methods=['GET'])
 @require_api_key
-def task_result():
-    data, db = request.get_json(), get_db()
-    task_id, status = data.get('task_id'), data.get('status')
-    if not task_id or not status: return "Bad Request", 400
+def wait_for_tasks(hostname):
+    """Long-poll: trzyma żądanie, aż dla komputera pojawi się zadanie albo minie ?timeout= sekund."""
+    db = get_db()
+    computer = db.execute("SELECT id FROM computers WHERE hostname = ?", (hostname,)).fetchone()
+    g.schedule_host = (hostname, computer is not None)
+    # X-Long-Poll: 1 tylko wtedy, gdy serwer faktycznie mógł trzymać żądanie - w pozostałych przypadkach
+    # odpowiedź wraca od razu i agent musi odczekać zwykłą przerwę, zamiast od razu pytać ponownie.
+    if not computer: return long_poll_response([], held=False)
+    computer_id = computer['id']
+    timeout = min(max(request.args.get('timeout', 30, type=int), 0), TASK_LONG_POLL_MAX_SECONDS)
+    if not long_poll_slots.acquire(blocking=False):
+        # Wszystkie miejsca na long-poll zajęte: zadania od razu, a agent wraca do zwykłego odpytywania co
+        # LOOP_INTERVAL, dopóki miejsce się nie zwolni.
+        inc_metric('winget_long_poll_rejected_total')
+        return long_poll_response(claim_pending_tasks(db, computer_id), held=False)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            with task_signal:
+                seen = task_generation.get(computer_id, 0)
+            tasks = claim_pending_tasks(db, computer_id)
+            remaining = deadline - time.monotonic()
+            if tasks or remaining <= 0:
+                return long_poll_response(tasks, held=timeout > 0)
+            # Ponowne sprawdzenie bazy co kilka sekund wyłapuje zadania dodane przez inny proces serwera.
+            with task_signal:
+                task_signal.wait_for(lambda: task_generation.get(computer_id, 0) != seen,
+                                     timeout=min(remaining, TASK_LONG_POLL_RECHECK_SECONDS))
+    finally:
+        long_poll_slots.release()
+
+
+def seconds_or_none(value):
+    try:
+        return round(float(value), 1) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def record_task_result(db, task_id, status, data):
+    """Zapisuje wynik zadania i zdarzenie w dzienniku. Zwraca (komunikat, id komputerów do powiadomienia) albo None."""
     task = db.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
-    if not task: return "Task not found", 404
-    db.execute("UPDATE tasks SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (status, task_id))
+    if not task: return None
+    db.execute("UPDATE tasks SET status = ?, updated_at = CURRENT_TIMESTAMP, duration_seconds = ?, queue_wait_seconds = ? "
+               "WHERE id = ?", (status, seconds_or_none(data.get('duration')), seconds_or_none(data.get('queue_wait')), task_id))
     computer_id, command, package_id = task['computer_id'], task['command'], task['payload']
-    latest_report_q = db.execute("SELECT id FROM reports WHERE computer_id = ? ORDER BY report_timestamp DESC LIMIT 1",
-                                 (computer_id,)).fetchone()
-    if not latest_report_q:
+    bump_page_version(db, computer_id)
+    released = advance_rollout(db, task['rollout_id']) if task['rollout_id'] else []
+    computer = db.execute("SELECT latest_report_id FROM computers WHERE id = ?", (computer_id,)).fetchone()
+    latest_report_id = computer['latest_report_id'] if computer else None
+    if not latest_report_id:
         db.commit()
-        return "Result received, but no report found to enrich data.", 200
-    latest_report_id = latest_report_q['id']
-    action_type, details_dict = "", {}
+        return "Result received, but no report found to enrich data.", released
+    action_type, event = "", {}
     if command == 'update_package':
         app_details = db.execute(
             "SELECT name, current_version, available_version FROM updates WHERE report_id = ? AND app_id = ?",
@@ -310,41 +2050,333 @@ def task_result():
         app_name = app_details['name'] if app_details else package_id
         if status == 'zakończone' and app_details:
             action_type = 'APP_UPDATE_SUCCESS'
-            details_dict = {"name": app_name, "from": app_details['current_version'],
-                            "to": app_details['available_version']}
+            event = {"from_version": app_details['current_version'], "to_version": app_details['available_version']}
         else:
             action_type = 'APP_UPDATE_FAILURE'
-            details_dict = {"name": app_name}
             db.execute("UPDATE updates SET status = 'Niepowodzenie' WHERE report_id = ? AND app_id = ?",
                        (latest_report_id, package_id))
     elif command == 'uninstall_package':
-        app_info = db.execute("SELECT name FROM applications WHERE report_id = ? AND app_id = ?",
+        app_info = db.execute("SELECT name FROM report_applications WHERE report_id = ? AND app_id = ?",
                               (latest_report_id, package_id)).fetchone()
-        app_name_to_uninstall = app_info['name'] if app_info else package_id
+        app_name = app_info['name'] if app_info else package_id
         action_type = 'APP_UNINSTALL_SUCCESS' if status == 'zakończone' else 'APP_UNINSTALL_FAILURE'
-        details_dict = {"name": app_name_to_uninstall}
     if action_type:
-        db.execute("INSERT INTO action_history (computer_id, action_type, details) VALUES (?, ?, ?)",
-                   (computer_id, action_type, json.dumps(details_dict)))
+        # Powtórzone zgłoszenie wyniku tego samego zadania nie dubluje wpisu (klucz task|<id>).
+        record_event(db.cursor(), computer_id, action_type, app_name, task_id=task_id, dedupe_key=f"task|{task_id}",
+                     **event)
     db.commit()
-    return "Result received", 200
+    return "Result received", released
+
+
+@app.route('/api/tasks/result', methods=['POST'])
+@require_api_key
+def task_result():
+    data = request.get_json()
+    task_id, status = data.get('task_id'), data.get('status')
+    if not task_id or not status: return "Bad Request", 400
+    with write_db() as db:
+        result = record_task_result(db, task_id, status, data)
+    if result is None: return "Task not found", 404
+    message, released = result
+    for cid in released: notify_task_queued(cid)
+    return message, 200
+
+
+# --- Wdrożenia zbiorcze ---
+# Wszystkie zadania wdrożenia powstają w jednej transakcji ze statusem 'wstrzymane' (agent ich nie pobiera)
+# i numerem fali. advance_rollout() zwalnia je do 'oczekuje': kolejna fala rusza dopiero po zakończeniu
+# poprzedniej, a w obrębie fali naraz działa najwyżej max_concurrent instalacji. Funkcja jest wołana przy
+# każdym wyniku zadania, więc wdrożenie postępuje samo, a po przekroczeniu progu błędów zatrzymuje się.
+# Zadania bez wyniku dłużej niż ROLLOUT_TASK_TIMEOUT_MINUTES są uznawane za nieudane (nadzór co minutę).
+rollout_watchdog = None
+
+def rollout_progress(db, rollout_id):
+    row = db.execute("""
+        SELECT COUNT(*) AS total, TOTAL(status = 'zakończone') AS succeeded,
+               TOTAL(status IN ('oczekuje', 'w toku')) AS running, TOTAL(status = 'wstrzymane') AS held,
+               TOTAL(status = 'anulowane') AS cancelled
+        FROM tasks WHERE rollout_id = ?
+    """, (rollout_id,)).fetchone()
+    progress = {key: int(row[key]) for key in row.keys()}
+    progress['failed'] = progress['total'] - sum(progress[k] for k in ('succeeded', 'running', 'held', 'cancelled'))
+    return progress
+
+
+def stop_rollout(db, rollout_id, status):
+    """Kończy wdrożenie ze statusem 'zatrzymane'/'anulowane'; niezwolnione zadania są anulowane (bez commit)."""
+    held = db.execute("SELECT t.id, t.computer_id, c.latest_report_id, t.payload FROM tasks t "
+                      "JOIN computers c ON c.id = t.computer_id WHERE t.rollout_id = ? AND t.status = 'wstrzymane'",
+                      (rollout_id,)).fetchall()
+    db.executemany("UPDATE tasks SET status = 'anulowane', updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                   [(t['id'],) for t in held])
+    db.executemany("UPDATE updates SET status = 'Do uaktualnienia' WHERE report_id = ? AND app_id = ? AND status = 'Oczekuje'",
+                   [(t['latest_report_id'], t['payload']) for t in held])
+    db.executemany("UPDATE computers SET page_version = page_version + 1 WHERE id = ?", [(t['computer_id'],) for t in held])
+    db.execute("UPDATE rollouts SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?", (status, rollout_id))
+
+
+def expire_rollout_tasks(db, rollout_id):
+    """Oznacza jako 'błąd' zadania wdrożenia bez wyniku dłużej niż ROLLOUT_TASK_TIMEOUT_MINUTES (bez commit).
+
+    Wynik, który agent przyśle później, nadpisze ten status jak zwykle. Zwraca liczbę wygaszonych zadań.
+    """
+    if ROLLOUT_TASK_TIMEOUT_MINUTES <= 0: return 0
+    stale = db.execute("""
+        SELECT t.id, t.computer_id, t.status, t.payload, c.latest_report_id,
+               COALESCE((SELECT u.name FROM updates u WHERE u.report_id = c.latest_report_id AND u.app_id = t.payload),
+                        t.payload) AS name
+        FROM tasks t JOIN computers c ON c.id = t.computer_id
+        WHERE t.rollout_id = ? AND t.status IN ('oczekuje', 'w toku') AND t.updated_at < datetime('now', ?)
+    """, (rollout_id, f'-{ROLLOUT_TASK_TIMEOUT_MINUTES} minutes')).fetchall()
+    cur = db.cursor()
+    expired = 0
+    for t in stale:
+        # Warunek na status: agent mógł w międzyczasie przejąć zadanie albo przysłać wynik.
+        cur.execute("UPDATE tasks SET status = 'błąd', updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = ?",
+                    (t['id'], t['status']))
+        if not cur.rowcount: continue
+        cur.execute("UPDATE updates SET status = 'Niepowodzenie' WHERE report_id = ? AND app_id = ?",
+                    (t['latest_report_id'], t['payload']))
+        record_event(cur, t['computer_id'], 'APP_UPDATE_FAILURE', t['name'], task_id=t['id'],
+                     dedupe_key=f"task|{t['id']}|timeout")
+        bump_page_version(db, t['computer_id'])
+        expired += 1
+    if expired:
+        logging.warning("Wdrożenie %s: %d zadań bez wyniku od %d min oznaczono jako nieudane.",
+                        rollout_id, expired, ROLLOUT_TASK_TIMEOUT_MINUTES)
+    return expired
+
+
+def advance_rollout(db, rollout_id):
+    """Zwalnia kolejne zadania wdrożenia, zatrzymuje je po przekroczeniu progu błędów albo oznacza jako zakończone.
+
+    Działa w bieżącej transakcji (bez commit); zwraca id komputerów, którym zwolniono zadania (do powiadomienia).
+    """
+    rollout = db.execute("SELECT * FROM rollouts WHERE id = ?", (rollout_id,)).fetchone()
+    if not rollout or rollout['status'] != 'aktywne': return []
+    expire_rollout_tasks(db, rollout_id)
+    progress = rollout_progress(db, rollout_id)
+    finished = progress['succeeded'] + progress['failed']
+    if (finished >= min(ROLLOUT_MIN_RESULTS, progress['total'])
+            and progress['failed'] > rollout['failure_threshold'] * finished):
+        stop_rollout(db, rollout_id, 'zatrzymane')
+        logging.warning("Wdrożenie %s (%s) zatrzymane: %d błędów na %d zakończonych zadań.",
+                        rollout_id, rollout['package_id'], progress['failed'], finished)
+        return []
+    if not progress['held'] and not progress['running']:
+        db.execute("UPDATE rollouts SET status = 'zakończone', finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                   (rollout_id,))
+        return []
+    free_slots = rollout['max_concurrent'] - progress['running']
+    if free_slots <= 0: return []
+    wave = db.execute("SELECT MIN(wave) FROM tasks WHERE rollout_id = ? AND status IN ('wstrzymane', 'oczekuje', 'w toku')",
+                      (rollout_id,)).fetchone()[0]
+    released = db.execute("SELECT id, computer_id FROM tasks WHERE rollout_id = ? AND wave = ? AND status = 'wstrzymane' "
+                          "ORDER BY id LIMIT ?", (rollout_id, wave, free_slots)).fetchall()
+    db.executemany("UPDATE tasks SET status = 'oczekuje', updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                   [(t['id'],) for t in released])
+    return [t['computer_id'] for t in released]
+
+
+def rollout_watchdog_loop():
+    """Co minutę przelicza aktywne wdrożenia, żeby wygasić zadania komputerów, które nie odpowiadają -
+    advance_rollout() wołane przy wynikach zadań nie ruszy, gdy żaden wynik już nie przyjdzie."""
+    while True:
+        time.sleep(ROLLOUT_WATCHDOG_INTERVAL_SECONDS)
+        try:
+            db = get_db()
+            for row in db.execute("SELECT id FROM rollouts WHERE status = 'aktywne'").fetchall():
+                with write_db() as writer:
+                    released = advance_rollout(writer, row['id'])
+                    writer.commit()
+                for cid in released: notify_task_queued(cid)
+        except Exception as e:
+            logging.error("Błąd nadzoru wdrożeń: %s", e, exc_info=True)
+
+
+def start_rollout_watchdog():
+    """Uruchamia (raz na proces) nadzór wdrożeń, jeśli ustawiono ROLLOUT_TASK_TIMEOUT_MINUTES."""
+    global rollout_watchdog
+    if rollout_watchdog is not None or ROLLOUT_TASK_TIMEOUT_MINUTES <= 0: return
+    rollout_watchdog = threading.Thread(target=rollout_watchdog_loop, name="rollout-watchdog", daemon=True)
+    rollout_watchdog.start()
+
+
+def create_rollout(db, package_id, wave_size, max_concurrent, failure_threshold):
+    """Zleca aktualizację package_id na wszystkich komputerach, które mają ją oczekującą (wg indeksu floty).
+
+    Pomija komputery z niezakończonym zadaniem aktualizacji tego pakietu. Zwraca id wdrożenia albo None,
+    gdy nie ma komputerów do zaktualizowania.
+    """
+    targets = db.execute("""
+        SELECT fu.computer_id, fu.name, c.latest_report_id
+        FROM fleet_updates fu JOIN computers c ON c.id = fu.computer_id
+        WHERE fu.update_type = 'APP' AND fu.app_key = ? AND fu.app_id = ?
+          AND NOT EXISTS (SELECT 1 FROM tasks t WHERE t.computer_id = fu.computer_id
+                          AND t.status IN ('oczekuje', 'w toku', 'wstrzymane')
+                          AND t.command = 'update_package' AND t.payload = fu.app_id)
+        ORDER BY c.hostname COLLATE NOCASE
+    """, (package_id, package_id)).fetchall()
+    if not targets: return None
+    cur = db.cursor()
+    cur.execute("INSERT INTO rollouts (package_id, name, wave_size, max_concurrent, failure_threshold) VALUES (?, ?, ?, ?, ?)",
+                (package_id, targets[0]['name'], wave_size, max_concurrent, failure_threshold))
+    rollout_id = cur.lastrowid
+    cur.executemany("INSERT INTO tasks (computer_id, command, payload, status, rollout_id, wave) "
+                    "VALUES (?, 'update_package', ?, 'wstrzymane', ?, ?)",
+                    [(t['computer_id'], package_id, rollout_id, i // wave_size) for i, t in enumerate(targets)])
+    cur.executemany("UPDATE updates SET status = 'Oczekuje' WHERE report_id = ? AND app_id = ?",
+                    [(t['latest_report_id'], package_id) for t in targets])
+    cur.executemany("UPDATE computers SET page_version = page_version + 1 WHERE id = ?",
+                    [(t['computer_id'],) for t in targets])
+    released = advance_rollout(db, rollout_id)
+    db.commit()
+    for cid in released: notify_task_queued(cid)
+    logging.info("Wdrożenie %s: %s na %d komputerach (fale po %d, równolegle %d, próg błędów %.0f%%).",
+                 rollout_id, package_id, len(targets), wave_size, max_concurrent, failure_threshold * 100)
+    return rollout_id
+
+
+def rollout_summary(db, rollout_id=None):
+    """Wdrożenia (wszystkie albo jedno) z licznikami zadań według stanu."""
+    rows = db.execute(f"""
+        SELECT r.*, COUNT(t.id) AS total, TOTAL(t.status = 'zakończone') AS succeeded,
+               TOTAL(t.status IN ('oczekuje', 'w toku')) AS running, TOTAL(t.status = 'wstrzymane') AS held,
+               TOTAL(t.status = 'anulowane') AS cancelled,
+               COUNT(t.id) - TOTAL(t.status IN ('zakończone', 'oczekuje', 'w toku', 'wstrzymane', 'anulowane')) AS failed
+        FROM rollouts r LEFT JOIN tasks t ON t.rollout_id = r.id
+        {'WHERE r.id = ?' if rollout_id else ''}
+        GROUP BY r.id ORDER BY r.id DESC
+    """, (rollout_id,) if rollout_id else ()).fetchall()
+    return [dict(r, **{k: int(r[k]) for k in ('succeeded', 'running', 'held', 'cancelled', 'failed')}) for r in rows]
+
+
+def rollout_waves(db, rollout_id):
+    return db.execute("""
+        SELECT wave, COUNT(*) AS total, TOTAL(status = 'zakończone') AS succeeded,
+               TOTAL(status IN ('oczekuje', 'w toku')) AS running, TOTAL(status = 'wstrzymane') AS held,
+               TOTAL(status = 'anulowane') AS cancelled
+        FROM tasks WHERE rollout_id = ? GROUP BY wave ORDER BY wave
+    """, (rollout_id,)).fetchall()
+
+
+def parse_rollout_params(data, threshold_scale=1.0):
+    """Parametry wdrożenia z formularza/JSON. Zwraca (package_id, wave_size, max_concurrent, próg 0-1) albo ValueError."""
+    package_id = (data.get('package_id') or '').strip()
+    wave_size = int(data['wave_size']) if data.get('wave_size') not in (None, '') else 50
+    max_concurrent = int(data['max_concurrent']) if data.get('max_concurrent') not in (None, '') else 20
+    raw_threshold = data.get('failure_threshold')
+    failure_threshold = 0.1 if raw_threshold in (None, '') else float(raw_threshold) / threshold_scale
+    if not package_id: raise ValueError("Brak package_id.")
+    if not is_dispatchable_package_id(package_id): raise ValueError("Identyfikator pakietu został skrócony przez winget.")
+    if wave_size < 1 or max_concurrent < 1: raise ValueError("Rozmiar fali i limit równoległości muszą być >= 1.")
+    if not 0 <= failure_threshold <= 1: raise ValueError("Próg błędów musi mieścić się w zakresie 0-100%.")
+    return package_id, wave_size, max_concurrent, failure_threshold
+
+
+@app.route('/rollouts', methods=['GET', 'POST'])
+def rollouts():
+    db = get_db()
+    if request.method == 'POST':
+        try:
+            params = parse_rollout_params(request.form, threshold_scale=100.0)
+        except ValueError as e:
+            return str(e), 400
+        with write_db() as writer:
+            rollout_id = create_rollout(writer, *params)
+        if not rollout_id: return "Brak komputerów z oczekującą aktualizacją tego pakietu.", 409
+        return redirect(url_for('rollout_details', rollout_id=rollout_id))
+    return render_template('rollouts.html', rollouts=rollout_summary(db))
+
+
+@app.route('/rollout/<int:rollout_id>')
+def rollout_details(rollout_id):
+    db = get_db()
+    summary = rollout_summary(db, rollout_id)
+    if not summary: abort(404)
+    tasks = db.execute("""
+        SELECT t.id, t.wave, t.status, t.updated_at, t.duration_seconds, t.queue_wait_seconds, c.hostname
+        FROM tasks t JOIN computers c ON c.id = t.computer_id WHERE t.rollout_id = ? ORDER BY t.wave, t.id
+    """, (rollout_id,)).fetchall()
+    return render_template('rollout.html', rollout=summary[0], waves=rollout_waves(db, rollout_id), tasks=tasks)
+
+
+@app.route('/rollout/<int:rollout_id>/cancel', methods=['POST'])
+def rollout_cancel(rollout_id):
+    with write_db() as db:
+        rollout = db.execute("SELECT status FROM rollouts WHERE id = ?", (rollout_id,)).fetchone()
+        if not rollout: abort(404)
+        if rollout['status'] == 'aktywne':
+            stop_rollout(db, rollout_id, 'anulowane')
+            db.commit()
+    return redirect(url_for('rollout_details', rollout_id=rollout_id))
+
+
+@app.route('/api/rollouts', methods=['GET', 'POST'])
+@require_api_key
+def api_rollouts():
+    db = get_db()
+    if request.method == 'GET':
+        return jsonify(rollout_summary(db))
+    try:
+        params = parse_rollout_params(request.get_json() or {})
+    except (ValueError, TypeError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    with write_db() as writer:
+        rollout_id = create_rollout(writer, *params)
+    if not rollout_id:
+        return jsonify({"status": "error", "message": "Brak komputerów z oczekującą aktualizacją tego pakietu."}), 409
+    return jsonify(rollout_summary(db, rollout_id)[0]), 201
+
+
+@app.route('/api/rollouts/<int:rollout_id>', methods=['GET'])
+@require_api_key
+def api_rollout(rollout_id):
+    db = get_db()
+    summary = rollout_summary(db, rollout_id)
+    if not summary: abort(404)
+    return jsonify(dict(summary[0], waves=[dict(w) for w in rollout_waves(db, rollout_id)]))
+
+
+@app.route('/api/rollouts/<int:rollout_id>/cancel', methods=['POST'])
+@require_api_key
+def api_rollout_cancel(rollout_id):
+    with write_db() as db:
+        rollout = db.execute("SELECT status FROM rollouts WHERE id = ?", (rollout_id,)).fetchone()
+        if not rollout: abort(404)
+        if rollout['status'] == 'aktywne':
+            stop_rollout(db, rollout_id, 'anulowane')
+            db.commit()
+    return jsonify(rollout_summary(get_db(), rollout_id)[0])
+
+
+def text_download(generate, filename, *args):
+    """Plik tekstowy wysyłany strumieniowo - kolejne fragmenty trafiają do klienta w miarę generowania.
+
+    Generator dostaje własne połączenie do odczytu: strumień trwa jeszcze po zakończeniu żądania.
+    """
+    def chunks():
+        db = open_read_connection()
+        try:
+            yield from generate(db, *args)
+        finally:
+            db.close()
+    return Response(chunks(), mimetype='text/plain; charset=utf-8',
+                    headers={"Content-disposition": f"attachment; filename={filename}"})
 
 
 @app.route('/report/computer/<int:computer_id>')
 def report_single(computer_id):
     computer = get_db().execute("SELECT hostname FROM computers WHERE id = ?", (computer_id,)).fetchone()
     if not computer: abort(404)
-    content = generate_report_content([computer_id])
     filename = f"report_{computer['hostname']}_{datetime.now().strftime('%Y%m%d')}.txt"
-    return Response(content, mimetype='text/plain', headers={"Content-disposition": f"attachment; filename={filename}"})
+    return text_download(generate_report_content, filename, [computer_id])
 
 
 @app.route('/report/all')
 def report_all():
-    computer_ids = [c['id'] for c in get_db().execute("SELECT id FROM computers ORDER BY hostname").fetchall()]
-    content = generate_report_content(computer_ids)
     filename = f"report_zbiorczy_{datetime.now().strftime('%Y%m%d')}.txt"
-    return Response(content, mimetype='text/plain', headers={"Content-disposition": f"attachment; filename={filename}"})
+    return text_download(generate_report_content, filename)
 
 
 @app.route('/report/snapshot/<int:report_id>')
@@ -353,189 +2385,367 @@ def report_snapshot(report_id):
         "SELECT c.hostname FROM reports r JOIN computers c ON r.computer_id = c.id WHERE r.id = ?",
         (report_id,)).fetchone()
     if not report: abort(404)
-    content = generate_snapshot_report_content(report_id)
     filename = f"report_snapshot-{report_id}_{report['hostname']}_{datetime.now().strftime('%Y%m%d')}.txt"
-    return Response(content, mimetype='text/plain', headers={"Content-disposition": f"attachment; filename={filename}"})
-
-
-def generate_report_content(computer_ids):
-    db, content = get_db(), []
-    for cid in computer_ids:
-        computer = db.execute("SELECT * FROM computers WHERE id = ?", (cid,)).fetchone()
-        if not computer: continue
-        content.append(f"# RAPORT DLA KOMPUTERA: {computer['hostname']} ({computer['ip_address']})")
-        content.append(f"Data wygenerowania: {datetime.now(ZoneInfo('Europe/Warsaw')).strftime('%Y-%m-%d %H:%M:%S')}")
-        content.append("")
-        content.append("## Dziennik Zdarzeń (ostatnie 20, bez powtórek)")
-        history = db.execute(
-            "SELECT timestamp, action_type, details FROM action_history WHERE computer_id = ? ORDER BY timestamp DESC",
-            (cid,)).fetchall()
-        # FILTR NA UNIKALNE ZDARZENIA:
-        seen = set()
-        unique_events = []
-        for item in history:
-            details = json.loads(item['details'])
-            # Możesz zbudować klucz z typu zdarzenia i nazwy aktualizacji
-            key = (item['action_type'], details.get('name', ''))
-            if key not in seen:
-                seen.add(key)
-                unique_events.append(item)
-            if len(unique_events) >= 20:  # limit jak wcześniej
-                break
-        if unique_events:
-            for item in unique_events:
-                details = json.loads(item['details'])
-                log_entry = f"* [{to_local_time_filter(item['timestamp'])}] "
-                if item['action_type'] == 'APP_UPDATE_SUCCESS':
-                    log_entry += f"Sukces aktualizacji: {details.get('name', '')} (z {details.get('from', '?')} do {details.get('to', '?')})"
-                elif item['action_type'] == 'APP_UPDATE_FAILURE':
-                    log_entry += f"Błąd aktualizacji: {details.get('name', '')}"
-                elif item['action_type'] == 'APP_UNINSTALL_SUCCESS':
-                    log_entry += f"Sukces deinstalacji: {details.get('name', '')}"
-                elif item['action_type'] == 'APP_UNINSTALL_FAILURE':
-                    log_entry += f"Błąd deinstalacji: {details.get('name', '')}"
-                elif item['action_type'] == 'OS_UPDATE_SUCCESS':
-                    log_entry += f"Sukces aktualizacji systemu: {details.get('name', '')}"
-                content.append(log_entry)
-        else:
-            content.append("* Brak zarejestrowanych zdarzeń w historii.")
-        latest_report = db.execute(
-            "SELECT id FROM reports WHERE computer_id = ? ORDER BY report_timestamp DESC LIMIT 1", (cid,)).fetchone()
-        if latest_report:
-            content.append("")
-            content.append("## Oczekujące aktualizacje (wg ostatniego raportu)")
-            updates = db.execute("SELECT name, current_version, available_version FROM updates WHERE report_id = ?",
-                                 (latest_report['id'],)).fetchall()
-            if updates:
-                [content.append(f"* {item['name']}: {item['current_version']} -> {item['available_version']}") for item
-                 in updates]
-            else:
-                content.append("* Brak oczekujących aktualizacji.")
-            content.append("")
-            content.append("## Zainstalowane aplikacje (wg ostatniego raportu)")
-            apps = db.execute("SELECT name, version FROM applications WHERE report_id = ?",
-                              (latest_report['id'],)).fetchall()
-            if apps:
-                [content.append(f"* {item['name']} ({item['version']})") for item in apps]
-            else:
-                content.append("* Brak aplikacji.")
-        content.append("")
-        content.append("=" * 80)
-        content.append("")
-    return "\n".join(content)
-
-
-def generate_snapshot_report_content(report_id):
-    db, content = get_db(), []
+    return text_download(generate_snapshot_report_content, filename, report_id)
+
+
+# Ostatnie 20 zdarzeń na komputer bez powtórek: is_latest oznacza najnowsze wystąpienie każdej pary (typ, nazwa),
+# więc zapytanie czyta z częściowego indeksu tylko te wiersze, niezależnie od długości historii.
+REPORT_EVENTS_SQL = """
+    SELECT computer_id, timestamp, action_type, name, from_version, to_version FROM (
+        SELECT computer_id, timestamp, action_type, name, from_version, to_version,
+               ROW_NUMBER() OVER (PARTITION BY computer_id ORDER BY timestamp DESC, id DESC) AS event_no
+        FROM action_history WHERE computer_id IN ({marks}) AND is_latest = 1
+    ) WHERE event_no <= 20 ORDER BY computer_id, event_no
+"""
+
+REPORT_EVENT_LABELS = {
+    'APP_UPDATE_SUCCESS': "Sukces aktualizacji: {name} (z {from_} do {to})",
+    'APP_UPDATE_FAILURE': "Błąd aktualizacji: {name}",
+    'APP_UNINSTALL_SUCCESS': "Sukces deinstalacji: {name}",
+    'APP_UNINSTALL_FAILURE': "Błąd deinstalacji: {name}",
+    'OS_UPDATE_SUCCESS': "Sukces aktualizacji systemu: {name}",
+}
+
+
+def group_by_computer(rows):
+    grouped = collections.defaultdict(list)
+    for row in rows:
+        grouped[row['computer_id']].append(row)
+    return grouped
+
+
+def iter_report_computers(db, computer_ids=None):
+    """Komputery do raportu partiami po REPORT_STREAM_BATCH (stronicowanie po nazwie hosta)."""
+    if computer_ids is not None:
+        marks = ','.join('?' * len(computer_ids))
+        yield db.execute(f"SELECT id, hostname, ip_address, latest_report_id FROM computers WHERE id IN ({marks}) "
+                         "ORDER BY hostname", computer_ids).fetchall()
+        return
+    last_hostname = ''
+    while True:
+        batch = db.execute("SELECT id, hostname, ip_address, latest_report_id FROM computers WHERE hostname > ? "
+                           "ORDER BY hostname LIMIT ?", (last_hostname, REPORT_STREAM_BATCH)).fetchall()
+        if not batch: return
+        yield batch
+        last_hostname = batch[-1]['hostname']
+
+
+def generate_report_content(db, computer_ids=None):
+    """Raport tekstowy dla podanych komputerów (domyślnie wszystkich), generowany fragmentami po komputerze.
+
+    Na partię komputerów przypadają trzy zapytania (zdarzenia, aktualizacje, aplikacje), więc pamięć zależy
+    od rozmiaru partii, a nie floty.
+    """
+    generated_at = datetime.now(ZoneInfo('Europe/Warsaw')).strftime('%Y-%m-%d %H:%M:%S')
+    for computers in iter_report_computers(db, computer_ids):
+        ids = [c['id'] for c in computers]
+        marks = ','.join('?' * len(ids))
+        events = group_by_computer(db.execute(REPORT_EVENTS_SQL.format(marks=marks), ids))
+        updates = group_by_computer(db.execute(
+            "SELECT c.id AS computer_id, u.name, u.current_version, u.available_version "
+            f"FROM computers c JOIN updates u ON u.report_id = c.latest_report_id WHERE c.id IN ({marks})", ids))
+        apps = group_by_computer(db.execute(
+            "SELECT c.id AS computer_id, ra.name, ra.version "
+            f"FROM computers c JOIN report_applications ra ON ra.report_id = c.latest_report_id WHERE c.id IN ({marks})",
+            ids))
+        for computer in computers:
+            cid = computer['id']
+            content = [f"# RAPORT DLA KOMPUTERA: {computer['hostname']} ({computer['ip_address']})",
+                       f"Data wygenerowania: {generated_at}", "",
+                       "## Dziennik Zdarzeń (ostatnie 20, bez powtórek)"]
+            for item in events.get(cid, []):
+                label = REPORT_EVENT_LABELS.get(item['action_type'], '')
+                content.append(f"* [{to_local_time_filter(item['timestamp'])}] " + label.format(
+                    name=item['name'], from_=item['from_version'] or '?', to=item['to_version'] or '?'))
+            if cid not in events:
+                content.append("* Brak zarejestrowanych zdarzeń w historii.")
+            if computer['latest_report_id']:
+                content += ["", "## Oczekujące aktualizacje (wg ostatniego raportu)"]
+                content += [f"* {item['name']}: {item['current_version']} -> {item['available_version']}"
+                            for item in updates.get(cid, [])] or ["* Brak oczekujących aktualizacji."]
+                content += ["", "## Zainstalowane aplikacje (wg ostatniego raportu)"]
+                content += [f"* {item['name']} ({item['version']})"
+                            for item in apps.get(cid, [])] or ["* Brak aplikacji."]
+            content += ["", "=" * 80, "", ""]
+            yield "\n".join(content)
+
+
+def generate_snapshot_report_content(db, report_id):
     report = db.execute(
         "SELECT r.id, r.report_timestamp, c.hostname, c.ip_address FROM reports r JOIN computers c ON r.computer_id = c.id WHERE r.id = ?",
         (report_id,)).fetchone()
-    if not report: return "Nie znaleziono raportu."
-    content.append(f"# RAPORT HISTORYCZNY DLA: {report['hostname']} ({report['ip_address']})")
-    content.append(f"# Migawka z dnia: {to_local_time_filter(report['report_timestamp'])}")
-    content.append(f"Data wygenerowania pliku: {datetime.now(ZoneInfo('Europe/Warsaw')).strftime('%Y-%m-%d %H:%M:%S')}")
-    content.append("")
-    content.append("## Oczekujące aktualizacje w tym raporcie")
-    updates = db.execute(
-        "SELECT name, current_version, available_version, update_type FROM updates WHERE report_id = ?",
-        (report_id,)).fetchall()
-    if updates:
-        for item in updates:
-            if item['update_type'] == 'OS':
-                content.append(f"* [System] {item['name']} (KB: {item['available_version']})")
-            else:
-                content.append(
-                    f"* [Aplikacja] {item['name']}: {item['current_version']} -> {item['available_version']}")
-    else:
-        content.append("* Brak.")
-    content.append("")
-    content.append("## Zainstalowane aplikacje w tym raporcie")
-    apps = db.execute("SELECT name, version FROM applications WHERE report_id = ?", (report_id,)).fetchall()
-    if apps:
-        [content.append(f"* {item['name']} ({item['version']})") for item in apps]
-    else:
-        content.append("* Brak.")
-    content.append("")
-    return "\n".join(content)
+    if not report:
+        yield "Nie znaleziono raportu."
+        return
+    yield (f"# RAPORT HISTORYCZNY DLA: {report['hostname']} ({report['ip_address']})\n"
+           f"# Migawka z dnia: {to_local_time_filter(report['report_timestamp'])}\n"
+           f"Data wygenerowania pliku: {datetime.now(ZoneInfo('Europe/Warsaw')).strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+           "## Oczekujące aktualizacje w tym raporcie\n")
+    empty = True
+    for item in db.execute("SELECT name, current_version, available_version, update_type FROM updates WHERE report_id = ?",
+                           (report_id,)):
+        empty = False
+        if item['update_type'] == 'OS':
+            yield f"* [System] {item['name']} (KB: {item['available_version']})\n"
+        else:
+            yield f"* [Aplikacja] {item['name']}: {item['current_version']} -> {item['available_version']}\n"
+    yield "* Brak.\n\n" if empty else "\n"
+    yield "## Zainstalowane aplikacje w tym raporcie\n"
+    empty = True
+    for item in db.execute("SELECT name, version FROM report_applications WHERE report_id = ?", (report_id,)):
+        empty = False
+        yield f"* {item['name']} ({item['version']})\n"
+    if empty:
+        yield "* Brak.\n"
 
-@app.route('/settings/generate_exe', methods=['POST'])
-def generate_exe():
-    if not shutil.which("pyinstaller"):
-        flash("Błąd serwera: Program 'pyinstaller' nie jest zainstalowany.", "error")
-        return redirect(url_for('settings'))
+# --- Generator agenta ---
+# agent.exe jest kompilowany PyInstallerem raz na wersję szablonu (skrót agent_template.py.txt i klucza podpisu),
+# w tle, przez jeden wątek budujący. Ustawienia z formularza nie są wkompilowane - trafiają do pliku
+# agent_config.json podpisanego kluczem prywatnym Ed25519, który zostaje na serwerze; w pliku wykonywalnym jest
+# tylko klucz publiczny do sprawdzenia podpisu. Pobranie agenta to więc tylko spakowanie gotowego agent.exe
+# z nowym plikiem konfiguracji.
+AGENT_BUILD_MESSAGES = {
+    'missing': ('Agent nie jest jeszcze zbudowany.', 'status-pending'),
+    'queued': ('Budowanie agenta czeka w kolejce...', 'status-pending'),
+    'building': ('Trwa budowanie agenta (PyInstaller, kilka minut)...', 'status-pending'),
+    'ready': ('Agent jest zbudowany - pobranie trwa chwilę.', 'status-ok'),
+    'failed': ('Budowanie agenta nie powiodło się.', 'status-fail'),
+    'unavailable': ("Program 'pyinstaller' nie jest zainstalowany na serwerze.", 'status-fail'),
+}
+AGENT_BUILD_DIR_RE = re.compile(r'[0-9a-f]{16}(-.*)?')
+agent_build_lock = threading.Lock()
+agent_build_queue = queue.Queue()
+agent_builds = {}  # wersja agenta -> stan budowania w tym procesie (status, czasy, błąd)
+agent_build_worker = None
+config_signing_key_cache = None
 
 
-    config = {
-        "api_endpoint_1": request.form.get('api_endpoint_1', ''),
-        "api_endpoint_2": request.form.get('api_endpoint_2', ''),
-        "api_key": request.form.get('api_key'),
-        "loop_interval": int(request.form.get('loop_interval', 15)),
-        "report_interval": int(request.form.get('report_interval', 240)),
-        "winget_path": request.form.get('winget_path', ''),  # jeśli masz
-        "blacklist_keywords": request.form.get('blacklist_keywords', '')
-    }
+def config_signing_key(create=True):
+    """Klucz prywatny Ed25519 podpisu agent_config.json, wyprowadzony z AGENT_CONFIG_SIGNING_KEY albo z losowego
+    sekretu zapisanego przy pierwszym użyciu. Klucz nie opuszcza serwera - agent.exe zawiera tylko klucz publiczny,
+    więc wyciągnięcie go z pliku nie pozwala podrobić konfiguracji (np. podmienić adresów serwerów).
+    Przy create=False zwraca None, zamiast tworzyć brakujący sekret."""
+    global config_signing_key_cache
+    with agent_build_lock:
+        if config_signing_key_cache is None:
+            secret = AGENT_CONFIG_SIGNING_KEY
+            if not secret:
+                path = os.path.join(AGENT_BUILD_DIR, 'config_signing.key')
+                if not create and not os.path.isfile(path):
+                    return None
+                os.makedirs(AGENT_BUILD_DIR, exist_ok=True)
+                try:
+                    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        f.write(secrets.token_hex(32))
+                    logging.info("Utworzono klucz podpisu konfiguracji agenta: %s", path)
+                except FileExistsError:
+                    pass
+                with open(path, 'r', encoding='utf-8') as f:
+                    secret = f.read().strip()
+            config_signing_key_cache = Ed25519PrivateKey.from_private_bytes(hashlib.sha256(secret.encode('utf-8')).digest())
+        return config_signing_key_cache
+
+
+def config_public_key():
+    """Klucz publiczny (hex) wpisywany do agenta przy budowaniu."""
+    return config_signing_key().public_key().public_bytes(Encoding.Raw, PublicFormat.Raw).hex()
+
+
+def agent_build_key(create=True):
+    """Wersja budowanego agenta - zmiana szablonu albo klucza podpisu wymaga nowej kompilacji.
+    Przy create=False zwraca None, gdy klucza podpisu jeszcze nie ma (nie ma więc też żadnego agenta)."""
+    if not create and config_signing_key(create=False) is None:
+        return None
+    return hashlib.sha256(f"{config_public_key()}\0{AGENT_TEMPLATE}".encode('utf-8')).hexdigest()[:16]
+
+
+def agent_exe_path(key):
+    return os.path.join(AGENT_BUILD_DIR, key, 'agent.exe')
+
+
+def sign_agent_config(settings):
+    payload = json.dumps(settings, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    signature = config_signing_key().sign(payload).hex()
+    return {"config": settings, "signature": signature}
+
 
-    blacklist_str = ', '.join([f"'{kw.strip()}'" for kw in config['blacklist_keywords'].splitlines() if kw.strip()])
+def agent_build_status():
+    """Stan budowania agenta bieżącej wersji - tylko odczyt, bez zlecania budowania i tworzenia klucza podpisu."""
+    key = agent_build_key(create=False)
+    with agent_build_lock:
+        state = dict(agent_builds.get(key, {}))
+    if key and os.path.isfile(agent_exe_path(key)):
+        state['status'] = 'ready'
+    elif not state:
+        state['status'] = 'missing' if shutil.which('pyinstaller') else 'unavailable'
+    message, css_class = AGENT_BUILD_MESSAGES[state['status']]
+    return dict(state, key=key, message=message, css_class=css_class)
 
-    logging.info(
-        f"GENERATOR: endpoint1={config['api_endpoint_1']} endpoint2={config['api_endpoint_2']} key={config['api_key']}")
 
-    final_agent_code = AGENT_TEMPLATE \
-        .replace('__BLACKLIST_KEYWORDS__', blacklist_str) \
-        .replace('__API_ENDPOINT_1__', config['api_endpoint_1']) \
-        .replace('__API_ENDPOINT_2__', config['api_endpoint_2']) \
-        .replace('__API_KEY__', config['api_key']) \
-        .replace('__LOOP_INTERVAL__', str(config['loop_interval'])) \
-        .replace('__REPORT_INTERVAL__', str(config['report_interval'])) \
-        .replace('__WINGET_PATH__', config['winget_path'])
+def queue_agent_build(retry=False):
+    """Zleca w tle zbudowanie agenta bieżącej wersji, jeśli go jeszcze nie ma i nie jest budowany. Nieudane
+    budowanie jest powtarzane tylko przy retry=True (przycisk w ustawieniach), a nie przy każdym pobraniu. Zwraca stan."""
+    global agent_build_worker
+    key = agent_build_key()
+    if not os.path.isfile(agent_exe_path(key)) and shutil.which('pyinstaller'):
+        with agent_build_lock:
+            status = agent_builds.get(key, {}).get('status')
+            if status is None or (retry and status == 'failed'):
+                agent_builds[key] = {'status': 'queued', 'queued_at': time.time()}
+                agent_build_queue.put(key)
+            if agent_build_worker is None:
+                agent_build_worker = threading.Thread(target=agent_build_loop, name="agent-build", daemon=True)
+                agent_build_worker.start()
+    return agent_build_status()
 
-    build_dir = os.path.abspath("C:\\tmp\\winget_agent_build")
-    os.makedirs(build_dir, exist_ok=True)
-    script_path = os.path.join(build_dir, "agent.py")  # << NAZWA agent.py
 
+def agent_build_loop():
+    while True:
+        key = agent_build_queue.get()
+        with agent_build_lock:
+            agent_builds[key].update(status='building', started_at=time.time())
+        try:
+            build_agent(key)
+            with agent_build_lock:
+                agent_builds[key].update(status='ready', finished_at=time.time())
+        except Exception as e:
+            logging.error("Budowanie agenta %s nie powiodło się: %s", key, e, exc_info=True)
+            with agent_build_lock:
+                agent_builds[key].update(status='failed', finished_at=time.time(), error=str(e)[-4000:])
+
+
+def build_agent(key):
+    """Kompiluje agenta w osobnym katalogu roboczym i publikuje AGENT_BUILD_DIR/<wersja>/agent.exe jednym os.replace,
+    więc pobrania w trakcie budowania nigdy nie widzą niepełnego pliku. Starsze wersje są potem usuwane."""
+    started = time.monotonic()
+    os.makedirs(AGENT_BUILD_DIR, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix=f"{key}-", dir=AGENT_BUILD_DIR)
     try:
+        script_path = os.path.join(work_dir, "agent.py")
         with open(script_path, "w", encoding="utf-8") as f:
-            f.write(final_agent_code)
-
+            f.write(AGENT_TEMPLATE.replace('__CONFIG_PUBLIC_KEY__', config_public_key()))
         command = [
-            "pyinstaller", "--onefile",
+            "pyinstaller", "--onefile", "--noconfirm",
             "--hidden-import=win32timezone",
-            # "--noconsole", # Pamiętaj o usunięciu/zakomentowaniu tej linii do debugowania
-            "--distpath", os.path.join(build_dir, 'dist'),
-            "--workpath", os.path.join(build_dir, 'build'),
-            "--specpath", build_dir,
+            "--distpath", os.path.join(work_dir, 'dist'),
+            "--workpath", os.path.join(work_dir, 'build'),
+            "--specpath", work_dir,
             script_path
         ]
+        logging.info("Uruchamianie PyInstaller: %s", ' '.join(command))
+        result = subprocess.run(command, capture_output=True, text=True, encoding='utf-8')
+        if result.returncode != 0:
+            raise RuntimeError(f"PyInstaller zakończył się kodem {result.returncode}:\n{result.stderr}")
+        dist_dir = os.path.join(work_dir, 'dist')
+        # Na wszelki wypadek, gdyby PyInstaller nazwał plik inaczej niż agent.exe
+        exe_files = sorted(f for f in os.listdir(dist_dir) if f.endswith('.exe')) if os.path.isdir(dist_dir) else []
+        if not exe_files:
+            raise FileNotFoundError(f"PyInstaller nie stworzył pliku .exe. Logi: {result.stderr}")
+        exe_name = 'agent.exe' if 'agent.exe' in exe_files else exe_files[0]
+        os.makedirs(os.path.join(AGENT_BUILD_DIR, key), exist_ok=True)
+        os.replace(os.path.join(dist_dir, exe_name), agent_exe_path(key))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    for name in os.listdir(AGENT_BUILD_DIR):
+        if name != key and AGENT_BUILD_DIR_RE.fullmatch(name):
+            shutil.rmtree(os.path.join(AGENT_BUILD_DIR, name), ignore_errors=True)
+    logging.info("Zbudowano agenta %s w %.0fs.", key, time.monotonic() - started)
+
+
+def agent_settings_from_form(form):
+    """Ustawienia agenta z formularza generatora (ValueError przy niepoprawnych interwałach)."""
+    settings = {
+        "api_endpoints": [ep.strip() for ep in (form.get('api_endpoint_1', ''), form.get('api_endpoint_2', ''))
+                          if ep.strip()],
+        "api_key": form.get('api_key', ''),
+        "loop_interval": int(form.get('loop_interval', 15)),
+        "report_interval": int(form.get('report_interval', 240)),
+        "winget_path": form.get('winget_path', '').strip(),
+        "blacklist_keywords": [kw.strip() for kw in form.get('blacklist_keywords', '').splitlines() if kw.strip()],
+    }
+    if settings['loop_interval'] <= 0 or settings['report_interval'] <= 0:
+        raise ValueError("Interwały muszą być dodatnie.")
+    return dict(settings, issued_at=datetime.now(UTC).strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+
+@app.route('/settings/generate_exe', methods=['POST'])
+def generate_exe():
+    try:
+        settings = agent_settings_from_form(request.form)
+    except ValueError as e:
+        return f"Niepoprawne ustawienia agenta: {e}", 400
+    logging.info("GENERATOR: serwery=%s, interwał=%ss, raport co %d pętli", settings['api_endpoints'],
+                 settings['loop_interval'], settings['report_interval'])
+    config_document = json.dumps(sign_agent_config(settings), ensure_ascii=False, indent=2)
+    if request.form.get('download') == 'config':
+        return Response(config_document, mimetype='application/json',
+                        headers={'Content-Disposition': 'attachment; filename=agent_config.json'})
+
+    status = queue_agent_build()
+    if status['status'] != 'ready':
+        flash(status['message'], "error")
+        return redirect(url_for('settings'))
+    # agent.exe jest już skompresowany przez PyInstaller - bez ponownej kompresji pakowanie trwa milisekundy.
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.write(agent_exe_path(status['key']), 'agent.exe', compress_type=zipfile.ZIP_STORED)
+        zf.writestr('agent_config.json', config_document, compress_type=zipfile.ZIP_DEFLATED)
+    archive.seek(0)
+    return send_file(archive, as_attachment=True, download_name='WingetAgent.zip', mimetype='application/zip')
+
+
+@app.route('/settings/agent_build', methods=['GET', 'POST'])
+def agent_build_view():
+    """Stan budowania agent.exe (JSON); POST zleca budowanie, np. ponownie po błędzie."""
+    if request.method == 'POST':
+        queue_agent_build(retry=True)
+        return redirect(url_for('settings'))
+    return jsonify(agent_build_status())
+
+
+@app.cli.command('build-agent')
+def build_agent_command():
+    """Buduje agent.exe bieżącej wersji szablonu (bez zlecania go z ustawień panelu)."""
+    key = agent_build_key()
+    if os.path.isfile(agent_exe_path(key)):
+        print(f"Agent {key} jest już zbudowany: {agent_exe_path(key)}")
+        return
+    if not shutil.which('pyinstaller'):
+        raise click.ClickException("Program 'pyinstaller' nie jest zainstalowany.")
+    build_agent(key)
+    print(f"Zbudowano agenta {key}: {agent_exe_path(key)}")
+
+
+# --- Serwer produkcyjny ---
+
+def run_server(host=SERVER_HOST, port=SERVER_PORT, threads=SERVER_THREADS):
+    """Uruchamia panel pod wielowątkowym serwerem WSGI waitress (każdy wątek ma własne połączenie do odczytu)."""
+    global long_poll_slots
+    from waitress import serve
+    # Czekający agent zajmuje wątek serwera - long-poll może zająć najwyżej połowę wątków, reszta zostaje
+    # dla panelu i raportów. Agent ponad limit dostaje odpowiedź od razu z X-Long-Poll: 0 i odpytuje co
+    # LOOP_INTERVAL, więc przy większej flocie trzeba zwiększyć SERVER_THREADS, żeby long-poll objął wszystkich.
+    waiters = max(1, min(TASK_LONG_POLL_MAX_WAITERS, threads // 2))
+    if waiters < TASK_LONG_POLL_MAX_WAITERS:
+        logging.warning("Long-poll zadań: najwyżej %d czekających agentów przy %d wątkach serwera (SERVER_THREADS) - "
+                        "pozostałe agenty odpytują co swój LOOP_INTERVAL.", waiters, threads)
+    long_poll_slots = threading.BoundedSemaphore(waiters)
+    get_db()  # sprawdzenie schematu i start retencji jeszcze przed pierwszym żądaniem
+    if REPORT_INGEST_MODE == 'async': start_ingest_writer()
+    logging.info("Serwer waitress na %s:%d, wątków: %d.", host, port, threads)
+    serve(app, host=host, port=port, threads=threads, connection_limit=max(100, threads * 4), ident='winget-dashboard')
+
+
+@app.cli.command('serve')
+@click.option('--host', default=SERVER_HOST, show_default=True, help="Adres nasłuchiwania.")
+@click.option('--port', default=SERVER_PORT, show_default=True, type=int, help="Port.")
+@click.option('--threads', default=SERVER_THREADS, show_default=True, type=int, help="Liczba wątków obsługujących żądania.")
+def serve_command(host, port, threads):
+    """Uruchamia panel w trybie produkcyjnym (waitress) zamiast serwera deweloperskiego `flask run`."""
+    run_server(host, port, threads)
+
 
-        logging.info(f"Uruchamianie PyInstaller: {' '.join(command)}")
-        result = subprocess.run(command, check=True, capture_output=True, text=True, encoding='utf-8')
-        logging.info(f"PyInstaller output: {result.stdout}")
-
-        exe_name = "agent.exe"
-        output_exe_path = os.path.join(build_dir, 'dist', exe_name)
-
-        if not os.path.exists(output_exe_path):
-            # Na wszelki wypadek, jak pyinstaller wygenerował .exe o nazwie agent.py.exe
-            exe_files = [f for f in os.listdir(os.path.join(build_dir, 'dist')) if f.endswith('.exe')]
-            if exe_files:
-                output_exe_path = os.path.join(build_dir, 'dist', exe_files[0])
-            else:
-                raise FileNotFoundError(f"PyInstaller nie stworzył pliku .exe. Logi: {result.stderr}")
-
-        return send_file(
-            output_exe_path,
-            as_attachment=True,
-            download_name='agent.exe',
-            mimetype='application/vnd.microsoft.portable-executable'
-        )
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Błąd kompilacji PyInstaller: {e.stderr}")
-        return f"<h1>Błąd podczas kompilacji</h1><pre>{e.stderr}</pre>", 500
-    except Exception as e:
-        logging.error(f"Wystąpił nieoczekiwany błąd: {e}", exc_info=True)
-        return "Wystąpił nieoczekiwany błąd serwera.", 500
-    # finally:
-    #     logging.info(f"Usuwanie folderu tymczasowego: {build_dir}")
-    #     shutil.rmtree(build_dir, ignore_errors=True)
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    run_server()
\ No newline at end of file
@@ -0,0 +1,162 @@
+"""Benchmark zapytań na syntetycznej bazie floty - przed i po migracjach schematu (flask migrate-db).
+
+Tworzy bazę w katalogu tymczasowym w postaci sprzed migracji (bez indeksów, bez computers.latest_report_id
+i z pustym indeksem aplikacji floty, user_version = 0), mierzy najczęstsze zapytania aplikacji, uruchamia
+run_migrations() i mierzy je ponownie.
+
+Użycie: python bench_db.py [--computers 500] [--reports 40] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+BENCH_DIR = tempfile.mkdtemp(prefix="winget-bench-")
+os.environ["DATABASE_FILE"] = os.path.join(BENCH_DIR, "fleet.db")
+
+import app  # noqa: E402 - DATABASE_FILE musi być ustawione przed importem
+
+# Zapytania "przed": postać sprzed wskaźnika latest_report_id; "po": postać używana teraz w app.py.
+QUERIES = [
+    ("ostatni raport komputera",
+     "SELECT id FROM reports WHERE computer_id = ? ORDER BY report_timestamp DESC, id DESC LIMIT 1",
+     "SELECT latest_report_id FROM computers WHERE id = ?", "computer"),
+    ("aktualizacje ostatniego raportu",
+     "SELECT name, current_version, available_version FROM updates WHERE report_id = "
+     "(SELECT id FROM reports WHERE computer_id = ? ORDER BY report_timestamp DESC, id DESC LIMIT 1)",
+     "SELECT name, current_version, available_version FROM updates WHERE report_id = "
+     "(SELECT latest_report_id FROM computers WHERE id = ?)", "computer"),
+    ("oczekujące zadania komputera",
+     "SELECT id, command, payload FROM tasks WHERE computer_id = ? AND status = 'oczekuje'",
+     None, "computer"),
+    ("historia raportów komputera",
+     "SELECT id, report_timestamp FROM reports WHERE computer_id = ? ORDER BY report_timestamp DESC",
+     None, "computer"),
+    ("dziennik zdarzeń komputera",
+     "SELECT timestamp, action_type, details FROM action_history WHERE computer_id = ? ORDER BY timestamp DESC LIMIT 20",
+     "SELECT timestamp, action_type, name FROM action_history WHERE computer_id = ? ORDER BY timestamp DESC LIMIT 20",
+     "computer"),
+    ("20 unikalnych zdarzeń (raport)",
+     "SELECT * FROM (SELECT *, ROW_NUMBER() OVER (ORDER BY timestamp DESC, id DESC) AS event_no FROM ("
+     "SELECT *, ROW_NUMBER() OVER (PARTITION BY action_type, json_extract(details, '$.name') "
+     "ORDER BY timestamp DESC, id DESC) AS repeat_no FROM action_history WHERE computer_id = ?) WHERE repeat_no = 1) "
+     "WHERE event_no <= 20",
+     app.REPORT_EVENTS_SQL.format(marks='?'), "computer"),
+    ("kontrola duplikatu zdarzenia OS",
+     "SELECT 1 FROM action_history WHERE computer_id = ? AND action_type = 'OS_UPDATE_SUCCESS' "
+     "AND json_extract(details, '$.name') = 'KB7' AND timestamp > datetime('2026-01-01', '-7 days')",
+     "SELECT 1 FROM action_history WHERE computer_id = ? AND dedupe_key = 'OS_UPDATE_SUCCESS|KB7|"
+     f"{1767225600 // app.EVENT_DEDUPE_BUCKET_SECONDS}'",  # 2026-01-01 UTC
+     "computer"),
+    ("poprzednie aktualizacje OS (zapis raportu)",
+     "SELECT name FROM updates WHERE report_id = ? AND update_type = 'OS'",
+     None, "report"),
+    ("kto ma aplikację X (flota)",
+     "SELECT c.id FROM computers c JOIN reports r ON r.id = (SELECT id FROM reports WHERE computer_id = c.id "
+     "ORDER BY report_timestamp DESC, id DESC LIMIT 1) JOIN report_applications ra ON ra.report_id = r.id "
+     "WHERE ra.app_id = ?",
+     "SELECT computer_id FROM fleet_apps WHERE app_key = ?", "app"),
+]
+
+
+def build_fleet(db, computers, reports_per_computer, rng):
+    with app.app.open_resource("schema.sql", mode="r") as f:
+        db.executescript(f.read())
+    # Postać bazy sprzed frameworka migracji.
+    db.executescript("""
+        DROP INDEX idx_reports_computer_time;
+        DROP INDEX idx_reports_snapshot;
+        DROP INDEX idx_updates_report;
+        DROP INDEX idx_tasks_computer_status;
+        DROP INDEX idx_action_history_computer_time;
+        ALTER TABLE computers DROP COLUMN latest_report_id;
+        ALTER TABLE computers DROP COLUMN page_version;
+        DROP TABLE action_history;
+        CREATE TABLE action_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            computer_id INTEGER NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            action_type TEXT NOT NULL,
+            details TEXT
+        );
+        PRAGMA user_version = 0;
+    """)
+    cur = db.cursor()
+    catalog = [{"name": f"Aplikacja {i}", "id": f"Vendor{i % 50}.App{i}", "version": f"{i % 9}.{i % 5}"} for i in range(400)]
+    snapshots = [app.store_app_snapshot(cur, rng.sample(catalog, rng.randint(60, 180))) for _ in range(200)]
+    cur.executemany("INSERT INTO computers (hostname, ip_address) VALUES (?, ?)",
+                    [(f"PC-{c:05d}", f"10.0.{c // 250}.{c % 250}") for c in range(computers)])
+    report_rows, update_rows = [], []
+    report_id = 0
+    for day in range(reports_per_computer):
+        for computer_id in range(1, computers + 1):
+            report_id += 1
+            report_rows.append((report_id, computer_id, f"2026-01-01 00:00:00", rng.choice(snapshots)))
+            for u in range(rng.randint(0, 12)):
+                update_rows.append((report_id, f"Aplikacja {u}", f"Vendor{u}.App{u}", "1.0", "2.0", "APP"))
+            for u in range(rng.randint(0, 3)):
+                update_rows.append((report_id, f"KB50{u} Aktualizacja", None, None, f"50{u}", "OS"))
+    cur.executemany("INSERT INTO reports (id, computer_id, report_timestamp, snapshot_id) "
+                    "VALUES (?, ?, datetime(?, '+' || ? || ' minutes'), ?)",
+                    [(r[0], r[1], r[2], r[0], r[3]) for r in report_rows])
+    cur.executemany("INSERT INTO updates (report_id, name, app_id, current_version, available_version, update_type) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", update_rows)
+    cur.executemany("INSERT INTO tasks (computer_id, command, payload, status) VALUES (?, 'update_package', 'x', ?)",
+                    [(rng.randint(1, computers), rng.choice(["oczekuje", "zakończone", "zakończone", "błąd"]))
+                     for _ in range(computers * 10)])
+    cur.executemany("INSERT INTO action_history (computer_id, action_type, details, timestamp) "
+                    "VALUES (?, 'OS_UPDATE_SUCCESS', ?, datetime('2026-01-01', '+' || ? || ' minutes'))",
+                    [(rng.randint(1, computers), f'{{"name": "KB{rng.randint(0, 40)}"}}', i)
+                     for i in range(computers * 30)])
+    db.commit()
+    return report_id
+
+
+def measure(db, sql, params, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for p in params:
+            db.execute(sql, (p,)).fetchall()
+    return (time.perf_counter() - started) / (repeat * len(params)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--computers", type=int, default=500, help="liczba komputerów w syntetycznej flocie")
+    parser.add_argument("--reports", type=int, default=40, help="liczba raportów na komputer")
+    parser.add_argument("--repeat", type=int, default=5, help="liczba powtórzeń każdego pomiaru")
+    parser.add_argument("--sample", type=int, default=200, help="liczba losowych komputerów/raportów na pomiar")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    db = sqlite3.connect(os.environ["DATABASE_FILE"])
+    db.row_factory = sqlite3.Row
+    started = time.perf_counter()
+    report_count = build_fleet(db, args.computers, args.reports, rng)
+    print(f"Syntetyczna flota: {args.computers} komputerów, {report_count} raportów "
+          f"({time.perf_counter() - started:.1f}s, {os.path.getsize(os.environ['DATABASE_FILE']) / 1e6:.1f} MB)")
+    samples = {"computer": [rng.randint(1, args.computers) for _ in range(args.sample)],
+               "report": [rng.randint(1, report_count) for _ in range(args.sample)],
+               "app": [f"Vendor{i % 50}.App{i}" for i in rng.sample(range(400), min(args.sample, 400) // 10)]}
+
+    before = [measure(db, old_sql, samples[kind], args.repeat) for _, old_sql, _, kind in QUERIES]
+    started = time.perf_counter()
+    app.run_migrations(db)
+    print(f"Migracje zastosowane w {time.perf_counter() - started:.2f}s\n")
+    after = [measure(db, new_sql or old_sql, samples[kind], args.repeat) for _, old_sql, new_sql, kind in QUERIES]
+
+    print(f"{'zapytanie':<44} {'przed [ms]':>11} {'po [ms]':>9} {'przyspieszenie':>15}")
+    for (label, *_), b, a in zip(QUERIES, before, after):
+        print(f"{label:<44} {b:>11.3f} {a:>9.3f} {b / a:>14.0f}x")
+    db.close()
+    for name in os.listdir(BENCH_DIR):
+        os.remove(os.path.join(BENCH_DIR, name))
+    os.rmdir(BENCH_DIR)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
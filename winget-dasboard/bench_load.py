@@ -0,0 +1,468 @@
+"""Generator obciążenia: symulowana flota agentów przeciwko lokalnej (albo wskazanej) instancji panelu.
+
+Wirtualne agenty wysyłają raporty w postaci takiej jak collect_and_report w agencie (pełne i różnicowe, gzip
+od 1 KB, stan dryfujący między raportami), odpytują /api/tasks/<hostname> i odsyłają wyniki zadań.
+Scenariusze są powtarzalne przy tym samym --seed:
+  steady      - flota po rozgrzewce raportuje równomiernie w tempie --report-rate i odpytuje o zadania
+  boot-storm  - nowe komputery wysyłają pełny raport jednocześnie (masowe włączenie floty), potem jak steady
+  rollout     - po rozgrzewce wdrożenie zbiorcze (POST /api/rollouts) pakietu oczekującego na każdym hoście
+--dashboard-rate dodaje do każdego scenariusza odczyty stron panelu (lista komputerów, strona komputera, widoki floty).
+Wynik: przepustowość, opóźnienia p50/p95/p99 i błędy na endpoint oraz przyrost bazy. --json zapisuje wynik
+do pliku, a --compare zestawia go z wcześniejszym zapisem (np. z poprzedniego commitu).
+
+Bez --url skrypt uruchamia serwer w osobnym procesie na świeżej bazie w katalogu tymczasowym: serwer deweloperski
+(flask run) albo produkcyjny (--server waitress, czyli `flask serve --threads N`).
+
+Użycie: python bench_load.py [--scenario steady] [--agents 200] [--duration 60] [--url http://host:5000/api]
+"""
+import argparse
+import gzip
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import app  # noqa: E402 - skrót stanu i pola raportu muszą być zgodne z serwerem
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+ROLLOUT_PACKAGE = "LoadTest.Rollout"
+COMPRESS_MIN_BYTES = 1024
+DASHBOARD_PAGES = ("/", "/computer/{hostname}", "/fleet/apps", "/fleet/updates")
+DB_TABLES = ("computers", "reports", "app_snapshots", "snapshot_apps", "updates", "tasks", "action_history")
+
+
+def build_state_delta(old_state, new_state):
+    """Różnica stanów w formacie agenta (added/removed/changed) albo None, gdy klucze nie są unikalne."""
+    delta = {}
+    for section, fields in app.STATE_FIELDS.items():
+        old = {app.state_entry_key(section, e): e for e in old_state.get(section, [])}
+        new = {app.state_entry_key(section, e): e for e in new_state.get(section, [])}
+        if len(old) != len(old_state.get(section, [])) or len(new) != len(new_state.get(section, [])):
+            return None
+        delta[section] = {
+            "added": [e for k, e in new.items() if k not in old],
+            "removed": [k for k in old if k not in new],
+            "changed": [e for k, e in new.items() if k in old and
+                        any(str(e.get(f) or '') != str(old[k].get(f) or '') for f in fields)],
+        }
+    return delta
+
+
+class VirtualAgent:
+    """Stan jednego symulowanego komputera: aplikacje, dostępne aktualizacje, aktualizacje systemu."""
+
+    def __init__(self, index, catalog, rng):
+        self.hostname = f"LOAD-{index:05d}"
+        self.ip_address = f"10.{index // 65025 % 256}.{index // 255 % 255}.{index % 255 + 1}"
+        self.rng = random.Random(rng.random())
+        self.apps = {a["id"]: dict(a) for a in self.rng.sample(catalog, self.rng.randint(60, 180))}
+        self.apps[ROLLOUT_PACKAGE] = {"name": "Load Test Rollout", "id": ROLLOUT_PACKAGE, "version": "1.0"}
+        self.updates = {}
+        for app_id in self.rng.sample(sorted(self.apps), self.rng.randint(0, 12)) + [ROLLOUT_PACKAGE]:
+            self.add_update(app_id)
+        self.os_updates = [{"Title": f"KB50{k} Aktualizacja zbiorcza", "KB": [f"50{k}"]}
+                           for k in self.rng.sample(range(40), self.rng.randint(0, 3))]
+        self.reboot_required = False
+        self.acked = None  # (state_hash, state) potwierdzone przez serwer - podstawa raportu różnicowego
+        self.lock = threading.Lock()
+
+    def add_update(self, app_id):
+        a = self.apps[app_id]
+        self.updates[app_id] = {"name": a["name"], "id": app_id, "current_version": a["version"],
+                                "available_version": f"{a['version']}.1"}
+
+    def apply_update(self, app_id):
+        update = self.updates.pop(app_id, None)
+        if update and app_id in self.apps:
+            self.apps[app_id]["version"] = update["available_version"]
+            self.reboot_required = self.reboot_required or self.rng.random() < 0.2
+
+    def drift(self, catalog, rate):
+        """Zmiany między raportami: zainstalowane aktualizacje, nowe wersje, (de)instalacje, poprawki systemu."""
+        for app_id in list(self.updates):
+            if app_id != ROLLOUT_PACKAGE and self.rng.random() < rate * 5:
+                self.apply_update(app_id)
+        for app_id in self.apps:
+            if app_id not in self.updates and self.rng.random() < rate:
+                self.add_update(app_id)
+        if self.rng.random() < rate * 5:
+            extra = self.rng.choice(catalog)
+            self.apps.setdefault(extra["id"], dict(extra))
+        if self.rng.random() < rate * 5:
+            victim = self.rng.choice(sorted(self.apps))
+            if victim != ROLLOUT_PACKAGE:
+                self.apps.pop(victim)
+                self.updates.pop(victim, None)
+        if self.os_updates and self.rng.random() < rate * 5:
+            self.os_updates.pop(0)
+        elif self.rng.random() < rate:
+            k = self.rng.randint(40, 99)
+            self.os_updates.append({"Title": f"KB50{k} Aktualizacja zbiorcza", "KB": [f"50{k}"]})
+
+    def report_bodies(self):
+        """Zwraca (treść do wysłania, pełna treść, skrót stanu, stan) - jak collect_and_report w agencie."""
+        payload = {
+            "hostname": self.hostname, "ip_address": self.ip_address, "reboot_required": self.reboot_required,
+            "installed_apps": list(self.apps.values()), "available_app_updates": list(self.updates.values()),
+            "pending_os_updates": self.os_updates,
+            "collector_stats": {k: {"status": "ok", "duration": round(self.rng.uniform(0.2, 30), 1)}
+                                for k in ("reboot_required", "installed_apps", "available_app_updates",
+                                          "pending_os_updates")},
+        }
+        state = app.normalize_report_state(json.loads(json.dumps(payload)))
+        state_hash = app.compute_state_hash(state)
+        full = json.dumps(dict(payload, protocol_version=app.REPORT_PROTOCOL_VERSION, state_hash=state_hash))
+        delta = build_state_delta(self.acked[1], state) if self.acked else None
+        if delta is None:
+            return full, full, state_hash, state
+        body = json.dumps({
+            "hostname": self.hostname, "ip_address": self.ip_address, "reboot_required": self.reboot_required,
+            "collector_stats": payload["collector_stats"], "protocol_version": app.REPORT_PROTOCOL_VERSION,
+            "mode": "delta", "base_hash": self.acked[0], "state_hash": state_hash, "delta": delta})
+        return body, full, state_hash, state
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.codes = defaultdict(Counter)
+        self.lag = []
+        self.sent_bytes = Counter()
+
+    def add(self, kind, status, seconds, sent=0):
+        with self.lock:
+            self.latencies[kind].append(seconds)
+            self.codes[kind][status] += 1
+            self.sent_bytes[kind] += sent
+
+    def summary(self, elapsed):
+        result = {}
+        for kind in sorted(self.latencies):
+            values = sorted(self.latencies[kind])
+            codes = self.codes[kind]
+            # 409 (żądanie pełnej synchronizacji) i 429 (kolejka pełna) to normalne odpowiedzi protokołu, nie błędy.
+            errors = sum(n for code, n in codes.items() if code == "exc" or (code >= 400 and code not in (409, 429)))
+            result[kind] = {
+                "requests": len(values), "rps": round(len(values) / elapsed, 2),
+                "error_rate": round(errors / len(values), 4), "rejected_429": codes.get(429, 0),
+                "p50_ms": percentile(values, 50), "p95_ms": percentile(values, 95), "p99_ms": percentile(values, 99),
+                "kB_sent": round(self.sent_bytes[kind] / 1024, 1), "codes": {str(k): v for k, v in codes.items()},
+            }
+        lag = sorted(self.lag)
+        result["_client"] = {"schedule_lag_p95_ms": percentile(lag, 95), "events": len(lag)}
+        return result
+
+
+def percentile(values, p):
+    if not values: return 0.0
+    return round(values[max(0, math.ceil(p / 100 * len(values)) - 1)] * 1000, 2)
+
+
+class LoadRun:
+    """Harmonogram zdarzeń (raport, odpytanie o zadania, wynik zadania) wykonywany przez pulę wątków."""
+
+    def __init__(self, args, base_url, agents, catalog):
+        self.args, self.base_url, self.agents, self.catalog = args, base_url, agents, catalog
+        self.stats = Stats()
+        self.events = []
+        self.events_lock = threading.Lock()
+        self.counter = itertools.count()
+        self.local = threading.local()
+        self.stop_at = None
+
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            session.headers.update({"Content-Type": "application/json", "X-API-Key": self.args.api_key})
+        return session
+
+    def schedule(self, due, kind, agent, data=None):
+        with self.events_lock:
+            heapq.heappush(self.events, (due, next(self.counter), kind, agent, data))
+
+    def request(self, kind, method, url, body=None, **kwargs):
+        headers, data = {}, None
+        if body is not None:
+            data = body.encode("utf-8")
+            if len(data) >= COMPRESS_MIN_BYTES:
+                data, headers["Content-Encoding"] = gzip.compress(data, compresslevel=6), "gzip"
+        started = time.perf_counter()
+        try:
+            r = self.session().request(method, url, data=data, headers=headers, timeout=120, **kwargs)
+        except requests.RequestException:
+            self.stats.add(kind, "exc", time.perf_counter() - started, len(data or b""))
+            return None
+        self.stats.add(kind, r.status_code, time.perf_counter() - started, len(data or b""))
+        return r
+
+    def send_report(self, agent):
+        with agent.lock:
+            agent.drift(self.catalog, self.args.drift)
+            body, full, state_hash, state = agent.report_bodies()
+        r = self.request("report", "POST", f"{self.base_url}/report", body)
+        if r is not None and r.status_code == 409 and body is not full:
+            r = self.request("report", "POST", f"{self.base_url}/report", full)
+        if r is None or r.status_code >= 300:
+            with agent.lock:
+                agent.acked = None
+            if r is not None and r.status_code == 429:
+                return float(r.headers.get("Retry-After", "30"))
+            return None
+        try:
+            server_hash = r.json().get("state_hash")
+        except ValueError:
+            server_hash = None
+        with agent.lock:
+            agent.acked = (state_hash, state) if server_hash == state_hash else None
+        return None
+
+    def poll_tasks(self, agent):
+        r = self.request("tasks", "GET", f"{self.base_url}/tasks/{agent.hostname}")
+        if r is None or r.status_code != 200:
+            return
+        for task in r.json():
+            self.schedule(time.monotonic() + self.args.task_seconds, "result", agent, task)
+
+    def view_dashboard(self, agent):
+        page = DASHBOARD_PAGES[agent.rng.randrange(len(DASHBOARD_PAGES))].format(hostname=agent.hostname)
+        self.request("page", "GET", self.base_url[:-len("/api")] + page)
+
+    def send_result(self, agent, task):
+        failed = agent.rng.random() < self.args.task_failure_rate
+        if task["command"] == "update_package" and not failed:
+            with agent.lock:
+                agent.apply_update(task["payload"])
+        body = json.dumps({"task_id": task["id"], "status": "błąd" if failed else "zakończone",
+                           "duration": self.args.task_seconds, "queue_wait": 0.0})
+        self.request("result", "POST", f"{self.base_url}/tasks/result", body)
+
+    def handle(self, due, kind, agent, data):
+        now = time.monotonic()
+        with self.stats.lock:
+            self.stats.lag.append(now - due)
+        if kind == "report":
+            retry_after = self.send_report(agent)
+            interval = len(self.agents) / self.args.report_rate
+            self.schedule(now + (retry_after if retry_after is not None else interval), "report", agent)
+        elif kind == "tasks":
+            self.poll_tasks(agent)
+            self.schedule(now + self.args.poll_interval, "tasks", agent)
+        elif kind == "result":
+            self.send_result(agent, data)
+        elif kind == "page":
+            self.view_dashboard(agent)
+            self.schedule(now + len(self.agents) / self.args.dashboard_rate, "page", agent)
+
+    def run(self, duration):
+        """Wykonuje zaplanowane zdarzenia przez `duration` sekund; zdarzenia po terminie nie są już uruchamiane."""
+        self.stop_at = time.monotonic() + duration
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            while True:
+                with self.events_lock:
+                    event = self.events[0] if self.events else None
+                    if event and event[0] <= time.monotonic():
+                        heapq.heappop(self.events)
+                if event is None or event[0] >= self.stop_at:
+                    if time.monotonic() >= self.stop_at:
+                        break
+                    time.sleep(0.01)
+                    continue
+                if event[0] > time.monotonic():
+                    time.sleep(min(0.01, event[0] - time.monotonic()))
+                    continue
+                pool.submit(self.handle, event[0], event[2], event[3], event[4])
+        return time.monotonic() - started
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_local_server(workdir, args):
+    env = dict(os.environ, DATABASE_FILE=os.path.join(workdir, "load.db"), API_KEY=args.api_key,
+               INGEST_SPOOL_DIR=os.path.join(workdir, "ingest_spool"), REPORT_INGEST_MODE=args.ingest_mode)
+    flask_cmd = [sys.executable, "-m", "flask", "--app", os.path.join(APP_DIR, "app.py")]
+    subprocess.run(flask_cmd + ["init-db"], env=env, check=True, capture_output=True)
+    port = free_port()
+    log = open(os.path.join(workdir, "server.log"), "w")
+    if args.server == "waitress":
+        serve_cmd = ["serve", "--host", "127.0.0.1", "--port", str(port), "--threads", str(args.server_threads)]
+    else:
+        serve_cmd = ["run", "--port", str(port), "--with-threads"]
+    proc = subprocess.Popen(flask_cmd + serve_cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}/api"
+    for _ in range(100):
+        try:
+            requests.get(f"{base_url}/ingest/stats", headers={"X-API-Key": args.api_key}, timeout=1)
+            return proc, base_url, env["DATABASE_FILE"]
+        except requests.RequestException:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("Serwer testowy nie wystartował - szczegóły w " + log.name)
+
+
+def database_snapshot(path):
+    if not path: return None
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        counts = {t: db.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in DB_TABLES}
+    finally:
+        db.close()
+    size = sum(os.path.getsize(path + s) for s in ("", "-wal") if os.path.exists(path + s))
+    return {"bytes": size, "rows": counts}
+
+
+def warm_up(run, agents):
+    """Pierwsze pełne raporty całej floty (serwer poznaje komputery); mierzone osobno od scenariusza."""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=run.args.concurrency) as pool:
+        list(pool.map(run.send_report, agents))
+    return time.perf_counter() - started
+
+
+def run_scenario(args, base_url, db_path):
+    rng = random.Random(args.seed)
+    catalog = [{"name": f"Aplikacja {i}", "id": f"Vendor{i % 50}.App{i}", "version": f"{i % 9}.{i % 5}"}
+               for i in range(400)]
+    agents = [VirtualAgent(i, catalog, rng) for i in range(args.agents)]
+    run = LoadRun(args, base_url, agents, catalog)
+    result = {"scenario": args.scenario, "agents": args.agents, "duration": args.duration, "seed": args.seed,
+              "report_rate": args.report_rate, "poll_interval": args.poll_interval,
+              "dashboard_rate": args.dashboard_rate, "server": None if args.url else args.server}
+    if args.scenario != "boot-storm":
+        result["warm_up_s"] = round(warm_up(run, agents), 2)
+        run.stats = Stats()
+    before = database_snapshot(db_path)
+    now = time.monotonic()
+    interval = args.agents / args.report_rate
+    for i, agent in enumerate(agents):
+        # boot-storm: wszyscy raportują od razu; pozostałe scenariusze - sloty rozłożone równo w cyklu.
+        first_report = now if args.scenario == "boot-storm" else now + interval * rng.random()
+        run.schedule(first_report, "report", agent)
+        run.schedule(now + args.poll_interval * i / args.agents, "tasks", agent)
+        if args.dashboard_rate > 0:
+            run.schedule(now + args.agents / args.dashboard_rate * rng.random(), "page", agent)
+    rollout_id = None
+    if args.scenario == "rollout":
+        r = requests.post(f"{base_url}/rollouts", headers={"X-API-Key": args.api_key}, timeout=30, json={
+            "package_id": ROLLOUT_PACKAGE, "wave_size": args.wave_size, "max_concurrent": args.max_concurrent,
+            "failure_threshold": 0.5})
+        r.raise_for_status()
+        rollout_id = r.json()["id"]
+    elapsed = run.run(args.duration)
+    result["elapsed_s"] = round(elapsed, 2)
+    result["endpoints"] = run.stats.summary(elapsed)
+    if rollout_id:
+        rollout = requests.get(f"{base_url}/rollouts/{rollout_id}", headers={"X-API-Key": args.api_key},
+                               timeout=30).json()
+        result["rollout"] = {k: rollout.get(k) for k in ("status", "total", "succeeded", "failed", "running", "held")}
+    after = database_snapshot(db_path)
+    if before and after:
+        result["database"] = {"bytes_before": before["bytes"], "bytes_after": after["bytes"],
+                              "rows_added": {t: after["rows"][t] - before["rows"][t] for t in DB_TABLES}}
+    return result
+
+
+def print_result(result, baseline=None):
+    print(f"Scenariusz: {result['scenario']}, agentów: {result['agents']}, czas: {result['elapsed_s']}s, "
+          f"seed: {result['seed']}" + (f", rozgrzewka {result['warm_up_s']}s" if "warm_up_s" in result else ""))
+    header = f"{'endpoint':<8} {'żądań':>7} {'req/s':>8} {'błędy':>7} {'429':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    print(header + ("  p95 wcześniej" if baseline else ""))
+    for kind, s in result["endpoints"].items():
+        if kind.startswith("_"): continue
+        line = (f"{kind:<8} {s['requests']:>7} {s['rps']:>8.1f} {s['error_rate']:>7.1%} {s['rejected_429']:>5} "
+                f"{s['p50_ms']:>8.1f} {s['p95_ms']:>8.1f} {s['p99_ms']:>8.1f}")
+        old = (baseline or {}).get("endpoints", {}).get(kind)
+        if old:
+            line += f"  {old['p95_ms']:>8.1f} ({(s['p95_ms'] - old['p95_ms']) / max(old['p95_ms'], 0.01):+.0%})"
+        print(line)
+    client = result["endpoints"]["_client"]
+    print(f"Opóźnienie harmonogramu klienta p95: {client['schedule_lag_p95_ms']:.0f} ms "
+          "(duże wartości = za mało --concurrency, wynik zaniżony)")
+    if "rollout" in result:
+        print("Wdrożenie:", ", ".join(f"{k}={v}" for k, v in result["rollout"].items()))
+    if "database" in result:
+        d = result["database"]
+        rows = ", ".join(f"{t} +{n}" for t, n in d["rows_added"].items() if n)
+        print(f"Baza: {d['bytes_before'] / 1e6:.1f} MB -> {d['bytes_after'] / 1e6:.1f} MB; wiersze: {rows or 'bez zmian'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=("steady", "boot-storm", "rollout"), default="steady")
+    parser.add_argument("--agents", type=int, default=200, help="liczba wirtualnych agentów")
+    parser.add_argument("--duration", type=float, default=60, help="czas pomiaru w sekundach")
+    parser.add_argument("--report-rate", type=float, default=5, help="raportów na sekundę w całej flocie")
+    parser.add_argument("--poll-interval", type=float, default=15, help="co ile sekund agent pyta o zadania")
+    parser.add_argument("--drift", type=float, default=0.01, help="prawdopodobieństwo zmiany aplikacji na raport")
+    parser.add_argument("--task-seconds", type=float, default=2, help="symulowany czas wykonania zadania")
+    parser.add_argument("--task-failure-rate", type=float, default=0.05, help="odsetek zadań kończonych błędem")
+    parser.add_argument("--wave-size", type=int, default=50, help="rozmiar fali (scenariusz rollout)")
+    parser.add_argument("--max-concurrent", type=int, default=20, help="limit równoległych zadań (rollout)")
+    parser.add_argument("--dashboard-rate", type=float, default=0, help="odczytów stron panelu na sekundę")
+    parser.add_argument("--concurrency", type=int, default=32, help="liczba wątków klienta")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--url", help="adres API istniejącej instancji, np. http://10.0.0.5:5000/api")
+    parser.add_argument("--api-key", default=os.getenv("API_KEY") or "load-test-key")
+    parser.add_argument("--ingest-mode", choices=("sync", "async"), default="sync",
+                        help="REPORT_INGEST_MODE lokalnego serwera")
+    parser.add_argument("--server", choices=("flask", "waitress"), default="flask", help="lokalny serwer")
+    parser.add_argument("--server-threads", type=int, default=32, help="wątki serwera waitress")
+    parser.add_argument("--json", help="zapisz wynik do pliku JSON")
+    parser.add_argument("--compare", help="porównaj z wynikiem zapisanym wcześniej przez --json")
+    args = parser.parse_args()
+
+    workdir, proc, db_path = None, None, None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        workdir = tempfile.mkdtemp(prefix="winget-load-")
+        proc, base_url, db_path = start_local_server(workdir, args)
+    try:
+        result = run_scenario(args, base_url, db_path)
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=30)
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    try:
+        result["commit"] = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR, capture_output=True,
+                                          text=True).stdout.strip() or None
+    except OSError:
+        result["commit"] = None
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"Porównanie z {args.compare} (commit {baseline.get('commit')})")
+        if (baseline.get("scenario"), baseline.get("agents")) != (result["scenario"], result["agents"]):
+            print("Uwaga: wynik bazowy dotyczy innego scenariusza lub liczby agentów - porównanie orientacyjne.")
+    print_result(result, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,31 +1,63 @@
+DROP VIEW IF EXISTS report_applications;
 DROP TABLE IF EXISTS computers;
 DROP TABLE IF EXISTS applications;
+DROP TABLE IF EXISTS snapshot_apps;
+DROP TABLE IF EXISTS app_snapshots;
 DROP TABLE IF EXISTS updates;
 DROP TABLE IF EXISTS tasks;
+DROP TABLE IF EXISTS rollouts;
 DROP TABLE IF EXISTS action_history;
 DROP TABLE IF EXISTS reports;
+DROP TABLE IF EXISTS fleet_apps;
+DROP TABLE IF EXISTS fleet_app_versions;
+DROP TABLE IF EXISTS fleet_updates;
+DROP TABLE IF EXISTS fleet_update_counts;
+DROP TABLE IF EXISTS catalog_packages;
 
+-- computers.latest_report_id wskazuje ostatni raport komputera; ustawiany przy zapisie raportu,
+-- żeby odczyty nie musiały za każdym razem szukać go w tabeli reports.
+-- computers.page_version rośnie przy każdej zmianie danych komputera (raport, zadanie, wynik zadania)
+-- i razem z ETag unieważnia zapamiętane strony panelu.
 CREATE TABLE computers (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     hostname TEXT UNIQUE NOT NULL,
     ip_address TEXT NOT NULL,
     reboot_required BOOLEAN NOT NULL DEFAULT 0,
-    last_report TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    last_report TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    latest_report_id INTEGER REFERENCES reports (id),
+    page_version INTEGER NOT NULL DEFAULT 0
 );
 CREATE TABLE reports (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     computer_id INTEGER NOT NULL,
     report_timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (computer_id) REFERENCES computers (id) ON DELETE CASCADE
+    snapshot_id INTEGER,
+    state_hash TEXT,
+    FOREIGN KEY (computer_id) REFERENCES computers (id) ON DELETE CASCADE,
+    FOREIGN KEY (snapshot_id) REFERENCES app_snapshots (id)
 );
-CREATE TABLE applications (
+CREATE INDEX idx_reports_computer_time ON reports (computer_id, report_timestamp DESC, id DESC);
+CREATE INDEX idx_reports_snapshot ON reports (snapshot_id);
+-- Migawki listy aplikacji: każdy unikalny zestaw (nazwa, id, wersja) zapisywany jest tylko raz,
+-- a raporty wskazują na niego przez reports.snapshot_id.
+CREATE TABLE app_snapshots (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
-    report_id INTEGER NOT NULL,
+    content_hash TEXT UNIQUE NOT NULL,
+    app_count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE snapshot_apps (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    snapshot_id INTEGER NOT NULL,
     name TEXT NOT NULL,
     version TEXT,
     app_id TEXT,
-    FOREIGN KEY (report_id) REFERENCES reports (id) ON DELETE CASCADE
+    FOREIGN KEY (snapshot_id) REFERENCES app_snapshots (id) ON DELETE CASCADE
 );
+CREATE INDEX idx_snapshot_apps_snapshot ON snapshot_apps (snapshot_id);
+CREATE VIEW report_applications AS
+    SELECT r.id AS report_id, sa.name, sa.version, sa.app_id
+    FROM reports r JOIN snapshot_apps sa ON sa.snapshot_id = r.snapshot_id;
 CREATE TABLE updates (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     report_id INTEGER NOT NULL,
@@ -35,8 +67,19 @@ CREATE TABLE updates (
     available_version TEXT,
     update_type TEXT NOT NULL,
     status TEXT NOT NULL DEFAULT 'Do uaktualnienia',
+    from_catalog INTEGER NOT NULL DEFAULT 0,
     FOREIGN KEY (report_id) REFERENCES reports (id) ON DELETE CASCADE
 );
+CREATE INDEX idx_updates_report ON updates (report_id, update_type);
+-- Katalog wersji pakietów (flask import-catalog): najnowsza znana wersja każdego pakietu winget. Przy
+-- UPDATE_SOURCE=catalog serwer sam dopisuje z niego aktualizacje do raportów (updates.from_catalog = 1);
+-- stan raportu widziany przez agenta (skrót, delta) obejmuje tylko wiersze z from_catalog = 0.
+CREATE TABLE catalog_packages (
+    package_id TEXT PRIMARY KEY COLLATE NOCASE,
+    name TEXT,
+    latest_version TEXT NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) WITHOUT ROWID;
 CREATE TABLE tasks (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     computer_id INTEGER NOT NULL,
@@ -45,13 +88,102 @@ CREATE TABLE tasks (
     status TEXT NOT NULL DEFAULT 'oczekuje',
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    rollout_id INTEGER REFERENCES rollouts (id),
+    wave INTEGER,
+    duration_seconds REAL,
+    queue_wait_seconds REAL,
     FOREIGN KEY (computer_id) REFERENCES computers (id) ON DELETE CASCADE
 );
+CREATE INDEX idx_tasks_computer_status ON tasks (computer_id, status);
+CREATE INDEX idx_tasks_rollout ON tasks (rollout_id, wave, status);
+-- duration_seconds/queue_wait_seconds: czas wykonania i czas w kolejce agenta, zgłaszane z wynikiem zadania.
+-- Wdrożenie zbiorcze: zadania z rollout_id czekają ze statusem 'wstrzymane' i są zwalniane falami
+-- (wave = numer fali) z limitem max_concurrent; failure_threshold to dopuszczalny odsetek błędów (0-1).
+CREATE TABLE rollouts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    package_id TEXT NOT NULL,
+    name TEXT,
+    status TEXT NOT NULL DEFAULT 'aktywne',
+    wave_size INTEGER NOT NULL,
+    max_concurrent INTEGER NOT NULL,
+    failure_threshold REAL NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+-- Dziennik zdarzeń: typowane kolumny zamiast JSON. dedupe_key (unikalny per komputer) odrzuca powtórki
+-- przy zapisie: 'task|<id>' dla wyników zadań, 'OS_UPDATE_SUCCESS|<tytuł>|<nr tygodnia>' dla aktualizacji
+-- systemu. is_latest = 1 ma tylko najnowsze zdarzenie danej pary (typ, nazwa) komputera.
 CREATE TABLE action_history (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     computer_id INTEGER NOT NULL,
     timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     action_type TEXT NOT NULL,
-    details TEXT,
+    name TEXT NOT NULL DEFAULT '',
+    from_version TEXT,
+    to_version TEXT,
+    task_id INTEGER,
+    dedupe_key TEXT,
+    is_latest INTEGER NOT NULL DEFAULT 1,
     FOREIGN KEY (computer_id) REFERENCES computers (id) ON DELETE CASCADE
-);
\ No newline at end of file
+);
+CREATE INDEX idx_action_history_computer_time ON action_history (computer_id, timestamp);
+CREATE UNIQUE INDEX idx_action_history_dedupe ON action_history (computer_id, dedupe_key);
+CREATE INDEX idx_action_history_latest_key ON action_history (computer_id, action_type, name) WHERE is_latest = 1;
+CREATE INDEX idx_action_history_latest_time ON action_history (computer_id, timestamp DESC, id DESC) WHERE is_latest = 1;
+-- Indeks floty: stan z ostatniego raportu każdego komputera (aktualizowany przy zapisie raportu)
+-- oraz liczniki hostów na aplikację/wersję i na oczekującą aktualizację, utrzymywane przez triggery.
+CREATE TABLE fleet_apps (
+    computer_id INTEGER NOT NULL,
+    app_key TEXT NOT NULL,
+    name TEXT,
+    app_id TEXT,
+    version TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (computer_id, app_key)
+) WITHOUT ROWID;
+CREATE INDEX idx_fleet_apps_app ON fleet_apps (app_key, version);
+CREATE TABLE fleet_app_versions (
+    app_key TEXT NOT NULL,
+    version TEXT NOT NULL,
+    name TEXT,
+    hosts INTEGER NOT NULL,
+    PRIMARY KEY (app_key, version)
+) WITHOUT ROWID;
+CREATE TABLE fleet_updates (
+    computer_id INTEGER NOT NULL,
+    update_type TEXT NOT NULL,
+    app_key TEXT NOT NULL,
+    name TEXT,
+    app_id TEXT,
+    current_version TEXT,
+    available_version TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (computer_id, update_type, app_key)
+) WITHOUT ROWID;
+CREATE INDEX idx_fleet_updates_app ON fleet_updates (update_type, app_key);
+CREATE TABLE fleet_update_counts (
+    update_type TEXT NOT NULL,
+    app_key TEXT NOT NULL,
+    available_version TEXT NOT NULL,
+    name TEXT,
+    hosts INTEGER NOT NULL,
+    PRIMARY KEY (update_type, app_key, available_version)
+) WITHOUT ROWID;
+CREATE TRIGGER fleet_apps_insert AFTER INSERT ON fleet_apps BEGIN
+    INSERT INTO fleet_app_versions (app_key, version, name, hosts) VALUES (NEW.app_key, NEW.version, NEW.name, 1)
+    ON CONFLICT (app_key, version) DO UPDATE SET hosts = hosts + 1, name = excluded.name;
+END;
+CREATE TRIGGER fleet_apps_delete AFTER DELETE ON fleet_apps BEGIN
+    UPDATE fleet_app_versions SET hosts = hosts - 1 WHERE app_key = OLD.app_key AND version = OLD.version;
+    DELETE FROM fleet_app_versions WHERE app_key = OLD.app_key AND version = OLD.version AND hosts <= 0;
+END;
+CREATE TRIGGER fleet_updates_insert AFTER INSERT ON fleet_updates BEGIN
+    INSERT INTO fleet_update_counts (update_type, app_key, available_version, name, hosts)
+    VALUES (NEW.update_type, NEW.app_key, NEW.available_version, NEW.name, 1)
+    ON CONFLICT (update_type, app_key, available_version) DO UPDATE SET hosts = hosts + 1, name = excluded.name;
+END;
+CREATE TRIGGER fleet_updates_delete AFTER DELETE ON fleet_updates BEGIN
+    UPDATE fleet_update_counts SET hosts = hosts - 1
+    WHERE update_type = OLD.update_type AND app_key = OLD.app_key AND available_version = OLD.available_version;
+    DELETE FROM fleet_update_counts
+    WHERE update_type = OLD.update_type AND app_key = OLD.app_key AND available_version = OLD.available_version
+      AND hosts <= 0;
+END;
\ No newline at end of file
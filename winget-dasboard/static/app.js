@@ -129,4 +129,27 @@ document.addEventListener('DOMContentLoaded', function() {
             textarea.value = cleaned;
         });
     }
-});
\ No newline at end of file
+});
+
+// Stan budowania agent.exe w generatorze (settings.html) - odpytywany, dopóki budowanie trwa
+document.addEventListener('DOMContentLoaded', function() {
+    var box = document.getElementById('agent-build');
+    if (!box || ['queued', 'building'].indexOf(box.dataset.status) === -1) return;
+    var message = document.getElementById('agent-build-message');
+    var poll = function() {
+        fetch(box.dataset.statusUrl)
+            .then(response => response.json())
+            .then(data => {
+                message.textContent = data.message;
+                message.className = data.css_class;
+                if (data.status === 'ready') {
+                    document.getElementById('download-agent-btn').disabled = false;
+                } else if (data.status === 'failed') {
+                    location.reload();
+                } else {
+                    setTimeout(poll, 5000);
+                }
+            }).catch(() => setTimeout(poll, 15000));
+    };
+    setTimeout(poll, 5000);
+});
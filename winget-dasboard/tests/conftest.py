@@ -0,0 +1,58 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Ustawienia muszą być znane przed importem app (czyta je przy imporcie).
+TEST_DIR = tempfile.mkdtemp(prefix="winget-dashboard-tests-")
+os.environ.update(DATABASE_FILE=os.path.join(TEST_DIR, "unused.db"), API_KEY="test-key",
+                  AGENT_BUILD_DIR=os.path.join(TEST_DIR, "agent_build"),
+                  INGEST_SPOOL_DIR=os.path.join(TEST_DIR, "ingest_spool"), REPORT_INGEST_MODE="sync")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as dashboard  # noqa: E402
+
+API_HEADERS = {"X-API-Key": "test-key"}
+
+
+def use_database(path):
+    """Przełącza aplikację na inny plik bazy: zamyka połączenia z puli i czyści pamięć stron."""
+    db = getattr(dashboard.db_readers, "db", None)
+    if db is not None:
+        db.close()
+        dashboard.db_readers.db = None
+    if dashboard.db_writer is not None:
+        dashboard.db_writer.close()
+        dashboard.db_writer = None
+    dashboard.DATABASE = str(path)
+    dashboard.schema_checked = False
+    dashboard.page_cache.clear()
+    dashboard.ingest_heads.clear()
+    # Wątki w tle (retencja, nadzór wdrożeń) nie są potrzebne - testy wołają ich funkcje bezpośrednio.
+    dashboard.retention_worker = False
+    dashboard.rollout_watchdog = False
+
+
+@pytest.fixture
+def app_db(tmp_path):
+    """Świeża baza z aktualnym schematem (flask init-db) w katalogu tymczasowym."""
+    use_database(tmp_path / "dashboard.db")
+    result = dashboard.app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0, result.output
+    yield tmp_path / "dashboard.db"
+    use_database(tmp_path / "closed.db")
+
+
+@pytest.fixture
+def client(app_db):
+    return dashboard.app.test_client()
+
+
+def send_report(client, hostname, installed_apps=(), app_updates=(), os_updates=(), **extra):
+    """Wysyła pełny raport agenta; zwraca odpowiedź serwera."""
+    data = {"hostname": hostname, "ip_address": "10.0.0.1", "reboot_required": False,
+            "installed_apps": list(installed_apps), "available_app_updates": list(app_updates),
+            "pending_os_updates": list(os_updates)}
+    data.update(extra)
+    return client.post("/api/report", json=data, headers=API_HEADERS)
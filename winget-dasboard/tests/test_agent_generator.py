@@ -0,0 +1,115 @@
+"""Generator agenta: budowanie na żądanie, pobieranie paczki i podpis agent_config.json sprawdzany przez agenta."""
+import io
+import json
+import os
+import sys
+import time
+import zipfile
+
+import pytest
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+
+from conftest import dashboard
+
+FORM = {"api_endpoint_1": "http://panel:5000/api/report", "api_endpoint_2": "", "api_key": "test-key",
+        "loop_interval": "15", "report_interval": "240", "winget_path": "", "blacklist_keywords": "microsoft\nedge\n"}
+
+
+@pytest.fixture
+def build_dir(tmp_path, monkeypatch):
+    """Pusty katalog budowania i brak klucza podpisu; PyInstaller zastąpiony zapisem atrapy agent.exe."""
+    monkeypatch.setattr(dashboard, "AGENT_BUILD_DIR", str(tmp_path / "agent_build"))
+    monkeypatch.setattr(dashboard, "config_signing_key_cache", None)
+    monkeypatch.setattr(dashboard, "agent_builds", {})
+    monkeypatch.setattr(dashboard.shutil, "which", lambda name: f"/usr/bin/{name}")
+
+    def fake_build(key):
+        os.makedirs(os.path.dirname(dashboard.agent_exe_path(key)), exist_ok=True)
+        with open(dashboard.agent_exe_path(key), "wb") as f:
+            f.write(b"MZ agent " + dashboard.config_public_key().encode("ascii"))
+    monkeypatch.setattr(dashboard, "build_agent", fake_build)
+    return tmp_path / "agent_build"
+
+
+def wait_for_build(timeout=10):
+    deadline = time.monotonic() + timeout
+    while dashboard.agent_build_status()["status"] != "ready":
+        assert time.monotonic() < deadline, dashboard.agent_build_status()
+        time.sleep(0.05)
+
+
+def test_viewing_settings_builds_nothing(client, build_dir):
+    page = client.get("/settings")
+    assert page.status_code == 200
+    assert "Zbuduj agenta" in page.get_data(as_text=True)
+    assert not (build_dir / "config_signing.key").exists()
+    assert dashboard.agent_builds == {}
+    assert client.get("/settings/agent_build").get_json()["status"] == "missing"
+
+
+def test_build_on_request_then_download(client, build_dir):
+    assert client.post("/settings/agent_build").status_code == 302
+    assert (build_dir / "config_signing.key").exists()
+    wait_for_build()
+    response = client.post("/settings/generate_exe", data=dict(FORM, download="package"))
+    assert response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
+        assert sorted(zf.namelist()) == ["agent.exe", "agent_config.json"]
+        document = json.loads(zf.read("agent_config.json"))
+        exe = zf.read("agent.exe")
+    assert document["config"]["api_endpoints"] == ["http://panel:5000/api/report"]
+    assert document["config"]["blacklist_keywords"] == ["microsoft", "edge"]
+    # W agencie jest tylko klucz publiczny - sekret podpisu zostaje na serwerze.
+    secret = (build_dir / "config_signing.key").read_text(encoding="utf-8").strip()
+    assert secret.encode("ascii") not in exe
+
+
+def load_config_function(public_key, config_path):
+    """Wykonuje sekcję konfiguracji z agent_template.py.txt (bez części usługi Windows) z podanym kluczem publicznym."""
+    source = dashboard.AGENT_TEMPLATE.replace("__CONFIG_PUBLIC_KEY__", public_key)
+    start = source.index("# --- Konfiguracja z pliku agent_config.json ---")
+    end = source.index("try:\n    AGENT_CONFIG, AGENT_CONFIG_PATH = load_agent_config()")
+    namespace = {"os": os, "sys": sys, "json": json, "__file__": str(config_path),
+                 "Ed25519PublicKey": Ed25519PublicKey, "InvalidSignature": InvalidSignature}
+    exec(compile(source[start:end], "agent_template.py.txt", "exec"), namespace)
+    namespace["config_search_paths"] = lambda: [str(config_path)]
+    return namespace["load_agent_config"]
+
+
+@pytest.fixture
+def signed_config(client, build_dir, tmp_path):
+    response = client.post("/settings/generate_exe", data=dict(FORM, download="config"))
+    assert response.status_code == 200
+    path = tmp_path / "agent_config.json"
+    path.write_bytes(response.data)
+    return path
+
+
+def test_agent_accepts_config_signed_by_server(signed_config):
+    load_agent_config = load_config_function(dashboard.config_public_key(), signed_config)
+    settings, path = load_agent_config()
+    assert settings["api_key"] == "test-key"
+    assert path == str(signed_config)
+
+
+def test_agent_rejects_modified_config(signed_config):
+    document = json.loads(signed_config.read_text(encoding="utf-8"))
+    document["config"]["api_endpoints"] = ["http://attacker/api/report"]
+    signed_config.write_text(json.dumps(document), encoding="utf-8")
+    with pytest.raises(ValueError, match="niepoprawny podpis"):
+        load_config_function(dashboard.config_public_key(), signed_config)()
+
+
+def test_agent_rejects_config_from_another_server(signed_config):
+    other_key = dashboard.Ed25519PrivateKey.generate().public_key()
+    other_hex = other_key.public_bytes(dashboard.Encoding.Raw, dashboard.PublicFormat.Raw).hex()
+    with pytest.raises(ValueError, match="niepoprawny podpis"):
+        load_config_function(other_hex, signed_config)()
+
+
+def test_agent_rejects_unsigned_config(tmp_path):
+    path = tmp_path / "agent_config.json"
+    path.write_text(json.dumps({"config": {"api_key": "x"}}), encoding="utf-8")
+    with pytest.raises(ValueError, match="niepoprawny podpis"):
+        load_config_function("00" * 32, path)()
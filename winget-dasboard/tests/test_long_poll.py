@@ -0,0 +1,69 @@
+"""Long-poll zadań (/api/tasks/<hostname>/wait): trzymanie żądania, wybudzanie po zleceniu i limit miejsc."""
+import threading
+import time
+
+from conftest import API_HEADERS, dashboard, send_report
+
+
+def wait_for_tasks(client, hostname, timeout):
+    return client.get(f"/api/tasks/{hostname}/wait?timeout={timeout}", headers=API_HEADERS)
+
+
+def test_unknown_host_is_not_held(client):
+    response = wait_for_tasks(client, "nieznany", 30)
+    assert response.get_json() == []
+    assert response.headers["X-Long-Poll"] == "0"
+
+
+def test_pending_task_is_returned_immediately(client):
+    send_report(client, "pc01")
+    client.post("/computer/1/refresh")
+    started = time.monotonic()
+    response = wait_for_tasks(client, "pc01", 30)
+    assert time.monotonic() - started < 2
+    assert [t["command"] for t in response.get_json()] == ["force_report"]
+    assert response.headers["X-Long-Poll"] == "1"
+
+
+def test_poll_without_tasks_is_held_until_timeout(client):
+    send_report(client, "pc01")
+    started = time.monotonic()
+    response = wait_for_tasks(client, "pc01", 1)
+    assert 0.9 <= time.monotonic() - started < 3
+    assert response.get_json() == []
+    assert response.headers["X-Long-Poll"] == "1"
+
+
+def test_queued_task_wakes_the_waiting_agent(client):
+    send_report(client, "pc01")
+    result = {}
+
+    def poll():
+        started = time.monotonic()
+        result["response"] = wait_for_tasks(dashboard.app.test_client(), "pc01", 30)
+        result["elapsed"] = time.monotonic() - started
+    waiter = threading.Thread(target=poll)
+    waiter.start()
+    time.sleep(0.5)
+    client.post("/computer/1/refresh")
+    waiter.join(timeout=10)
+    assert [t["command"] for t in result["response"].get_json()] == ["force_report"]
+    assert result["elapsed"] < 5  # wybudzone zleceniem, a nie po 30 s ani po ponownym sprawdzeniu bazy
+
+
+def test_full_long_poll_slots_fall_back_to_regular_polling(client, monkeypatch):
+    send_report(client, "pc01")
+    monkeypatch.setattr(dashboard, "long_poll_slots", threading.BoundedSemaphore(1))
+    dashboard.long_poll_slots.acquire()
+    started = time.monotonic()
+    response = wait_for_tasks(client, "pc01", 30)
+    assert time.monotonic() - started < 2
+    assert response.headers["X-Long-Poll"] == "0"
+
+
+def test_timeout_is_capped(client, monkeypatch):
+    send_report(client, "pc01")
+    monkeypatch.setattr(dashboard, "TASK_LONG_POLL_MAX_SECONDS", 1)
+    started = time.monotonic()
+    wait_for_tasks(client, "pc01", 600)
+    assert time.monotonic() - started < 3
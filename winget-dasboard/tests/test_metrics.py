@@ -0,0 +1,65 @@
+"""Endpoint /metrics: autoryzacja, format Prometheusa, metryki żądań i czasy zgłoszone przez agentów."""
+import pytest
+
+from conftest import API_HEADERS, dashboard, send_report
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics(monkeypatch):
+    monkeypatch.setattr(dashboard, "metric_values", {})
+
+
+def scrape(client, headers=API_HEADERS):
+    response = client.get("/metrics", headers=headers)
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    return {line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+            for line in response.get_data(as_text=True).splitlines() if line and not line.startswith("#")}
+
+
+def test_metrics_require_api_key(client):
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"X-API-Key": "zły"}).status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer test-key"}).status_code == 200
+
+
+def test_request_and_report_metrics(client):
+    send_report(client, "pc01", [{"name": "7-Zip", "id": "7zip.7zip", "version": "23.01"}])
+    client.get("/")
+    samples = scrape(client)
+    assert samples['winget_http_requests_total{method="POST",route="/api/report",status="200"}'] == 1
+    assert samples['winget_http_requests_total{method="GET",route="/",status="200"}'] == 1
+    assert samples['winget_http_request_duration_seconds_count{method="GET",route="/"}'] == 1
+    assert samples['winget_http_request_duration_seconds_bucket{method="GET",route="/",le="+Inf"}'] == 1
+    assert samples['winget_report_payload_bytes_count{mode="full"}'] == 1
+    assert samples['winget_sqlite_statement_duration_seconds_count{statement="INSERT"}'] > 0
+    assert samples["winget_computers"] >= 0
+    assert samples['winget_page_cache{result="misses"}'] >= 1
+
+
+def test_agent_timings_are_exported(client):
+    send_report(client, "pc01", collector_stats={
+        "installed_apps": {"status": "ok", "duration": 3.2},
+        "pending_os_updates": {"status": "cached", "duration": 0, "age": 60},
+    }, command_stats={
+        "winget list": {"count": 2, "total": 6.5, "max": 4.0, "failed": 1},
+        "zepsute": "nie słownik",
+    })
+    samples = scrape(client)
+    assert samples['winget_agent_collector_duration_seconds_bucket{collector="installed_apps",status="ok",le="5"}'] == 1
+    assert not any('collector="pending_os_updates"' in key for key in samples)  # wyniki z pamięci podręcznej agenta
+    assert samples['winget_agent_command_duration_seconds_sum{command="winget list"}'] == 6.5
+    assert samples['winget_agent_command_duration_seconds_count{command="winget list"}'] == 2
+    assert samples['winget_agent_command_failures_total{command="winget list"}'] == 1
+
+
+def test_task_gauge_counts_by_status(client):
+    send_report(client, "pc01")
+    client.post("/computer/1/refresh")
+    client.post("/computer/1/refresh")
+    client.get("/api/tasks/pc01", headers=API_HEADERS)
+    assert scrape(client)['winget_tasks{status="w toku"}'] == 2
+
+
+def test_label_values_are_escaped():
+    assert dashboard.metric_labels((("command", 'a"b\\c\nd'),)) == '{command="a\\"b\\\\c\\nd"}'
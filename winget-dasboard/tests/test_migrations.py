@@ -0,0 +1,125 @@
+"""Migracje schematu (flask migrate-db) od bazy z pierwszej wersji panelu (tests/fixtures/schema_v0.sql)."""
+import json
+import os
+import sqlite3
+
+import pytest
+
+from conftest import dashboard, use_database
+
+BASELINE_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "schema_v0.sql")
+
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    """Baza w schemacie sprzed migracji (user_version 0) z trzema raportami, zadaniem i dziennikiem w JSON."""
+    path = tmp_path / "baseline.db"
+    db = sqlite3.connect(path)
+    with open(BASELINE_SCHEMA, encoding="utf-8") as f:
+        db.executescript(f.read())
+    db.execute("INSERT INTO computers (hostname, ip_address) VALUES ('pc01', '10.0.0.1')")
+    for report_id, (chrome, timestamp) in enumerate([("123.0", "2024-05-01 10:00:00"),
+                                                     ("124.0", "2024-05-02 10:00:00"),
+                                                     ("124.0", "2024-05-03 10:00:00")], 1):
+        db.execute("INSERT INTO reports (computer_id, report_timestamp) VALUES (1, ?)", (timestamp,))
+        db.executemany("INSERT INTO applications (report_id, name, version, app_id) VALUES (?, ?, ?, ?)",
+                       [(report_id, "Google Chrome", chrome, "Google.Chrome"), (report_id, "7-Zip", "23.01", "7zip.7zip")])
+    db.execute("INSERT INTO updates (report_id, name, app_id, current_version, available_version, update_type) "
+               "VALUES (3, 'Google Chrome', 'Google.Chrome', '124.0', '125.0', 'APP')")
+    db.execute("INSERT INTO tasks (computer_id, command, payload, status) "
+               "VALUES (1, 'update_package', 'Google.Chrome', 'zakończone')")
+    db.executemany("INSERT INTO action_history (computer_id, timestamp, action_type, details) VALUES (1, ?, ?, ?)", [
+        ("2024-05-01 11:00:00", "OS_UPDATE_SUCCESS", json.dumps({"name": "KB5037771"})),
+        ("2024-05-01 12:00:00", "OS_UPDATE_SUCCESS", json.dumps({"name": "KB5037771"})),
+        ("2024-05-02 11:00:00", "APP_UPDATE_SUCCESS", json.dumps({"name": "Google Chrome", "from": "123.0", "to": "124.0"})),
+        ("2024-05-02 12:00:00", "APP_UNINSTALL_FAILURE", "not json"),
+    ])
+    db.commit()
+    db.close()
+    use_database(path)
+    yield path
+    use_database(tmp_path / "closed.db")
+
+
+def schema_of(path):
+    """Kolumny tabel i nazwy indeksów - do porównania bazy po migracjach z bazą z init-db."""
+    db = sqlite3.connect(path)
+    try:
+        objects = db.execute("SELECT type, name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'").fetchall()
+        return {(kind, name, tuple(sorted(c[1] for c in db.execute(f"PRAGMA table_info('{name}')")))
+                 if kind in ("table", "view") else ()) for kind, name in objects}
+    finally:
+        db.close()
+
+
+def test_migrates_baseline_to_current_schema(baseline_db, tmp_path):
+    result = dashboard.app.test_cli_runner().invoke(args=["migrate-db"])
+    assert result.exit_code == 0, result.output
+    assert f"do {dashboard.SCHEMA_VERSION}" in result.output
+
+    use_database(tmp_path / "fresh.db")
+    dashboard.app.test_cli_runner().invoke(args=["init-db"])
+    assert schema_of(baseline_db) == schema_of(tmp_path / "fresh.db")
+
+    db = sqlite3.connect(baseline_db)
+    assert db.execute("PRAGMA user_version").fetchone()[0] == dashboard.SCHEMA_VERSION
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    db.close()
+
+
+def test_migration_keeps_reports_and_history(baseline_db):
+    dashboard.app.test_cli_runner().invoke(args=["migrate-db"])
+    db = sqlite3.connect(baseline_db)
+    db.row_factory = sqlite3.Row
+    assert [tuple(r) for r in db.execute("SELECT report_id, app_id, version FROM report_applications "
+                                         "ORDER BY report_id, app_id")] == [
+        (1, "7zip.7zip", "23.01"), (1, "Google.Chrome", "123.0"), (2, "7zip.7zip", "23.01"), (2, "Google.Chrome", "124.0"),
+        (3, "7zip.7zip", "23.01"), (3, "Google.Chrome", "124.0")]
+    # Raporty z identyczną listą aplikacji dzielą jedną migawkę.
+    assert db.execute("SELECT COUNT(DISTINCT snapshot_id) FROM reports").fetchone()[0] == 2
+    assert db.execute("SELECT latest_report_id FROM computers").fetchone()[0] == 3
+    assert [tuple(r) for r in db.execute("SELECT app_id, available_version FROM updates")] == [("Google.Chrome", "125.0")]
+    events = [tuple(r) for r in db.execute("SELECT action_type, name, from_version, to_version, is_latest "
+                                           "FROM action_history ORDER BY id")]
+    assert events == [("OS_UPDATE_SUCCESS", "KB5037771", None, None, 0),
+                      ("OS_UPDATE_SUCCESS", "KB5037771", None, None, 1),
+                      ("APP_UPDATE_SUCCESS", "Google Chrome", "123.0", "124.0", 1),
+                      ("APP_UNINSTALL_FAILURE", "", None, None, 1)]
+    assert db.execute("SELECT status FROM tasks").fetchone()[0] == "zakończone"
+    db.close()
+
+
+def test_migrated_database_accepts_reports(baseline_db):
+    dashboard.app.test_cli_runner().invoke(args=["migrate-db"])
+    client = dashboard.app.test_client()
+    response = client.post("/api/report", headers={"X-API-Key": "test-key"}, json={
+        "hostname": "pc01", "ip_address": "10.0.0.2", "installed_apps": [
+            {"name": "Google Chrome", "id": "Google.Chrome", "version": "125.0"}],
+        "available_app_updates": [], "pending_os_updates": []})
+    assert response.status_code == 200
+    assert client.get("/computer/pc01").status_code == 200
+
+
+def test_migrate_db_is_idempotent(baseline_db):
+    runner = dashboard.app.test_cli_runner()
+    runner.invoke(args=["migrate-db"])
+    result = runner.invoke(args=["migrate-db"])
+    assert result.exit_code == 0
+    assert f"Schemat jest aktualny (wersja {dashboard.SCHEMA_VERSION})" in result.output
+
+
+def test_snapshot_migration_in_small_batches(baseline_db, monkeypatch):
+    db = sqlite3.connect(baseline_db)
+    db.execute("INSERT INTO reports (computer_id, report_timestamp) VALUES (1, '2024-05-04 10:00:00')")  # bez aplikacji
+    db.commit()
+    db.close()
+    monkeypatch.setattr(dashboard, "MIGRATION_BATCH_SIZE", 2)
+    result = dashboard.app.test_cli_runner().invoke(args=["migrate-db"])
+    assert result.exit_code == 0, result.output
+    assert "Zmigrowano 4 raportów" in result.output
+    db = sqlite3.connect(baseline_db)
+    assert db.execute("SELECT COUNT(*) FROM reports WHERE snapshot_id IS NULL").fetchone()[0] == 0
+    assert db.execute("SELECT app_count FROM app_snapshots s JOIN reports r ON r.snapshot_id = s.id "
+                      "WHERE r.id = 4").fetchone()[0] == 0
+    assert db.execute("SELECT COUNT(*) FROM report_applications WHERE report_id = 3").fetchone()[0] == 2
+    db.close()
@@ -0,0 +1,65 @@
+"""Strony panelu: rewalidacja ETag (304) i pamięć wyrenderowanych stron unieważniana przez page_version."""
+import pytest
+
+from conftest import API_HEADERS, dashboard, send_report
+
+CHROME = {"name": "Google Chrome", "id": "Google.Chrome", "version": "123.0"}
+
+
+def revalidate(client, url, etag):
+    return client.get(url, headers={"If-None-Match": etag})
+
+
+@pytest.mark.parametrize("url", ["/", "/computer/pc01", "/computer/pc01/history", "/report/1"])
+def test_unchanged_page_is_not_modified(client, url):
+    send_report(client, "pc01", [CHROME])
+    page = client.get(url)
+    assert page.status_code == 200
+    assert page.headers["Cache-Control"] == "private, no-cache"
+    response = revalidate(client, url, page.headers["ETag"])
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_new_report_invalidates_computer_pages(client):
+    send_report(client, "pc01", [CHROME])
+    send_report(client, "pc02", [CHROME])
+    pages = {url: client.get(url).headers["ETag"] for url in ("/", "/computer/pc01", "/computer/pc02")}
+    send_report(client, "pc01", [dict(CHROME, version="124.0")], ip_address="10.0.0.9")
+    response = revalidate(client, "/computer/pc01", pages["/computer/pc01"])
+    assert response.status_code == 200
+    assert "124.0" in response.get_data(as_text=True)
+    assert revalidate(client, "/", pages["/"]).status_code == 200
+    assert revalidate(client, "/computer/pc02", pages["/computer/pc02"]).status_code == 304
+
+
+def test_dispatched_task_invalidates_computer_page(client):
+    send_report(client, "pc01", [CHROME])
+    etag = client.get("/computer/pc01").headers["ETag"]
+    assert client.post("/computer/1/refresh").status_code == 200
+    assert revalidate(client, "/computer/pc01", etag).status_code == 200
+    etag = client.get("/computer/pc01").headers["ETag"]
+    task = client.get("/api/tasks/pc01", headers=API_HEADERS).get_json()[0]
+    client.post("/api/tasks/result", headers=API_HEADERS, json={"task_id": task["id"], "status": "zakończone"})
+    assert revalidate(client, "/computer/pc01", etag).status_code == 200
+
+
+def test_rendered_page_is_reused_until_version_changes(client, monkeypatch):
+    send_report(client, "pc01", [CHROME])
+    renders = []
+    render_template = dashboard.render_template
+    monkeypatch.setattr(dashboard, "render_template", lambda *a, **kw: renders.append(a[0]) or render_template(*a, **kw))
+    client.get("/computer/pc01")
+    client.get("/computer/pc01")
+    assert renders == ["computer.html"]
+    send_report(client, "pc01", [dict(CHROME, version="124.0")])
+    client.get("/computer/pc01")
+    assert renders == ["computer.html", "computer.html"]
+
+
+def test_cache_is_bounded(client, monkeypatch):
+    monkeypatch.setattr(dashboard, "PAGE_CACHE_SIZE", 2)
+    for hostname in ("pc01", "pc02", "pc03"):
+        send_report(client, hostname, [CHROME])
+        client.get(f"/computer/{hostname}")
+    assert list(dashboard.page_cache) == [("computer", "pc02"), ("computer", "pc03")]
@@ -0,0 +1,87 @@
+"""Protokół raportów różnicowych: pełny raport, delta względem potwierdzonego stanu i żądanie resynchronizacji."""
+import sqlite3
+
+from conftest import API_HEADERS, dashboard, send_report
+
+APPS = [{"name": "Google Chrome", "id": "Google.Chrome", "version": "123.0"},
+        {"name": "7-Zip", "id": "7zip.7zip", "version": "23.01"}]
+UPDATES = [{"name": "Google Chrome", "id": "Google.Chrome", "current_version": "123.0", "available_version": "124.0"}]
+OS_UPDATES = [{"Title": "2024-05 Cumulative Update (KB5037771)", "KB": ["5037771"]}]
+
+
+def state_of(installed_apps, app_updates=(), os_updates=()):
+    return dashboard.normalize_report_state({"installed_apps": list(installed_apps),
+                                             "available_app_updates": list(app_updates),
+                                             "pending_os_updates": list(os_updates)})
+
+
+def send_delta(client, base_hash, new_state, delta, state_hash=None):
+    return client.post("/api/report", headers=API_HEADERS, json={
+        "hostname": "pc01", "ip_address": "10.0.0.1", "reboot_required": False, "protocol_version": 2,
+        "mode": "delta", "base_hash": base_hash, "delta": delta,
+        "state_hash": state_hash or dashboard.compute_state_hash(new_state)})
+
+
+def latest_apps(db_path):
+    db = sqlite3.connect(db_path)
+    try:
+        return sorted(db.execute("SELECT ra.app_id, ra.version FROM computers c "
+                                 "JOIN report_applications ra ON ra.report_id = c.latest_report_id").fetchall())
+    finally:
+        db.close()
+
+
+def test_full_report_returns_state_hash(client):
+    response = send_report(client, "pc01", APPS, UPDATES, OS_UPDATES)
+    assert response.status_code == 200
+    assert response.get_json()["state_hash"] == dashboard.compute_state_hash(state_of(APPS, UPDATES, OS_UPDATES))
+
+
+def test_delta_is_applied_to_acknowledged_state(client, app_db):
+    base_hash = send_report(client, "pc01", APPS, UPDATES).get_json()["state_hash"]
+    new_apps = [dict(APPS[0], version="124.0"), {"name": "Notepad++", "id": "Notepad++.Notepad++", "version": "8.6"}]
+    delta = {
+        "installed_apps": {"added": [new_apps[1]], "removed": ["7zip.7zip"], "changed": [new_apps[0]]},
+        "available_app_updates": {"added": [], "removed": ["Google.Chrome"], "changed": []},
+        "pending_os_updates": {"added": [], "removed": [], "changed": []},
+    }
+    response = send_delta(client, base_hash, state_of(new_apps), delta)
+    assert response.status_code == 200
+    assert response.get_json()["state_hash"] == dashboard.compute_state_hash(state_of(new_apps))
+    assert latest_apps(app_db) == [("Google.Chrome", "124.0"), ("Notepad++.Notepad++", "8.6")]
+
+
+def test_delta_against_unknown_base_requires_resync(client, app_db):
+    send_report(client, "pc01", APPS)
+    empty = {"added": [], "removed": [], "changed": []}
+    delta = {"installed_apps": {"added": [], "removed": ["7zip.7zip"], "changed": []},
+             "available_app_updates": empty, "pending_os_updates": empty}
+    response = send_delta(client, "0" * 64, state_of(APPS[:1]), delta)
+    assert response.status_code == 409
+    assert response.get_json() == {"status": "resync_required"}
+    assert latest_apps(app_db) == [("7zip.7zip", "23.01"), ("Google.Chrome", "123.0")]
+
+
+def test_delta_with_mismatched_result_hash_requires_resync(client, app_db):
+    base_hash = send_report(client, "pc01", APPS).get_json()["state_hash"]
+    empty = {"added": [], "removed": [], "changed": []}
+    delta = {"installed_apps": empty, "available_app_updates": empty, "pending_os_updates": empty}
+    assert send_delta(client, base_hash, state_of(APPS), delta, state_hash="f" * 64).status_code == 409
+    # Po pełnej synchronizacji kolejna delta znowu przechodzi.
+    base_hash = send_report(client, "pc01", APPS).get_json()["state_hash"]
+    assert send_delta(client, base_hash, state_of(APPS), delta).status_code == 200
+
+
+def test_delta_from_unknown_host_requires_resync(client):
+    empty = {"added": [], "removed": [], "changed": []}
+    delta = {"installed_apps": empty, "available_app_updates": empty, "pending_os_updates": empty}
+    assert send_delta(client, "0" * 64, state_of([]), delta).status_code == 409
+
+
+def test_full_report_without_a_section_keeps_previous_data(client, app_db):
+    send_report(client, "pc01", APPS, UPDATES, OS_UPDATES)
+    response = client.post("/api/report", headers=API_HEADERS, json={
+        "hostname": "pc01", "ip_address": "10.0.0.1", "available_app_updates": [], "pending_os_updates": OS_UPDATES})
+    assert response.status_code == 200
+    assert response.get_json()["state_hash"] == dashboard.compute_state_hash(state_of(APPS, [], OS_UPDATES))
+    assert latest_apps(app_db) == [("7zip.7zip", "23.01"), ("Google.Chrome", "123.0")]
@@ -0,0 +1,59 @@
+"""Retencja historii raportów: przerzedzanie według polityki przez wspólne połączenie zapisujące."""
+import contextlib
+import sqlite3
+
+from conftest import dashboard, send_report
+
+CHROME = {"name": "Google Chrome", "id": "Google.Chrome", "version": "123.0"}
+
+
+def backdate_reports(app_db, days):
+    db = sqlite3.connect(app_db)
+    for report_id, age in days.items():
+        db.execute("UPDATE reports SET report_timestamp = datetime('now', ?) WHERE id = ?", (f"-{age} days", report_id))
+    db.commit()
+    db.close()
+
+
+def report_ids(app_db):
+    db = sqlite3.connect(app_db)
+    try:
+        return [r[0] for r in db.execute("SELECT id FROM reports ORDER BY id")]
+    finally:
+        db.close()
+
+
+def test_prune_keeps_latest_report_and_one_per_day(client, app_db):
+    for version in ("120.0", "121.0", "122.0", "123.0"):
+        send_report(client, "pc01", [dict(CHROME, version=version)])
+    backdate_reports(app_db, {1: 10.2, 2: 10.1, 3: 3})
+    stats = dashboard.prune_reports(dashboard.parse_retention_policy("all:1,daily:30"), pause=0)
+    assert (stats["candidates"], stats["reports"]) == (1, 1)
+    assert report_ids(app_db) == [2, 3, 4]
+
+    stats = dashboard.prune_reports(dashboard.parse_retention_policy("all:1"), pause=0)
+    assert report_ids(app_db) == [4]  # ostatni raport komputera nigdy nie jest usuwany
+    assert stats["snapshots"] == 2  # migawkę raportu 1 usunęło już pierwsze przerzedzanie
+
+
+def test_prune_writes_only_through_write_db(client, app_db, monkeypatch):
+    for version in ("120.0", "121.0", "122.0"):
+        send_report(client, "pc01", [dict(CHROME, version=version)])
+    backdate_reports(app_db, {1: 5, 2: 5})
+    blocks = []
+    original = dashboard.write_db
+
+    @contextlib.contextmanager
+    def counting_write_db():
+        with original() as db:
+            blocks.append(db)
+            yield db
+    monkeypatch.setattr(dashboard, "write_db", counting_write_db)
+    connections = []
+    connect_db = dashboard.connect_db
+    monkeypatch.setattr(dashboard, "connect_db", lambda **kwargs: connections.append(kwargs) or connect_db(**kwargs))
+    dashboard.prune_reports(dashboard.parse_retention_policy("all:1"), batch_size=1, pause=0)
+    assert report_ids(app_db) == [3]
+    assert connections == [{}]  # tylko połączenie do odczytu listy kandydatów
+    # Osobny blok write_db() na każdą partię raportów i migawek - połączenie jest zwalniane między nimi.
+    assert len(blocks) >= 4 and all(db is blocks[0] for db in blocks)
@@ -0,0 +1,108 @@
+"""Wdrożenia zbiorcze: zwalnianie fal, limit równoległości, próg błędów i wygaszanie zadań bez wyniku."""
+import sqlite3
+
+import pytest
+
+from conftest import API_HEADERS, dashboard, send_report
+
+HOSTS = [f"pc{i:02d}" for i in range(5)]
+CHROME = {"name": "Google Chrome", "id": "Google.Chrome", "version": "123.0"}
+CHROME_UPDATE = {"name": "Google Chrome", "id": "Google.Chrome", "current_version": "123.0", "available_version": "124.0"}
+
+
+@pytest.fixture
+def rollout(client):
+    for hostname in HOSTS:
+        send_report(client, hostname, [CHROME], [CHROME_UPDATE])
+    response = client.post("/api/rollouts", headers=API_HEADERS, json={
+        "package_id": "Google.Chrome", "wave_size": 2, "max_concurrent": 1, "failure_threshold": 0.5})
+    assert response.status_code == 201, response.get_data(as_text=True)
+    return response.get_json()["id"]
+
+
+def task_states(app_db, rollout_id):
+    db = sqlite3.connect(app_db)
+    try:
+        return {hostname: (wave, status) for hostname, wave, status in db.execute(
+            "SELECT c.hostname, t.wave, t.status FROM tasks t JOIN computers c ON c.id = t.computer_id "
+            "WHERE t.rollout_id = ?", (rollout_id,))}
+    finally:
+        db.close()
+
+
+def run_agent(client, hostname, status="zakończone"):
+    """Agent pobiera zadania i od razu zgłasza wynik; zwraca liczbę wykonanych zadań."""
+    tasks = client.get(f"/api/tasks/{hostname}", headers=API_HEADERS).get_json()
+    for task in tasks:
+        client.post("/api/tasks/result", headers=API_HEADERS, json={"task_id": task["id"], "status": status})
+    return len(tasks)
+
+
+def summary(client, rollout_id):
+    return client.get(f"/api/rollouts/{rollout_id}", headers=API_HEADERS).get_json()
+
+
+def test_waves_are_released_one_after_another(client, app_db, rollout):
+    states = task_states(app_db, rollout)
+    assert sorted(wave for wave, _ in states.values()) == [0, 0, 1, 1, 2]
+    assert [h for h, (_, status) in sorted(states.items()) if status == "oczekuje"] == ["pc00"]
+
+    order = []
+    while True:
+        released = [h for h, (_, status) in sorted(task_states(app_db, rollout).items()) if status == "oczekuje"]
+        assert len(released) <= 1  # max_concurrent
+        if not released: break
+        assert run_agent(client, released[0]) == 1
+        order.append((released[0], task_states(app_db, rollout)[released[0]][0]))
+    assert [wave for _, wave in order] == [0, 0, 1, 1, 2]
+    assert summary(client, rollout)["status"] == "zakończone"
+    assert summary(client, rollout)["succeeded"] == len(HOSTS)
+
+
+def test_next_wave_waits_for_running_tasks(client, app_db, rollout):
+    run_agent(client, "pc00")
+    tasks = client.get("/api/tasks/pc01", headers=API_HEADERS).get_json()  # pobrane, bez wyniku ('w toku')
+    assert task_states(app_db, rollout)["pc01"] == (0, "w toku")
+    assert all(status == "wstrzymane" for wave, status in task_states(app_db, rollout).values() if wave > 0)
+    client.post("/api/tasks/result", headers=API_HEADERS, json={"task_id": tasks[0]["id"], "status": "zakończone"})
+    assert sum(status == "oczekuje" for _, status in task_states(app_db, rollout).values()) == 1
+
+
+def test_rollout_stops_above_failure_threshold(client, app_db, rollout, monkeypatch):
+    monkeypatch.setattr(dashboard, "ROLLOUT_MIN_RESULTS", 2)
+    run_agent(client, "pc00", status="błąd")
+    assert summary(client, rollout)["status"] == "aktywne"  # za mało wyników, żeby oceniać próg
+    run_agent(client, "pc01", status="błąd")
+    result = summary(client, rollout)
+    assert result["status"] == "zatrzymane"
+    assert (result["failed"], result["cancelled"], result["held"]) == (2, 3, 0)
+    assert run_agent(client, "pc02") == 0
+
+
+def test_stale_tasks_expire_and_release_the_wave(client, app_db, rollout, monkeypatch):
+    monkeypatch.setattr(dashboard, "ROLLOUT_TASK_TIMEOUT_MINUTES", 30)
+    run_agent(client, "pc00")
+    assert task_states(app_db, rollout)["pc01"] == (0, "oczekuje")  # pc01 jest wyłączony
+    db = sqlite3.connect(app_db)
+    db.execute("UPDATE tasks SET updated_at = datetime('now', '-31 minutes') WHERE status = 'oczekuje'")
+    db.commit()
+    db.close()
+    with dashboard.write_db() as db:
+        released = dashboard.advance_rollout(db, rollout)
+        db.commit()
+    states = task_states(app_db, rollout)
+    assert states["pc01"] == (0, "błąd")
+    assert [h for h, (_, status) in states.items() if status == "oczekuje"] == ["pc02"]
+    assert len(released) == 1
+    assert summary(client, rollout)["failed"] == 1
+    db = sqlite3.connect(app_db)
+    assert db.execute("SELECT action_type, name FROM action_history").fetchall() == [
+        ("APP_UPDATE_SUCCESS", "Google Chrome"), ("APP_UPDATE_FAILURE", "Google Chrome")]
+    db.close()
+
+
+def test_recent_tasks_do_not_expire(client, app_db, rollout, monkeypatch):
+    monkeypatch.setattr(dashboard, "ROLLOUT_TASK_TIMEOUT_MINUTES", 30)
+    with dashboard.write_db() as db:
+        assert dashboard.expire_rollout_tasks(db, rollout) == 0
+    assert task_states(app_db, rollout)["pc00"] == (0, "oczekuje")
@@ -0,0 +1,92 @@
+"""Wyliczanie dostępnych aktualizacji z katalogu wersji (UPDATE_SOURCE=catalog) i porównywanie wersji."""
+import json
+import sqlite3
+
+import pytest
+
+from conftest import dashboard, send_report
+
+
+@pytest.mark.parametrize("older, newer", [
+    ("1.0", "1.0.1"), ("1.9", "1.10"), ("1.0.1", "1.10"), ("1.0-beta", "1.0"), ("2.0a", "2.0b"),
+    ("123.0.6312.123", "124.0.6367.60"), ("23.01", "24.05"), ("8.6.9", "8.6.10"),
+])
+def test_compare_versions_orders_versions(older, newer):
+    assert dashboard.compare_versions(older, newer) == -1
+    assert dashboard.compare_versions(newer, older) == 1
+    assert dashboard.is_newer_version(newer, older)
+
+
+@pytest.mark.parametrize("a, b", [("1.2", "1.2.0"), ("1.2.0.0", "1.2"), ("2.0A", "2.0a"), ("3", "3.0.0")])
+def test_compare_versions_equal(a, b):
+    assert dashboard.compare_versions(a, b) == 0
+    assert not dashboard.is_newer_version(a, b)
+
+
+@pytest.mark.parametrize("installed", ["Unknown", "< 2.0", "> 1.0", ""])
+def test_uncomparable_versions_are_never_outdated(installed):
+    assert not dashboard.is_newer_version("9.9", installed)
+
+
+@pytest.fixture
+def catalog_mode(client, monkeypatch):
+    monkeypatch.setattr(dashboard, "UPDATE_SOURCE", "catalog")
+    return client
+
+
+def import_catalog(tmp_path, packages):
+    path = tmp_path / "catalog.json"
+    path.write_text(json.dumps(packages), encoding="utf-8")
+    result = dashboard.app.test_cli_runner().invoke(args=["import-catalog", str(path)])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def latest_updates(app_db):
+    db = sqlite3.connect(app_db)
+    try:
+        return sorted(db.execute("SELECT u.app_id, u.available_version, u.from_catalog FROM computers c "
+                                 "JOIN updates u ON u.report_id = c.latest_report_id WHERE u.update_type = 'APP'"))
+    finally:
+        db.close()
+
+
+APPS = [{"name": "Google Chrome", "id": "Google.Chrome", "version": "123.0"},
+        {"name": "7-Zip", "id": "7zip.7zip", "version": "23.01"},
+        {"name": "Firefox", "id": "Mozilla.Firefox", "version": "126.0"}]
+
+
+def test_report_gets_updates_from_catalog(catalog_mode, app_db, tmp_path):
+    import_catalog(tmp_path, [{"id": "google.chrome", "version": "124.0"}, {"id": "Mozilla.Firefox", "version": "125.0"}])
+    response = send_report(catalog_mode, "pc01", APPS)
+    assert response.headers["X-Update-Source"] == "catalog"
+    assert latest_updates(app_db) == [("Google.Chrome", "124.0", 1)]
+
+
+def test_agent_reported_update_takes_precedence(catalog_mode, app_db, tmp_path):
+    import_catalog(tmp_path, [{"id": "Google.Chrome", "version": "124.0"}])
+    send_report(catalog_mode, "pc01", APPS, [{"name": "Google Chrome", "id": "Google.Chrome",
+                                              "current_version": "123.0", "available_version": "124.1"}])
+    assert latest_updates(app_db) == [("Google.Chrome", "124.1", 0)]
+
+
+def test_catalog_import_refreshes_latest_report_and_report_page(catalog_mode, app_db, tmp_path):
+    import_catalog(tmp_path, [{"id": "Google.Chrome", "version": "124.0"}])
+    send_report(catalog_mode, "pc01", APPS)
+    page = catalog_mode.get("/report/1")
+    assert "124.0" in page.get_data(as_text=True)
+
+    output = import_catalog(tmp_path, [{"id": "Google.Chrome", "version": "125.0"}, {"id": "7zip.7zip", "version": "24.05"}])
+    assert "zmiany u 1" in output
+    assert latest_updates(app_db) == [("7zip.7zip", "24.05", 1), ("Google.Chrome", "125.0", 1)]
+    # Strona raportu jest wersjonowana przez page_version komputera - stary ETag już nie pasuje.
+    response = catalog_mode.get("/report/1", headers={"If-None-Match": page.headers["ETag"]})
+    assert response.status_code == 200
+    assert "125.0" in response.get_data(as_text=True)
+
+
+def test_agent_mode_ignores_catalog(client, app_db, tmp_path):
+    import_catalog(tmp_path, [{"id": "Google.Chrome", "version": "124.0"}])
+    response = send_report(client, "pc01", APPS)
+    assert response.headers["X-Update-Source"] == "agent"
+    assert latest_updates(app_db) == []